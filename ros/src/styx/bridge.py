@@ -12,7 +12,8 @@ import sensor_msgs.point_cloud2 as pcl2
 from std_msgs.msg import Header
 from cv_bridge import CvBridge, CvBridgeError
 
-from styx_msgs.msg import TrafficLight, TrafficLightArray, Lane
+from styx_msgs.msg import TrafficLight, TrafficLightArray, Lane, SharedImage
+from image_ring import ImageRingWriter
 import numpy as np
 from PIL import Image as PIL_Image
 from io import BytesIO
@@ -32,7 +33,8 @@ TYPE = {
     'brake_cmd': BrakeCmd,
     'throttle_cmd': ThrottleCmd,
     'path_draw': Lane,
-    'image':Image
+    'image':Image,
+    'image_shm': SharedImage
 }
 
 
@@ -58,6 +60,15 @@ class Bridge(object):
         self.publishers = {e.name: rospy.Publisher(e.topic, TYPE[e.type], queue_size=1)
                            for e in conf.publishers}
 
+        # Optionally pass camera frames to nodes on this host through shared memory,
+        # publishing just a descriptor of each (full images are then only sent if
+        # something else subscribes to them)
+        if rospy.get_param('/camera_shared_memory', False):
+            self.image_ring = ImageRingWriter(num_slots=rospy.get_param('/camera_ring_slots', 8))
+            rospy.on_shutdown(self.image_ring.close)
+        else:
+            self.image_ring = None
+
     def create_light(self, x, y, z, yaw, state):
         light = TrafficLight()
 
@@ -178,8 +189,20 @@ class Bridge(object):
         imgString = data["image"]
         image = PIL_Image.open(BytesIO(base64.b64decode(imgString)))
         image_array = np.asarray(image)
+        stamp = rospy.Time.now()
+
+        if self.image_ring:
+            descriptor = SharedImage()
+            descriptor.header.stamp = stamp
+            descriptor.ring, descriptor.slot, descriptor.sequence = self.image_ring.write(image_array)
+            descriptor.height, descriptor.width = image_array.shape[:2]
+            descriptor.encoding = "rgb8"
+            self.publishers['image_shm'].publish(descriptor)
+            if self.publishers['image'].get_num_connections() == 0:
+                return
 
         image_message = self.bridge.cv2_to_imgmsg(image_array, encoding="rgb8")
+        image_message.header.stamp = stamp
         self.publishers['image'].publish(image_message)
 
     def callback_steering(self, data):
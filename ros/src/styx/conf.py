@@ -19,5 +19,6 @@ conf = AttrDict({
         {'topic': '/vehicle/traffic_lights', 'type': 'trafficlights', 'name': 'trafficlights'},
         {'topic': '/vehicle/dbw_enabled', 'type': 'bool', 'name': 'dbw_status'},
         {'topic': '/image_color', 'type': 'image', 'name': 'image'},
+        {'topic': '/image_color_shm', 'type': 'image_shm', 'name': 'image_shm'},
     ]
 })
@@ -0,0 +1,162 @@
+###############################################################################
+#   Udacity self-driving car course : Capstone Project.
+#
+#   Team   : smart-carla
+#
+#   Ring buffer of camera frames in shared memory (a memory-mapped file in
+#   /dev/shm), so that the bridge can hand frames to tl_detector on the
+#   same host without serialising 1.4 MB images through TCPROS: the bridge
+#   writes each decoded frame into the next slot and publishes a small
+#   styx_msgs/SharedImage descriptor, and the detector views the slot in
+#   place. Each slot records the sequence number of the frame in it, zeroed
+#   while being written, so a reader can tell if the slot has since been
+#   reused for a newer frame.
+#
+#   File layout: HEADER at 0, then a uint64 sequence number per slot, then
+#   from DATA_OFFSET the slots themselves, each slot_size bytes.
+###############################################################################
+
+import errno
+import glob
+import itertools
+import mmap
+import os
+import struct
+import tempfile
+
+import numpy as np
+
+HEADER = struct.Struct('<4sIII') # magic, version, number of slots, slot size
+MAGIC = b'IMRG'
+VERSION = 1
+SEQUENCE = struct.Struct('<Q')
+SEQUENCES_OFFSET = 64
+DATA_OFFSET = 4096 # page aligned
+
+# Numbers each ring file a writer in this process opens
+ring_numbers = itertools.count(1)
+
+DEFAULT_RING_PATH = os.path.join('/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir(),
+                                 'styx_image_color')
+
+def remove_stale_rings(base_path):
+    """Removes ring files left by writers that died without closing them"""
+    for path in glob.glob(base_path + "_*"):
+        try:
+            pid = int(path[len(base_path) + 1:].split("_")[0])
+        except ValueError:
+            continue # someone else's, e.g. a longer base path
+        try:
+            os.kill(pid, 0)
+        except OSError as e:
+            if e.errno == errno.ESRCH:
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass # another writer got there first
+
+class ImageRingWriter(object):
+
+    def __init__(self, path=DEFAULT_RING_PATH, num_slots=8):
+        """
+        Args:
+            path (str): ring buffer file names start with this
+            num_slots (int): frames kept; readers have until this many newer
+                             frames have been written to finish with one
+        """
+        self.base_path = path
+        self.num_slots = num_slots
+        self.path = None
+        self.ring = None
+        self.slot_size = 0
+        self.sequence = 0
+
+    def open(self, slot_size):
+        """(Re)creates the ring file with slots of at least slot_size bytes. Each
+           file gets a new name (with the writer's pid, a number and the slot
+           size), so readers of an old ring keep their mapping, and a reader
+           never mistakes a restarted writer's ring for the one it has open."""
+        if self.path is None:
+            remove_stale_rings(self.base_path)
+        self.close()
+        self.slot_size = (slot_size + mmap.PAGESIZE - 1) // mmap.PAGESIZE * mmap.PAGESIZE
+        self.path = "%s_%d_%d_%d" % (self.base_path, os.getpid(), next(ring_numbers), self.slot_size)
+        size = DATA_OFFSET + self.num_slots * self.slot_size
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o600)
+        try:
+            os.ftruncate(fd, size)
+            self.ring = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        HEADER.pack_into(self.ring, 0, MAGIC, VERSION, self.num_slots, self.slot_size)
+
+    def close(self):
+        if self.ring is not None:
+            self.ring.close()
+            self.ring = None
+            try:
+                os.unlink(self.path)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise # otherwise already removed, e.g. by a /dev/shm cleanup
+
+    def write(self, image):
+        """Copies a frame into the next slot
+
+        Args:
+            image (ndarray): uint8 image
+
+        Returns:
+            (str, int, int): ring file path, slot and sequence number for the descriptor
+        """
+        if image.nbytes > self.slot_size:
+            self.open(image.nbytes)
+        self.sequence += 1
+        slot = self.sequence % self.num_slots
+        sequence_offset = SEQUENCES_OFFSET + slot * SEQUENCE.size
+        # Mark slot as being written, so readers of the frame it held see it's gone
+        SEQUENCE.pack_into(self.ring, sequence_offset, 0)
+        data_offset = DATA_OFFSET + slot * self.slot_size
+        slot_view = np.frombuffer(self.ring, dtype=np.uint8, count=image.nbytes, offset=data_offset)
+        slot_view[:] = np.ascontiguousarray(image).reshape(-1)
+        del slot_view # no buffer exports left, so the ring can be closed and resized
+        SEQUENCE.pack_into(self.ring, sequence_offset, self.sequence)
+        return self.path, slot, self.sequence
+
+class ImageRingReader(object):
+
+    def __init__(self, path):
+        """
+        Args:
+            path (str): ring buffer file, as given in the descriptor
+        """
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            self.ring = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+        finally:
+            os.close(fd)
+        magic, version, self.num_slots, self.slot_size = HEADER.unpack_from(self.ring, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("%s is not a version %d image ring" % (path, VERSION))
+
+    def slot_sequence(self, slot):
+        """Sequence number of the frame now in the slot, 0 while one is being written"""
+        return SEQUENCE.unpack_from(self.ring, SEQUENCES_OFFSET + slot * SEQUENCE.size)[0]
+
+    def is_current(self, slot, sequence):
+        """True if the slot still holds the given frame"""
+        return self.slot_sequence(slot) == sequence
+
+    def view(self, slot, sequence, height, width, channels=3):
+        """The frame in place in shared memory, without copying it
+
+        Returns:
+            ndarray: height x width x channels read-only view, or None if the slot
+                     has already been reused; check is_current() again once
+                     finished with it in case it was reused meanwhile
+        """
+        if not self.is_current(slot, sequence):
+            return None
+        image = np.frombuffer(self.ring, dtype=np.uint8, count=height * width * channels,
+                              offset=DATA_OFFSET + slot * self.slot_size)
+        return image.reshape(height, width, channels)
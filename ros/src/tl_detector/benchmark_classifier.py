@@ -0,0 +1,255 @@
+###############################################################################
+#   Udacity self-driving car course : Capstone Project.
+#
+#   Team   : smart-carla
+#
+#   Streams the labelled images in data/ through one or more TLClassifier
+#   backends and reports, for each, accuracy, per-class precision/recall,
+#   confusion between light states, throughput, latency percentiles and
+#   peak resident memory. Runs without ROS: if styx_msgs isn't available a
+#   stand-in with the TrafficLight states is used. Each backend is run in
+#   its own process so that its memory is measured on its own. Run from
+#   this folder, e.g.
+#     python benchmark_classifier.py --classifier COLOUR --img-type sim
+#     python benchmark_classifier.py --classifier FRCNN,CASCADE \
+#         --model-variant ,optimised --batch-size 1,4 --json results.json
+#   With --soak, classifies that many frames instead and reports whether
+#   graph size and latency stay flat, e.g. --classifier VGG --soak 100000
+###############################################################################
+
+import argparse
+import json
+import multiprocessing
+import platform
+import resource
+import sys
+import time
+
+import cv2
+import numpy as np
+from six.moves import queue
+
+from light_classification import styx_msgs_stub
+USING_STYX_MSGS_STUB = styx_msgs_stub.install_if_missing()
+
+from light_classification.tl_classifier import TLClassifier
+from light_classification.labelled_images import find_labelled_images
+
+STATES = [0, 1, 2, 4]
+STATE_NAMES = ['RED', 'YELLOW', 'GREEN', 'UNKNOWN']
+LATENCY_PERCENTILES = [50, 90, 95, 99]
+
+def peak_rss_mb():
+    """Peak resident memory of this process so far in MB"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kB, macOS bytes
+    return peak / (1024.0 * 1024.0) if sys.platform == 'darwin' else peak / 1024.0
+
+def cpu_description():
+    """CPU model name, so results from different machines aren't confused"""
+    try:
+        with open('/proc/cpuinfo') as f:
+            for line in f:
+                if line.startswith('model name'):
+                    return line.split(':', 1)[1].strip()
+    except IOError:
+        pass
+    return platform.processor()
+
+def soak(classifier, labelled_images, num_frames, window=1000):
+    """Classifies num_frames frames, cycling round the images, and reports the
+       number of ops in the graph and mean latency for each window of frames"""
+    images = [cv2.imread(image_file) for image_file, _ in labelled_images[:100]]
+    graph = classifier.sess.graph if hasattr(classifier, 'sess') else None
+    start_ops = len(graph.get_operations()) if graph else 0
+
+    print("%10s %10s %10s" % ("frames", "graph ops", "mean ms"))
+    window_time = 0.0
+    for frame in range(1, num_frames + 1):
+        tic = time.time()
+        classifier.get_classification(images[frame % len(images)])
+        window_time += time.time() - tic
+        if frame % window == 0 or frame == num_frames:
+            num_ops = len(graph.get_operations()) if graph else 0
+            print("%10d %10d %10.1f" % (frame, num_ops,
+                      1000.0 * window_time / (window if frame % window == 0 else frame % window)))
+            window_time = 0.0
+
+    end_ops = len(graph.get_operations()) if graph else 0
+    print("Graph grew by %d ops over %d frames" % (end_ops - start_ops, num_frames))
+
+def class_metrics(confusion):
+    """Precision and recall of each state from a true x predicted confusion matrix"""
+    metrics = {}
+    for i, name in enumerate(STATE_NAMES):
+        predicted = confusion[:, i].sum()
+        actual = confusion[i, :].sum()
+        metrics[name] = {'precision': float(confusion[i, i]) / predicted if predicted else None,
+                         'recall': float(confusion[i, i]) / actual if actual else None,
+                         'support': int(actual)}
+    return metrics
+
+def benchmark(classifier_name, model_variant, is_site, labelled_images, batch_size=1):
+    """Loads one backend and streams the images through it, one at a time or
+       batch_size at a time with get_classification_batch()
+
+    Returns:
+        dict: results, as written to the JSON output
+    """
+    rss_before_load = peak_rss_mb()
+    tic = time.time()
+    classifier = TLClassifier(is_site=is_site, model_variant=model_variant,
+                              classifier=classifier_name)
+    load_time = time.time() - tic
+
+    confusion = np.zeros((len(STATES), len(STATES)), dtype=int) # true x predicted
+    latencies = [] # per image; for batches, batch time shared equally
+    start = time.time()
+    for batch_start in range(0, len(labelled_images), batch_size):
+        batch = labelled_images[batch_start:batch_start + batch_size]
+        images = [cv2.imread(image_file) for image_file, _ in batch] # BGR, as from camera via cv_bridge
+        tic = time.time()
+        if batch_size == 1:
+            states = [classifier.get_classification(images[0])]
+        else:
+            states, _ = classifier.get_classification_batch(images)
+        latencies.extend([(time.time() - tic) * 1000.0 / len(batch)] * len(batch))
+        for (_, true_state), state in zip(batch, states):
+            confusion[STATES.index(true_state), STATES.index(state)] += 1
+    elapsed = time.time() - start
+
+    # Ignore the first, which includes one-off setup costs
+    latencies = np.array(latencies[1:] if len(latencies) > 1 else latencies)
+    results = {'classifier': classifier_name,
+               'model_variant': model_variant,
+               'site': is_site,
+               'batch_size': batch_size,
+               'images': len(labelled_images),
+               'load_time_s': load_time,
+               'accuracy': float(np.trace(confusion)) / max(1, len(labelled_images)),
+               # Including reading and decoding each image file
+               'throughput_fps': len(labelled_images) / elapsed if elapsed else None,
+               'classify_fps': 1000.0 / np.mean(latencies) if len(latencies) else None,
+               'latency_ms': {'mean': float(np.mean(latencies)) if len(latencies) else None,
+                              'max': float(np.max(latencies)) if len(latencies) else None},
+               'rss_before_load_mb': rss_before_load,
+               'peak_rss_mb': peak_rss_mb(),
+               'classes': class_metrics(confusion),
+               'confusion': confusion.tolist()}
+    for percentile in LATENCY_PERCENTILES:
+        results['latency_ms']['p%d' % percentile] = (float(np.percentile(latencies, percentile))
+                                                     if len(latencies) else None)
+    if classifier_name == "CASCADE":
+        results['cascade'] = classifier.get_cascade_stats()
+    return results
+
+def benchmark_worker(result_queue, args):
+    try:
+        result_queue.put(benchmark(*args))
+    except Exception as e:
+        result_queue.put({'classifier': args[0], 'model_variant': args[1], 'error': repr(e)})
+
+def benchmark_in_subprocess(*args):
+    """Runs benchmark() in a child process, so peak memory is for that backend alone"""
+    result_queue = multiprocessing.Queue()
+    worker = multiprocessing.Process(target=benchmark_worker, args=(result_queue, args))
+    worker.start()
+    while True:
+        try:
+            results = result_queue.get(timeout=1.0)
+            break
+        except queue.Empty:
+            if not worker.is_alive():
+                # Died without reporting back, e.g. killed for using too much
+                # memory or crashed inside TensorFlow/OpenCV (one more look in
+                # case the result arrived as it exited)
+                try:
+                    results = result_queue.get(timeout=1.0)
+                except queue.Empty:
+                    results = {'classifier': args[0], 'model_variant': args[1],
+                               'error': "benchmark process died with exit code %s" % worker.exitcode}
+                break
+    worker.join()
+    return results
+
+def print_results(results, img_type):
+    if 'error' in results:
+        print("\n%s %s failed: %s" % (results['classifier'], results['model_variant'], results['error']))
+        return
+    latency = results['latency_ms']
+    print("\n%s%s on %d %s images, batches of %d: accuracy=%.3f" % (results['classifier'],
+              " (%s)" % results['model_variant'] if results['model_variant'] else "",
+              results['images'], img_type, results['batch_size'], results['accuracy']))
+    print("Loaded in %.1f s, throughput %.1f frames/s (%.1f classifying only), peak RSS %.0f MB" %
+              (results['load_time_s'], results['throughput_fps'] or 0.0,
+               results['classify_fps'] or 0.0, results['peak_rss_mb']))
+    print("Time per frame: mean=%.1f ms " % latency['mean'] +
+              " ".join("p%d=%.1f ms" % (p, latency['p%d' % p]) for p in LATENCY_PERCENTILES) +
+              " max=%.1f ms" % latency['max'])
+    if 'cascade' in results:
+        stats = results['cascade']
+        print("Cascade: escalated %.1f%% of frames, stage 1 mean=%.1f ms, stage 2 mean=%.1f ms" %
+                  (100.0 * stats['escalation_rate'], 1000.0 * stats['stage1_mean_time'],
+                   1000.0 * stats['stage2_mean_time']))
+    print("\nConfusion (rows true, columns predicted):")
+    print("%8s " % "" + " ".join("%8s" % name for name in STATE_NAMES) +
+              " %9s %9s" % ("precision", "recall"))
+    for name, row in zip(STATE_NAMES, results['confusion']):
+        metrics = results['classes'][name]
+        print("%8s " % name + " ".join("%8d" % count for count in row) + " %9s %9s" %
+                  tuple("%.3f" % metrics[key] if metrics[key] is not None else "-"
+                        for key in ('precision', 'recall')))
+
+def run():
+    parser = argparse.ArgumentParser(description="Benchmark traffic light classifier backends")
+    parser.add_argument('--classifier', default="FRCNN",
+                        help="comma-separated backends from FRCNN, VGG, COLOUR and CASCADE")
+    parser.add_argument('--model-variant', default="",
+                        help="comma-separated FRCNN model variants to try, e.g. ',optimised' "
+                             "for the original and optimised models")
+    parser.add_argument('--site', action='store_true', help="use the real-image model")
+    parser.add_argument('--img-type', default="both", help="sim, real or both")
+    parser.add_argument('--max-images', type=int, default=0, help="limit number of images (0=all)")
+    parser.add_argument('--batch-size', default="1",
+                        help="comma-separated numbers of images to classify per call, e.g. 1,4,8")
+    parser.add_argument('--json', help="also write results to this file")
+    parser.add_argument('--soak', type=int, default=0,
+                        help="instead run this many frames, checking graph size and latency stay flat")
+    args = parser.parse_args()
+
+    labelled_images = find_labelled_images(args.img_type)
+    if args.max_images:
+        labelled_images = labelled_images[:args.max_images]
+
+    classifier_names = args.classifier.split(',')
+    model_variants = args.model_variant.split(',')
+
+    if args.soak:
+        classifier = TLClassifier(is_site=args.site, model_variant=model_variants[0],
+                                  classifier=classifier_names[0])
+        soak(classifier, labelled_images, args.soak)
+        return
+
+    all_results = []
+    for classifier_name in classifier_names:
+        # Model variants only apply to backends that use the FRCNN model
+        for model_variant in (model_variants if classifier_name in ("FRCNN", "CASCADE") else [""]):
+            for batch_size in [int(size) for size in args.batch_size.split(',')]:
+                results = benchmark_in_subprocess(classifier_name, model_variant, args.site,
+                                                  labelled_images, batch_size)
+                print_results(results, args.img_type)
+                all_results.append(results)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'host': {'cpu': cpu_description(),
+                                'cpu_count': multiprocessing.cpu_count(),
+                                'platform': platform.platform(),
+                                'python': platform.python_version()},
+                       'time': time.strftime("%Y-%m-%dT%H:%M:%S"),
+                       'img_type': args.img_type,
+                       'styx_msgs_stub': USING_STYX_MSGS_STUB,
+                       'results': all_results}, f, indent=2, sort_keys=True)
+
+if __name__ == '__main__':
+    run()
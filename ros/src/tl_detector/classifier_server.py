@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+###############################################################################
+#   Udacity self-driving car course : Capstone Project.
+#
+#   Team   : smart-carla
+#
+#   Runs TLClassifier in its own process, serving classification requests
+#   from tl_detector over a Unix domain socket with frames passed in shared
+#   memory (see light_classification/classifier_service.py). tl_detector
+#   starts this itself when its ~classifier_server parameter is set, but it
+#   can also be run by hand, and works without ROS, e.g.
+#     python classifier_server.py --classifier FRCNN --workers 2
+#   and then, from another shell, stream the labelled images in data/
+#   through it as tl_detector would:
+#     python classifier_server.py --client --in-flight 2 --timeout 0.5
+###############################################################################
+
+import argparse
+import signal
+import sys
+import time
+
+import cv2
+import numpy as np
+
+from light_classification import styx_msgs_stub
+styx_msgs_stub.install_if_missing()
+
+from light_classification.classifier_service import (ClassifierServer, ClassifierClient,
+                                                     DEFAULT_SOCKET_PATH)
+from light_classification.labelled_images import find_labelled_images
+
+def serve(args):
+    # Only the server needs TensorFlow
+    from light_classification.tl_classifier import TLClassifier, set_thread_cpu_affinity
+
+    cpu_affinity = [int(cpu) for cpu in args.cpu_affinity.split(',') if cpu]
+    if cpu_affinity:
+        # Before any other thread starts, so the whole server inherits it
+        set_thread_cpu_affinity(cpu_affinity)
+
+    def make_classifier(progress_cb):
+        return TLClassifier(is_site=args.site, model_variant=args.model_variant,
+                            classifier=args.classifier, cascade_confidence=args.cascade_confidence,
+                            intra_op_threads=args.intra_op_threads,
+                            inter_op_threads=args.inter_op_threads,
+                            warm_up=not args.no_warm_up, progress_cb=progress_cb)
+
+    server = ClassifierServer(args.socket, make_classifier, workers=args.workers,
+                              max_queue=args.max_queue)
+    # Tidy up the socket file when tl_detector stops us
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    server.serve_forever()
+
+def client(args):
+    """Streams labelled images through a running server, args.in_flight at a
+       time, and reports accuracy, round trip times, failures and server health"""
+    labelled_images = find_labelled_images(args.img_type)
+    if args.max_images:
+        labelled_images = labelled_images[:args.max_images]
+
+    def report_stage(stage):
+        print("Server: %s" % stage)
+
+    tl_client = ClassifierClient(args.socket, timeout=args.timeout, max_in_flight=args.in_flight)
+    try:
+        if not tl_client.wait_until_ready(args.ready_timeout, progress_cb=report_stage):
+            print("Server at %s not ready" % args.socket)
+            return
+        print("Timeout %.2f s" % tl_client.timeout)
+        correct = 0
+        latencies = []
+        start = time.time()
+        for batch_start in range(0, len(labelled_images), args.in_flight):
+            batch = labelled_images[batch_start:batch_start + args.in_flight]
+            images = [cv2.imread(image_file) for image_file, _ in batch]
+            tic = time.time()
+            states, _ = tl_client.get_classification_batch(images)
+            latencies.extend([time.time() - tic] * len(batch))
+            correct += sum(state == true_state for (_, true_state), state in zip(batch, states))
+        elapsed = time.time() - start
+
+        print("%d images: accuracy=%.3f, %.1f frames/s" %
+                  (len(labelled_images), float(correct) / max(1, len(labelled_images)),
+                   len(labelled_images) / elapsed if elapsed else 0.0))
+        if latencies:
+            print("Round trip per request: p50=%.1f ms p95=%.1f ms max=%.1f ms" %
+                      tuple(1000.0 * value for value in (np.percentile(latencies, 50),
+                                                         np.percentile(latencies, 95),
+                                                         np.max(latencies))))
+        print("Client: %s" % tl_client.counts)
+        print("Server: %s" % tl_client.get_health())
+    finally:
+        tl_client.close()
+
+def run():
+    parser = argparse.ArgumentParser(description="Traffic light classifier server")
+    parser.add_argument('--socket', default=DEFAULT_SOCKET_PATH, help="Unix domain socket path")
+    parser.add_argument('--client', action='store_true',
+                        help="instead stream the labelled images through a running server")
+    # Server options, as the tl_detector parameters of the same names
+    parser.add_argument('--classifier', default="FRCNN", help="FRCNN, VGG, COLOUR or CASCADE")
+    parser.add_argument('--site', action='store_true', help="use the real-image model")
+    parser.add_argument('--model-variant', default="", help="e.g. optimised")
+    parser.add_argument('--cascade-confidence', type=float, default=0.9)
+    parser.add_argument('--intra-op-threads', type=int, default=0)
+    parser.add_argument('--inter-op-threads', type=int, default=0)
+    parser.add_argument('--cpu-affinity', default="",
+                        help="comma-separated CPU numbers to pin the server process to")
+    parser.add_argument('--no-warm-up', action='store_true')
+    parser.add_argument('--workers', type=int, default=1,
+                        help="requests classified at once, each with its own copy of the model")
+    parser.add_argument('--max-queue', type=int, default=8,
+                        help="requests waiting for a worker before more are refused")
+    # Client options
+    parser.add_argument('--img-type', default="both", help="sim, real or both")
+    parser.add_argument('--max-images', type=int, default=0, help="limit number of images (0=all)")
+    parser.add_argument('--in-flight', type=int, default=1, help="requests outstanding at once")
+    parser.add_argument('--timeout', type=float, default=0.0,
+                        help="seconds to wait for each result (0=fit to the server's classification time)")
+    parser.add_argument('--ready-timeout', type=float, default=120.0,
+                        help="seconds to wait for the server to load")
+    args = parser.parse_args()
+
+    if args.client:
+        client(args)
+    else:
+        serve(args)
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,169 @@
+###############################################################################
+#   Udacity self-driving car course : Capstone Project.
+#
+#   Team   : smart-carla
+#
+#   Replays laps of a circuit of cycling traffic lights, watching each light
+#   for a while on every lap as the car would approaching and waiting at it,
+#   and compares classifying on the fixed schedule (every 0.5 s by default,
+#   as when stopped at the light) with letting LightPhaseEstimator stretch
+#   the interval while no change of light is due. With --base-interval 0, as
+#   inside the braking envelope, the estimator never stretches it. Reports the classifications
+#   saved and how much later each change of light is noticed. The first run
+#   starts with no timings learnt (unless given an existing --state-file,
+#   e.g. one tl_detector saved); later runs load what the previous one
+#   saved, as tl_detector does across restarts. Each light gets its own
+#   cycle timing and offset. Needs neither ROS nor a classifier (which is
+#   taken to be always right), e.g.
+#     python evaluate_phase_estimator.py --laps 5 --runs 2 --jitter 0.2
+###############################################################################
+
+import argparse
+import bisect
+import os
+import random
+import tempfile
+
+import numpy as np
+
+from light_classification.light_phase_estimator import LightPhaseEstimator
+from light_classification.classification_scheduler import ClassificationScheduler
+
+RED, YELLOW, GREEN = 0, 1, 2
+STATE_NAMES = {RED: 'RED', YELLOW: 'YELLOW', GREEN: 'GREEN'}
+NEXT_STATE = {GREEN: YELLOW, YELLOW: RED, RED: GREEN}
+
+class CyclingLight(object):
+    """Light going GREEN, YELLOW, RED, GREEN... with the given durations,
+       each varied by jitter seconds (standard deviation)"""
+
+    def __init__(self, durations, jitter, end_time, rng):
+        self.change_times = []
+        self.states = []
+        state = rng.choice([RED, YELLOW, GREEN])
+        time = -rng.uniform(0.0, durations[state])
+        while time < end_time:
+            self.change_times.append(time)
+            self.states.append(state)
+            time += max(0.5, rng.gauss(durations[state], jitter))
+            state = NEXT_STATE[state]
+
+    def state_at(self, time):
+        return self.states[bisect.bisect_right(self.change_times, time) - 1]
+
+    def changes_between(self, start, end):
+        """(time, new state) of each change in (start, end]"""
+        first = bisect.bisect_right(self.change_times, start)
+        last = bisect.bisect_right(self.change_times, end)
+        return list(zip(self.change_times[first:last], self.states[first:last]))
+
+def replay(lights, args, estimator=None):
+    """Watches each light for args.visit seconds per lap
+
+    Returns:
+        (int, list): classifications made, and (new state, seconds late) for
+                     each change of light while watching
+    """
+    scheduler = ClassificationScheduler(phase_max_interval=args.phase_max_interval)
+    frame_interval = 1.0 / args.frame_rate
+    classifications = 0
+    delays = []
+    for lap in range(args.laps):
+        for light_idx, light in enumerate(lights):
+            start = (lap * len(lights) + light_idx) * (args.visit + args.travel)
+            scheduler.reset() # new light: look straight away
+            pending_changes = [] # changes since we last looked
+            last_look = None
+            for frame in range(int(args.visit * args.frame_rate)):
+                now = start + frame * frame_interval
+                if last_look is not None:
+                    pending_changes.extend(light.changes_between(now - frame_interval, now))
+                time_to_change = estimator.time_to_change(light_idx, now) if estimator else None
+                interval = scheduler.apply_phase(args.base_interval, time_to_change)
+                if last_look is not None and now - last_look < interval - 1e-6:
+                    continue
+                classifications += 1
+                last_look = now
+                state = light.state_at(now)
+                for change_time, new_state in pending_changes:
+                    if new_state == state:
+                        delays.append((new_state, now - change_time))
+                pending_changes = []
+                if estimator:
+                    estimator.observe(light_idx, state, now)
+    return classifications, delays
+
+def summarise_delays(delays):
+    values = [delay for _, delay in delays]
+    if not values:
+        return "no changes seen"
+    return "mean %.2f s, p95 %.2f s, max %.2f s" % (np.mean(values), np.percentile(values, 95), max(values))
+
+def run():
+    parser = argparse.ArgumentParser(description="Replay cycling lights to compare classification "
+                                                 "with and without the light phase estimator")
+    parser.add_argument('--lights', type=int, default=8, help="intersections on the circuit")
+    parser.add_argument('--laps', type=int, default=5, help="laps per run")
+    parser.add_argument('--runs', type=int, default=2,
+                        help="runs, each starting with the timings saved by the last")
+    parser.add_argument('--green', type=float, default=8.0, help="mean green time, seconds")
+    parser.add_argument('--yellow', type=float, default=2.0, help="mean yellow time, seconds")
+    parser.add_argument('--red', type=float, default=10.0, help="mean red time, seconds")
+    parser.add_argument('--spread', type=float, default=0.2,
+                        help="each light's timings are scaled by up to this fraction either way")
+    parser.add_argument('--jitter', type=float, default=0.1,
+                        help="standard deviation of each phase's duration, seconds")
+    parser.add_argument('--visit', type=float, default=30.0, help="seconds watching each light per lap")
+    parser.add_argument('--travel', type=float, default=20.0, help="seconds between lights")
+    parser.add_argument('--frame-rate', type=float, default=10.0, help="camera frames per second")
+    parser.add_argument('--base-interval', type=float, default=0.5,
+                        help="seconds between classifications without the estimator "
+                             "(~schedule_stopped_interval; 0=every frame)")
+    parser.add_argument('--phase-max-interval', type=float, default=1.0,
+                        help="longest interval while no change is due (~phase_max_interval)")
+    parser.add_argument('--margin', type=float, default=1.0,
+                        help="seconds before a predicted change to go back to the fixed schedule (~phase_margin)")
+    parser.add_argument('--state-file', help="where to keep learnt timings between runs (default temporary)")
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    # Each light keeps its own timings from run to run
+    light_durations = []
+    for _ in range(args.lights):
+        scale = 1.0 + rng.uniform(-args.spread, args.spread)
+        light_durations.append({GREEN: args.green * scale, YELLOW: args.yellow, RED: args.red * scale})
+    end_time = args.laps * args.lights * (args.visit + args.travel)
+    # An existing --state-file makes even the first run warm
+    state_file = args.state_file or os.path.join(tempfile.mkdtemp(), "tl_phase.json")
+
+    print("%d lights watched %.0f s per lap, %d laps per run, %.0f frames/s" %
+              (args.lights, args.visit, args.laps, args.frame_rate))
+    for run_idx in range(args.runs):
+        # Lights are at a different point in their cycles each run, as on
+        # restarting the simulator
+        run_rng = random.Random(args.seed + 1 + run_idx)
+        lights = [CyclingLight(durations, args.jitter, end_time, run_rng) for durations in light_durations]
+
+        estimator = LightPhaseEstimator(margin=args.margin)
+        warm = estimator.load(state_file)
+        baseline_count, baseline_delays = replay(lights, args)
+        phase_count, phase_delays = replay(lights, args, estimator)
+        estimator.save(state_file)
+
+        print("\nRun %d (%s start)" % (run_idx + 1, "warm" if warm else "cold"))
+        print("Classifications: %d fixed schedule, %d with estimator (%.1f%% saved)" %
+                  (baseline_count, phase_count, 100.0 * (baseline_count - phase_count) / max(1, baseline_count)))
+        print("Change noticed after: fixed %s; with estimator %s" %
+                  (summarise_delays(baseline_delays), summarise_delays(phase_delays)))
+        for state in (YELLOW, RED, GREEN):
+            print("  to %-6s fixed %s; with estimator %s" %
+                      (STATE_NAMES[state],
+                       summarise_delays([d for d in baseline_delays if d[0] == state]),
+                       summarise_delays([d for d in phase_delays if d[0] == state])))
+
+    print("\nLearnt durations (light: {state: seconds}) in %s:" % state_file)
+    print(estimator.summary())
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,119 @@
+###############################################################################
+#   Udacity self-driving car course : Capstone Project.
+#
+#   Team   : smart-carla
+#
+#   Replays the labelled image sequences in data/ (in index order, as they
+#   were captured) through a classifier, and compares how quickly the
+#   Bayesian light state filter and the old STATE_COUNT_THRESHOLD debounce
+#   react to each change of light, and how often each wrongly reports a red
+#   light or misses one. Needs the catkin workspace sourced (for styx_msgs).
+#   Run from this folder, e.g.
+#     python evaluate_state_filter.py --classifier FRCNN --frame-interval 1.0
+###############################################################################
+
+import argparse
+import os
+from collections import Counter, OrderedDict
+
+import cv2
+import numpy as np
+
+from styx_msgs.msg import TrafficLight
+from light_classification.tl_classifier import TLClassifier, scores_from_confidence
+from light_classification.light_state_filter import LightStateFilter
+from light_classification.labelled_images import find_labelled_images
+
+STATE_COUNT_THRESHOLD = 3 # as in tl_detector.py
+
+class Debounce(object):
+    """The original tl_detector logic: act on a state once it has been
+       classified STATE_COUNT_THRESHOLD+1 times in a row"""
+
+    def __init__(self):
+        self.state = TrafficLight.UNKNOWN
+        self.state_count = 0
+        self.decided_state = None
+
+    def update(self, state):
+        if self.state != state:
+            self.state_count = 0
+            self.state = state
+        elif self.state_count >= STATE_COUNT_THRESHOLD:
+            self.decided_state = self.state
+        self.state_count += 1
+        return self.decided_state
+
+def get_sequences(labelled_images):
+    """Groups images by folder and type, each sorted by capture index. Some
+       frames were saved twice with different labels (two lights in view),
+       which would make the true state flicker, so those are left out."""
+    sequences = OrderedDict()
+    for image_file, state in labelled_images:
+        name = os.path.basename(image_file)
+        key = (os.path.dirname(image_file), name.split('_')[0])
+        sequences.setdefault(key, []).append((int(name.split('_')[1]), image_file, state))
+
+    unambiguous_sequences = []
+    for sequence in sequences.values():
+        index_counts = Counter(index for index, _, _ in sequence)
+        unambiguous_sequences.append(sorted(item for item in sequence if index_counts[item[0]] == 1))
+    return unambiguous_sequences
+
+def score_decisions(truths, decisions, frame_interval):
+    """Reaction delay to each change of true state, plus false and missed red frames"""
+    delays = []
+    red_delays = []
+    for i in range(1, len(truths)):
+        if truths[i] == truths[i - 1]:
+            continue
+        # Frames until decision catches up, if it does before the next change
+        for j in range(i, len(truths)):
+            if truths[j] != truths[i]:
+                break
+            if decisions[j] == truths[i]:
+                delays.append((j - i) * frame_interval)
+                if truths[i] == TrafficLight.RED:
+                    red_delays.append((j - i) * frame_interval)
+                break
+    false_red = sum(1 for t, d in zip(truths, decisions) if d == TrafficLight.RED and t != TrafficLight.RED)
+    missed_red = sum(1 for t, d in zip(truths, decisions) if t == TrafficLight.RED and d != TrafficLight.RED)
+    return {'mean_delay': np.mean(delays) if delays else float('nan'),
+            'mean_red_delay': np.mean(red_delays) if red_delays else float('nan'),
+            'false_red_frames': false_red,
+            'missed_red_frames': missed_red}
+
+def run():
+    parser = argparse.ArgumentParser(description="Compare light state filter with debounce on image replays")
+    parser.add_argument('--classifier', default="FRCNN", help="FRCNN, VGG, COLOUR or CASCADE")
+    parser.add_argument('--site', action='store_true', help="use the real-image model")
+    parser.add_argument('--img-type', default="sim", help="sim, real or both")
+    parser.add_argument('--frame-interval', type=float, default=1.0,
+                        help="seconds between classifications to assume")
+    parser.add_argument('--confidence', type=float, default=0.8, help="filter confidence to report state")
+    args = parser.parse_args()
+
+    classifier = TLClassifier(is_site=args.site, classifier=args.classifier)
+
+    truths = []
+    filtered = []
+    debounced = []
+    for sequence in get_sequences(find_labelled_images(args.img_type)):
+        state_filter = LightStateFilter(confidence=args.confidence)
+        debounce = Debounce()
+        for _, image_file, true_state in sequence:
+            state = classifier.get_classification(cv2.imread(image_file))
+            scores = classifier.last_scores or scores_from_confidence(state, 1.0)
+            truths.append(true_state)
+            filtered.append(state_filter.update(scores, args.frame_interval))
+            debounced.append(debounce.update(state))
+
+    print("\n%d frames, assuming %.2f s per classification" % (len(truths), args.frame_interval))
+    print("%-10s %14s %14s %12s %12s" % ("", "mean delay s", "red delay s", "false red", "missed red"))
+    for name, decisions in (("debounce", debounced), ("filter", filtered)):
+        result = score_decisions(truths, decisions, args.frame_interval)
+        print("%-10s %14.2f %14.2f %12d %12d" % (name, result['mean_delay'], result['mean_red_delay'],
+                  result['false_red_frames'], result['missed_red_frames']))
+
+if __name__ == '__main__':
+    run()
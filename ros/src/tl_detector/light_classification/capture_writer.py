@@ -0,0 +1,165 @@
+###############################################################################
+#   Udacity self-driving car course : Capstone Project.
+#
+#   Team   : smart-carla
+#
+#   Saves training images on a background thread, so that capturing doesn't
+#   hold up the detector. Frames are handed over through a bounded queue;
+#   if the writer falls behind, new frames are dropped rather than making
+#   the caller wait. By default frames go into sharded record files, each
+#   holding a few hundred JPEGs together with their ground truth state, our
+#   pose and distance to the light, so training can read a capture session
+#   from a handful of files instead of globbing thousands of small ones.
+#
+#   Record layout: HEADER (magic, metadata length, JPEG length), then the
+#   metadata as JSON, then the JPEG bytes.
+###############################################################################
+
+import json
+import os
+import struct
+import threading
+import time
+from glob import glob
+
+import cv2
+from six.moves import queue
+
+HEADER = struct.Struct('<4sII')
+MAGIC = b'TLR1'
+SHARD_EXT = '.tlrec'
+
+class CaptureWriter(object):
+
+    def __init__(self, output_dir, sharded=True, records_per_shard=500, queue_size=32,
+                 jpeg_quality=95, prefix="capture"):
+        """
+        Args:
+            output_dir (str): folder to write to
+            sharded (bool): write record files; if False, one
+                            [sim|real]_idx_state.jpg file per frame as before
+            records_per_shard (int): frames per record file
+            queue_size (int): frames waiting to be written before new ones are dropped
+            jpeg_quality (int): 0-100
+            prefix (str): start of record file names, followed by session time
+        """
+        self.output_dir = output_dir
+        self.sharded = sharded
+        self.records_per_shard = records_per_shard
+        self.jpeg_quality = jpeg_quality
+        self.shard_prefix = os.path.join(output_dir, "%s_%s" % (prefix, time.strftime("%Y%m%d_%H%M%S")))
+        self.shard_file = None
+        self.shard_index = 0
+        self.shard_records = 0
+        self.frames_written = 0
+        self.frames_dropped = 0
+        self.frames_failed = 0
+
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.thread = threading.Thread(target=self.write_loop, name="tl_capture_writer")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self, image, image_is_rgb, metadata):
+        """Queues a frame to be saved, never waiting
+
+        Args:
+            image (ndarray): height x width x 3 image; must not be modified
+                             afterwards (a view of a ROS message buffer is fine)
+            image_is_rgb (bool): True if RGB rather than OpenCV's usual BGR
+            metadata (dict): must have 'image_type' ("sim" or "real"), 'idx'
+                             and 'state'; anything else JSON can hold is kept too
+
+        Returns:
+            bool: False if the frame was dropped because the writer is behind
+        """
+        try:
+            self.queue.put_nowait((image, image_is_rgb, metadata))
+            return True
+        except queue.Full:
+            self.frames_dropped += 1
+            return False
+
+    def close(self):
+        """Writes out everything queued so far and closes the current record file"""
+        self.queue.put(None)
+        self.thread.join()
+
+    def write_loop(self):
+        """Writer thread: JPEG-encodes and saves queued frames until closed"""
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            image, image_is_rgb, metadata = item
+            try:
+                self.write(cv2.cvtColor(image, cv2.COLOR_RGB2BGR) if image_is_rgb else image,
+                           metadata)
+                self.frames_written += 1
+            except (IOError, OSError, ValueError) as e:
+                self.frames_failed += 1
+                print("Warning: failed to save training image: %s" % repr(e))
+        if self.shard_file:
+            self.shard_file.close()
+            self.shard_file = None
+
+    def write(self, image, metadata):
+        ok, jpeg = cv2.imencode('.jpg', image, [int(cv2.IMWRITE_JPEG_QUALITY), self.jpeg_quality])
+        if not ok:
+            raise ValueError("JPEG encoding failed")
+        jpeg = jpeg.tobytes()
+
+        if not self.sharded:
+            filename = "%s_%d_%d.jpg" % (metadata['image_type'], metadata['idx'], metadata['state'])
+            with open(os.path.join(self.output_dir, filename), 'wb') as f:
+                f.write(jpeg)
+            return
+
+        if self.shard_file is None or self.shard_records >= self.records_per_shard:
+            if self.shard_file:
+                self.shard_file.close()
+            self.shard_index += 1
+            self.shard_file = open("%s_%04d%s" % (self.shard_prefix, self.shard_index, SHARD_EXT), 'wb')
+            self.shard_records = 0
+        meta = json.dumps(metadata, sort_keys=True).encode('utf-8')
+        self.shard_file.write(HEADER.pack(MAGIC, len(meta), len(jpeg)))
+        self.shard_file.write(meta)
+        self.shard_file.write(jpeg)
+        # So a crash or kill loses at most the frame being written
+        self.shard_file.flush()
+        self.shard_records += 1
+
+def find_capture_shards(folder):
+    """Sorted record files in a folder"""
+    return sorted(glob(os.path.join(folder, "*" + SHARD_EXT)))
+
+def read_capture_index(shard_file):
+    """Reads the metadata of every record in a record file, skipping the images
+
+    Returns:
+        list: (offset, metadata) of each record, offset being where it starts
+    """
+    index = []
+    with open(shard_file, 'rb') as f:
+        while True:
+            offset = f.tell()
+            header = f.read(HEADER.size)
+            if len(header) < HEADER.size:
+                break # end of file, or last record cut short
+            magic, meta_len, jpeg_len = HEADER.unpack(header)
+            if magic != MAGIC:
+                raise ValueError("%s is not a capture record file (at offset %d)" % (shard_file, offset))
+            meta = f.read(meta_len)
+            f.seek(jpeg_len, os.SEEK_CUR)
+            if len(meta) < meta_len or f.tell() > os.fstat(f.fileno()).st_size:
+                break
+            index.append((offset, json.loads(meta.decode('utf-8'))))
+    return index
+
+def read_capture_jpeg(shard_file, offset):
+    """JPEG bytes of the record starting at offset in a record file"""
+    with open(shard_file, 'rb') as f:
+        f.seek(offset)
+        _, meta_len, jpeg_len = HEADER.unpack(f.read(HEADER.size))
+        f.seek(meta_len, os.SEEK_CUR)
+        return f.read(jpeg_len)
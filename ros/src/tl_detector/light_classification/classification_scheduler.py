@@ -0,0 +1,117 @@
+###############################################################################
+#   Udacity self-driving car course : Capstone Project.
+#
+#   Team   : smart-carla
+#
+#   Decides how often to classify the light ahead, and at what input
+#   resolution, from our distance to its stop line and our speed. Inside the
+#   braking envelope (where a red light must already have been seen to stop
+#   comfortably) every frame is classified. Further out, classifications are
+#   spaced so that at least a set number still happen before we reach the
+#   braking envelope, which bounds how late a red light can be noticed. When
+#   we are stopped, the light is checked at a fixed slow rate.
+#
+#   Far away lights are only a few pixels, so they get the highest resolution
+#   of the pyramid; close up a smaller input is enough and quicker.
+#
+#   If a LightPhaseEstimator predicts how long until the light changes, the
+#   interval is stretched towards phase_max_interval while no change is due
+#   (e.g. when stopped), and back to the usual one once a change is. A change
+#   nobody predicted is therefore noticed at most phase_max_interval late.
+#   Inside the braking envelope every frame is still classified whatever the
+#   prediction, as a wrong one there could mean running a red light.
+###############################################################################
+
+class ClassificationScheduler(object):
+
+    def __init__(self, decel=3.0, reaction_time=0.5, min_looks=3, max_interval=2.0,
+                 stopped_speed=0.5, stopped_interval=0.5, pyramid=None, phase_max_interval=1.0):
+        """
+        Args:
+            decel (float): comfortable deceleration in m/s^2 for the braking envelope
+            reaction_time (float): seconds allowed after the last look for
+                                   classification, filtering and the controller
+            min_looks (int): classifications wanted before reaching the envelope
+            max_interval (float): never go longer than this between classifications
+            stopped_speed (float): m/s below which we count as stopped
+            stopped_interval (float): seconds between classifications when stopped
+            pyramid (list): [min_distance, width, height] levels; the first level
+                            whose min_distance we are at or beyond sets the largest
+                            input size (default [[40, 640, 480], [15, 480, 360], [0, 320, 240]])
+            phase_max_interval (float): longest interval while the light isn't
+                                        predicted to change
+        """
+        self.decel = decel
+        self.reaction_time = reaction_time
+        self.min_looks = min_looks
+        self.max_interval = max_interval
+        self.stopped_speed = stopped_speed
+        self.stopped_interval = stopped_interval
+        self.phase_max_interval = phase_max_interval
+        self.pyramid = sorted(pyramid or [[40, 640, 480], [15, 480, 360], [0, 320, 240]], reverse=True)
+        self.last_classify_time = None
+        self.frames_skipped = 0
+
+    def braking_distance(self, speed, processing_time=0.0):
+        """Distance in metres we need to stop from speed, including the
+           distance covered while reacting"""
+        return speed * speed / (2.0 * self.decel) + speed * (self.reaction_time + processing_time)
+
+    def get_interval(self, distance, speed, processing_time=0.0, time_to_change=None):
+        """Longest time in seconds we can now wait between classifications
+
+        Args:
+            distance (float): metres to the stop line
+            speed (float): our speed in m/s
+            processing_time (float): expected time to classify a frame
+            time_to_change (float): seconds until the light may change, if predicted
+        """
+        speed = abs(speed)
+        if speed < self.stopped_speed:
+            interval = self.stopped_interval
+        else:
+            slack = distance - self.braking_distance(speed, processing_time)
+            if slack <= 0.0:
+                interval = 0.0 # inside braking envelope: every frame
+            else:
+                interval = min(self.max_interval, slack / speed / self.min_looks)
+        return self.apply_phase(interval, time_to_change)
+
+    def apply_phase(self, interval, time_to_change):
+        """Interval stretched while the light isn't predicted to change, but
+           never shortened, and never stretched from 0 (inside the braking
+           envelope)"""
+        if time_to_change is None or interval <= 0.0:
+            return interval
+        return max(interval, min(self.phase_max_interval, time_to_change))
+
+    def should_classify(self, distance, speed, now, processing_time=0.0, time_to_change=None):
+        """True if it is time to classify a frame; if so, call classified() once done
+
+        Args:
+            distance (float): metres to the stop line
+            speed (float): our speed in m/s
+            now (float): time in seconds
+            processing_time (float): expected time to classify a frame
+            time_to_change (float): seconds until the light may change, if predicted
+        """
+        if (self.last_classify_time is None or now < self.last_classify_time or
+                now - self.last_classify_time >= self.get_interval(distance, speed, processing_time,
+                                                                   time_to_change)):
+            return True
+        self.frames_skipped += 1
+        return False
+
+    def classified(self, now):
+        self.last_classify_time = now
+
+    def reset(self):
+        """Classify the next frame whatever, e.g. when approaching a new light"""
+        self.last_classify_time = None
+
+    def get_input_size(self, distance):
+        """Largest width, height to give the classifier at this distance"""
+        for min_distance, width, height in self.pyramid:
+            if distance >= min_distance:
+                return width, height
+        return self.pyramid[-1][1], self.pyramid[-1][2]
@@ -0,0 +1,603 @@
+###############################################################################
+#   Udacity self-driving car course : Capstone Project.
+#
+#   Team   : smart-carla
+#
+#   Runs the light classifier in a separate process, so that a long
+#   TensorFlow session run doesn't hold up the pose, waypoint and camera
+#   callbacks of tl_detector by sharing its Python interpreter (and GIL).
+#   The client copies each frame into a shared memory ring buffer (see
+#   styx/image_ring.py) and sends a small request naming the slot over a
+#   Unix domain socket; the server classifies the frame in place and
+#   replies with the state, per-class scores, detection box and timings.
+#
+#   Requests carry an id and a deadline, so several can be in flight at
+#   once: the server queues them for its worker threads (each with its own
+#   classifier) and skips any whose deadline has passed or whose frame has
+#   been overwritten. A client that gets no reply in time just treats the
+#   light as UNKNOWN. The server also answers health requests with its
+#   loading stage and request counts.
+#
+#   Messages: uint32 length, then that many bytes of JSON, in both directions.
+#   Needs neither ROS nor TensorFlow itself: the server is given a function
+#   that constructs the classifier (see classifier_server.py).
+###############################################################################
+
+import itertools
+import json
+import os
+import resource
+import socket
+import struct
+import sys
+import threading
+import time
+from six.moves import queue
+
+import numpy as np
+
+# Shared memory ring buffer, from the styx bridge package
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'styx'))
+from image_ring import ImageRingReader, ImageRingWriter, DEFAULT_RING_PATH
+
+LENGTH = struct.Struct('<I')
+UNKNOWN = 4 # TrafficLight.UNKNOWN, without needing styx_msgs here
+NUM_SCORE_STATES = 4 # len(SCORE_STATES)
+
+# Numbers each client's ring files, so that one replacing another in this
+# process (e.g. on a model swap) doesn't truncate or unlink the other's
+client_numbers = itertools.count(1)
+DEFAULT_TIMEOUT = 1.0 # seconds, until the server says how long it takes
+DEFAULT_SOCKET_PATH = DEFAULT_RING_PATH.replace('styx_image_color', 'tl_classifier.sock')
+
+def send_message(sock, message):
+    data = json.dumps(message).encode('utf-8')
+    sock.sendall(LENGTH.pack(len(data)) + data)
+
+def receive_exactly(sock, size):
+    chunks = []
+    while size:
+        chunk = sock.recv(size)
+        if not chunk:
+            raise EOFError("connection closed")
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+def receive_message(sock):
+    """Next message from the socket, waiting for it; raises EOFError once closed"""
+    length = LENGTH.unpack(receive_exactly(sock, LENGTH.size))[0]
+    return json.loads(receive_exactly(sock, length).decode('utf-8'))
+
+def peak_rss_mb():
+    """Peak resident memory of this process so far in MB (Linux)"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+def rss_mb():
+    """Resident memory of this process now in MB (Linux), or None if unknown"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize() / (1024.0 * 1024.0)
+    except (IOError, OSError, ValueError, IndexError):
+        return None
+
+class ClassifierServer(object):
+
+    def __init__(self, socket_path, classifier_factory, workers=1, max_queue=8):
+        """
+        Args:
+            socket_path (str): Unix domain socket to listen on
+            classifier_factory (function): called with a progress callback taking
+                                           a stage name, returns a classifier with
+                                           TLClassifier's get_classification()
+            workers (int): requests classified at once, each worker having its
+                           own classifier (and so its own copy of the model)
+            max_queue (int): requests waiting for a worker before new ones are
+                             turned away as busy
+        """
+        self.socket_path = socket_path
+        self.classifier_factory = classifier_factory
+        self.num_workers = workers
+        self.requests = queue.Queue(maxsize=max_queue)
+        self.rings = {} # ring file path -> ImageRingReader
+        self.rings_lock = threading.Lock()
+        self.stage = "starting"
+        self.start_time = time.time()
+        self.counts = {'requests': 0, 'completed': 0, 'expired': 0, 'overwritten': 0,
+                       'busy': 0, 'errors': 0}
+        # Also guards in_progress and mean_classification_time, which every worker updates
+        self.counts_lock = threading.Lock()
+        self.in_progress = 0
+        self.mean_classification_time = None
+        self.classifiers = [] # one per worker, once loaded
+        self.listener = None
+        self.running = False
+
+    def count(self, event):
+        with self.counts_lock:
+            self.counts[event] += 1
+
+    def set_stage(self, stage):
+        self.stage = stage
+        print("Classifier server: %s" % stage)
+
+    def serve_forever(self):
+        """Listens for clients, loading the classifiers meanwhile, until stop()"""
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path) # left by a previous server
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(self.socket_path)
+        self.listener.listen(4)
+        self.running = True
+
+        # Load in the background, so health requests are answered meanwhile
+        loader = threading.Thread(target=self.load_workers, name="tl_server_load")
+        loader.daemon = True
+        loader.start()
+
+        try:
+            while self.running:
+                try:
+                    connection, _ = self.listener.accept()
+                except socket.error:
+                    break # listener closed by stop()
+                reader = threading.Thread(target=self.connection_loop, args=(connection,),
+                                          name="tl_server_connection")
+                reader.daemon = True
+                reader.start()
+        finally:
+            self.stop()
+
+    def stop(self):
+        self.running = False
+        if self.listener is not None:
+            self.listener.close()
+            self.listener = None
+            if os.path.exists(self.socket_path):
+                os.unlink(self.socket_path)
+
+    def load_workers(self):
+        self.set_stage("loading")
+        try:
+            classifiers = [self.classifier_factory(self.set_stage) for _ in range(self.num_workers)]
+        except Exception as e:
+            self.set_stage("failed: %s" % repr(e))
+            return
+        # Until real requests come in, warm-up gives the best idea of how long
+        # classifying takes, which clients base their timeouts on
+        warm_up_latencies = [classifier.warm_up_latencies[-1] for classifier in classifiers
+                             if getattr(classifier, 'warm_up_latencies', None)]
+        if warm_up_latencies and self.mean_classification_time is None:
+            self.mean_classification_time = max(warm_up_latencies)
+        self.classifiers = classifiers
+        for i, classifier in enumerate(classifiers):
+            worker = threading.Thread(target=self.worker_loop, args=(classifier,),
+                                      name="tl_server_worker_%d" % i)
+            worker.daemon = True
+            worker.start()
+        self.set_stage("ready")
+
+    def connection_loop(self, connection):
+        """Reads requests from one client until it disconnects"""
+        send_lock = threading.Lock()
+        try:
+            while self.running:
+                request = receive_message(connection)
+                if request.get('type') == 'health':
+                    self.reply(connection, send_lock, {'id': request['id'], 'health': self.health()})
+                    continue
+                self.count('requests')
+                if self.stage != "ready":
+                    self.reply(connection, send_lock, {'id': request['id'], 'error': "not ready"})
+                    continue
+                try:
+                    self.requests.put_nowait((connection, send_lock, request))
+                except queue.Full:
+                    self.count('busy')
+                    self.reply(connection, send_lock, {'id': request['id'], 'error': "busy"})
+        except (EOFError, socket.error, ValueError):
+            pass
+        finally:
+            connection.close()
+
+    def reply(self, connection, send_lock, message):
+        try:
+            with send_lock:
+                send_message(connection, message)
+        except socket.error:
+            pass # client has gone; its reader will tidy up
+
+    def get_ring(self, path):
+        with self.rings_lock:
+            if path not in self.rings:
+                self.rings[path] = ImageRingReader(path)
+            return self.rings[path]
+
+    def worker_loop(self, classifier):
+        while self.running:
+            try:
+                connection, send_lock, request = self.requests.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            with self.counts_lock:
+                self.in_progress += 1
+            try:
+                self.reply(connection, send_lock, self.classify(classifier, request))
+            finally:
+                with self.counts_lock:
+                    self.in_progress -= 1
+
+    def classify(self, classifier, request):
+        """Classifies the frame a request refers to
+
+        Returns:
+            dict: reply, with 'state', 'scores', 'detection' and 'timings', or 'error'
+        """
+        request_id = request['id']
+        if time.time() > request['deadline']:
+            # Client has already given up waiting
+            self.count('expired')
+            return {'id': request_id, 'error': "expired"}
+        try:
+            ring = self.get_ring(request['ring'])
+            image = ring.view(request['slot'], request['sequence'], request['height'], request['width'])
+            if image is None:
+                self.count('overwritten')
+                return {'id': request_id, 'error': "overwritten"}
+            max_size = tuple(request['max_size']) if request.get('max_size') else None
+            tic = time.time()
+            state = classifier.get_classification(image, request.get('rgb', False), max_size)
+            classification_time = time.time() - tic
+            del image
+            if not ring.is_current(request['slot'], request['sequence']):
+                # Overwritten while we were classifying it, so can't be trusted
+                self.count('overwritten')
+                return {'id': request_id, 'error': "overwritten"}
+        except Exception as e:
+            self.count('errors')
+            return {'id': request_id, 'error': repr(e)}
+
+        with self.counts_lock:
+            if self.mean_classification_time is None:
+                self.mean_classification_time = classification_time
+            else:
+                self.mean_classification_time += 0.1 * (classification_time - self.mean_classification_time)
+            self.counts['completed'] += 1
+        detection = getattr(classifier, 'last_detection', None)
+        if detection is not None:
+            box, score = detection
+            detection = [[float(value) for value in box], float(score)]
+        scores = getattr(classifier, 'last_scores', None)
+        return {'id': request_id,
+                'state': int(state),
+                'scores': [float(score) for score in scores] if scores is not None else None,
+                'detection': detection,
+                'timings': dict(getattr(classifier, 'last_timings', {})),
+                'classification_time': classification_time}
+
+    def health(self):
+        with self.counts_lock:
+            health = dict(self.counts)
+            in_progress = self.in_progress
+            mean_classification_time = self.mean_classification_time
+        health.update({'stage': self.stage,
+                       'ready': self.stage == "ready",
+                       'pid': os.getpid(),
+                       'uptime': time.time() - self.start_time,
+                       'workers': self.num_workers,
+                       'queue_depth': self.requests.qsize(),
+                       'in_progress': in_progress,
+                       'mean_classification_time': mean_classification_time,
+                       'peak_rss_mb': peak_rss_mb(),
+                       'rss_mb': rss_mb()})
+        cascade_stats = [classifier.get_cascade_stats() for classifier in self.classifiers
+                         if getattr(classifier, 'classifier', None) == "CASCADE"]
+        if cascade_stats:
+            health['cascade'] = cascade_stats # per worker
+        return health
+
+class ClassifierClient(object):
+    """Stands in for TLClassifier in the node, passing frames to a
+       ClassifierServer; get_classification() gives UNKNOWN if no reply comes
+       within the timeout, or the server can't be reached"""
+
+    def __init__(self, socket_path=DEFAULT_SOCKET_PATH, timeout=None, max_in_flight=4,
+                 ring_path=None, reconnect_interval=1.0, server_process=None):
+        """
+        Args:
+            socket_path (str): Unix domain socket the server listens on
+            timeout (float): seconds to wait for a classification; if None (or
+                             0), set by wait_until_ready() from how long the
+                             server takes, see fit_timeout()
+            max_in_flight (int): requests outstanding at once; frames are kept in
+                                 a ring with a slot more than this
+            ring_path (str): start of shared memory ring file names (default
+                             unique to this client)
+            reconnect_interval (float): seconds between attempts to reach the server
+            server_process (subprocess.Popen): server started for this client,
+                                               stopped by close()
+        """
+        self.socket_path = socket_path
+        self.timeout = timeout or DEFAULT_TIMEOUT
+        self.fit_timeout_to_server = not timeout
+        self.max_in_flight = max_in_flight
+        self.reconnect_interval = reconnect_interval
+        self.server_process = server_process
+        self.ring = ImageRingWriter(ring_path or "%s_client_%d_%d" % (DEFAULT_RING_PATH, os.getpid(),
+                                                                       next(client_numbers)),
+                                    num_slots=max_in_flight + 1)
+        self.ring_lock = threading.Lock()
+        self.sock = None
+        self.send_lock = threading.Lock()
+        self.pending = {} # request id -> [threading.Event, reply]
+        self.pending_lock = threading.Lock()
+        self.in_flight = threading.Semaphore(max_in_flight)
+        self.next_id = 0
+        self.last_connect_attempt = None
+        self.last_health = None
+        self.counts = {'requests': 0, 'timeouts': 0, 'errors': 0, 'disconnected': 0}
+
+        # Same results as TLClassifier leaves after get_classification()
+        self.last_detection = None
+        self.last_scores = None
+        self.last_timings = {}
+
+    def connect(self):
+        """Connects to the server if not already, at most every reconnect_interval
+
+        Returns:
+            bool: True if connected
+        """
+        if self.sock is not None:
+            return True
+        now = time.time()
+        if self.last_connect_attempt is not None and now - self.last_connect_attempt < self.reconnect_interval:
+            return False
+        self.last_connect_attempt = now
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.socket_path)
+        except socket.error:
+            sock.close()
+            return False
+        self.sock = sock
+        reader = threading.Thread(target=self.receive_loop, args=(sock,), name="tl_client_receive")
+        reader.daemon = True
+        reader.start()
+        return True
+
+    def close(self):
+        self.disconnect(self.sock)
+        self.ring.close()
+        if self.server_process is not None and self.server_process.poll() is None:
+            self.server_process.terminate()
+            self.server_process.wait()
+
+    def disconnect(self, sock):
+        if sock is None:
+            return
+        with self.send_lock:
+            if self.sock is sock:
+                self.sock = None
+        sock.close()
+        # Nothing more will come for anything outstanding
+        with self.pending_lock:
+            for entry in self.pending.values():
+                entry[1] = {'error': "disconnected"}
+                entry[0].set()
+
+    def receive_loop(self, sock):
+        try:
+            while True:
+                reply = receive_message(sock)
+                if 'health' in reply:
+                    self.last_health = reply['health']
+                with self.pending_lock:
+                    entry = self.pending.get(reply['id'])
+                if entry is not None: # else we gave up waiting for it
+                    entry[1] = reply
+                    entry[0].set()
+        except (EOFError, socket.error, ValueError):
+            self.disconnect(sock)
+
+    def send(self, message):
+        """Sends a request, giving its id, or None if the server can't be reached"""
+        if not self.connect():
+            return None
+        with self.send_lock:
+            sock = self.sock
+            if sock is None:
+                return None
+            self.next_id += 1
+            message['id'] = self.next_id
+            with self.pending_lock:
+                self.pending[message['id']] = [threading.Event(), None]
+            try:
+                send_message(sock, message)
+            except socket.error:
+                sock = None
+        if sock is None:
+            self.disconnect(self.sock)
+            self.forget(message['id'])
+            return None
+        return message['id']
+
+    def forget(self, request_id):
+        with self.pending_lock:
+            entry = self.pending.pop(request_id, None)
+        return entry[1] if entry else None
+
+    def submit(self, image, rgb=False, max_size=None):
+        """Starts classifying a frame without waiting for the result; waits for
+           a free slot if max_in_flight requests are already outstanding
+
+        Args:
+            image (ndarray): height x width x 3 uint8 image, BGR unless rgb
+            rgb (bool): True if image is RGB rather than OpenCV's usual BGR
+            max_size ((int, int)): as for TLClassifier.get_classification()
+
+        Returns:
+            (int, float): request id (None if the server can't be reached) and
+                          time the result is due by
+        """
+        deadline = time.time() + self.timeout
+        if not self.in_flight.acquire(False):
+            # Python 2 semaphores can't time out, so poll for a free slot
+            while not self.in_flight.acquire(False):
+                if time.time() > deadline:
+                    return None, deadline
+                time.sleep(0.001)
+        self.counts['requests'] += 1
+        with self.ring_lock:
+            ring_file, slot, sequence = self.ring.write(image)
+        request_id = self.send({'type': 'classify', 'ring': ring_file, 'slot': slot,
+                                'sequence': sequence, 'height': image.shape[0],
+                                'width': image.shape[1], 'rgb': bool(rgb),
+                                'max_size': list(max_size) if max_size else None,
+                                'deadline': deadline})
+        if request_id is None:
+            self.in_flight.release()
+            self.counts['disconnected'] += 1
+        return request_id, deadline
+
+    def result(self, request_id, deadline):
+        """Waits until the deadline for the reply to a submit()
+
+        Returns:
+            dict: reply from server; on failure just {'error': reason}
+        """
+        if request_id is None:
+            return {'error': "not connected"}
+        try:
+            with self.pending_lock:
+                event = self.pending[request_id][0]
+            event.wait(max(0.0, deadline - time.time()))
+            reply = self.forget(request_id)
+        finally:
+            self.in_flight.release()
+        if reply is None:
+            self.counts['timeouts'] += 1
+            return {'error': "timeout"}
+        if 'error' in reply:
+            self.counts['errors'] += 1
+        return reply
+
+    def unpack(self, reply, round_trip):
+        """State from a reply, setting last_scores etc. as TLClassifier would"""
+        if 'error' in reply:
+            self.last_detection = None
+            # No evidence either way, so the state filter carries on with what
+            # it already believes rather than being told the light is UNKNOWN
+            self.last_scores = [1.0 / NUM_SCORE_STATES] * NUM_SCORE_STATES
+            self.last_timings = {}
+            return UNKNOWN
+        detection = reply.get('detection')
+        self.last_detection = (tuple(detection[0]), detection[1]) if detection else None
+        self.last_scores = reply.get('scores')
+        self.last_timings = reply.get('timings', {})
+        # Everything beyond the server's own time on it: copying into shared
+        # memory, messages, queueing and waking up
+        self.last_timings['ipc'] = round_trip - reply['classification_time']
+        return reply['state']
+
+    def get_classification(self, image, rgb=False, max_size=None):
+        """Classifies the frame in the server, as TLClassifier.get_classification()
+
+        Returns:
+            int: ID of traffic light color, UNKNOWN if no reply in time
+        """
+        tic = time.time()
+        request_id, deadline = self.submit(image, rgb, max_size)
+        reply = self.result(request_id, deadline)
+        return self.unpack(reply, time.time() - tic)
+
+    def get_classification_batch(self, images, rgb=False, rois=None):
+        """Classifies several images (or regions of one) as separate requests
+           all in flight together, so the server's workers share them out
+
+        Returns:
+            list: ID of traffic light color for each image or region
+            list: probability of each of SCORE_STATES for each (None where unknown)
+        """
+        if rois is not None:
+            if isinstance(images, np.ndarray):
+                images = [images] * len(rois)
+            images = [image[y0:y1, x0:x1] for image, (x0, y0, x1, y1) in zip(images, rois)]
+        tic = time.time()
+        states, class_scores, self.last_detections = [], [], []
+        for start in range(0, len(images), self.max_in_flight):
+            submitted = [self.submit(image, rgb) for image in images[start:start + self.max_in_flight]]
+            for request_id, deadline in submitted:
+                states.append(self.unpack(self.result(request_id, deadline), time.time() - tic))
+                class_scores.append(self.last_scores)
+                self.last_detections.append(self.last_detection)
+        return states, class_scores
+
+    def request_health(self):
+        """Asks the server how it is; the answer turns up in last_health"""
+        request_id = self.send({'type': 'health'})
+        if request_id is not None:
+            # Nobody waits on it; the receive thread stores it anyway
+            self.forget(request_id)
+
+    def get_health(self, timeout=1.0):
+        """Asks the server how it is and waits for the answer
+
+        Returns:
+            dict: server health (see ClassifierServer.health()), or None if no answer
+        """
+        request_id = self.send({'type': 'health'})
+        if request_id is None:
+            return None
+        with self.pending_lock:
+            event = self.pending[request_id][0]
+        event.wait(timeout)
+        reply = self.forget(request_id)
+        return reply.get('health') if reply else None
+
+    def wait_until_ready(self, timeout, progress_cb=None, poll_interval=0.5):
+        """Waits for the server to be up and have loaded its classifiers
+
+        Args:
+            timeout (float): seconds to give up after
+            progress_cb (function): called with the server's loading stage when it changes
+
+        Returns:
+            bool: True if ready
+        """
+        give_up = time.time() + timeout
+        stage = None
+        while time.time() < give_up:
+            health = self.get_health()
+            if health is not None:
+                if health['stage'] != stage:
+                    stage = health['stage']
+                    if progress_cb:
+                        progress_cb(stage)
+                if health['ready']:
+                    if self.fit_timeout_to_server:
+                        self.fit_timeout(health)
+                    return True
+                if stage.startswith("failed"):
+                    return False
+            time.sleep(poll_interval)
+        return False
+
+    def fit_timeout(self, health, factor=2.0, margin=0.5):
+        """Sets the timeout from the server's mean classification time, allowing
+           for requests queued behind others when more are in flight than it has
+           workers, so that a slow model doesn't turn every result into a timeout
+
+        Args:
+            health (dict): from get_health()
+            factor (float): multiple of the expected wait to allow...
+            margin (float): ...plus this many seconds
+
+        Returns:
+            float: the new timeout in seconds
+        """
+        mean_classification_time = health.get('mean_classification_time')
+        if mean_classification_time:
+            queued = -(-self.max_in_flight // max(1, health.get('workers', 1))) # rounded up
+            self.timeout = factor * queued * mean_classification_time + margin
+        return self.timeout
@@ -0,0 +1,114 @@
+###############################################################################
+#   Udacity self-driving car course : Capstone Project.
+#
+#   Team   : smart-carla
+#
+#   Lightweight traffic light classifier using only OpenCV colour-space
+#   analysis, for machines without a GPU where the neural network
+#   classifiers can't keep up with the camera. Takes a few milliseconds per
+#   frame on one CPU core, at some cost in accuracy.
+#
+#   Method: shrink frame, threshold lit-lamp colours in HSV, find round
+#   blobs of each colour, and vote for each blob weighted by its area and by
+#   whether the housing is dark where the other lamps should be (above a green
+#   lamp, below a red one, either side of a yellow one).
+###############################################################################
+
+import cv2
+import numpy as np
+
+from styx_msgs.msg import TrafficLight
+
+# Working width in pixels; frames are shrunk to this first to keep it cheap
+WORK_WIDTH = 400
+
+# HSV ranges (OpenCV hue is 0..179) of lit lamps. Red wraps round hue zero.
+MIN_SATURATION = 100
+MIN_VALUE = 150
+HUE_RANGES = {TrafficLight.RED:    [(0, 10), (160, 179)],
+              TrafficLight.YELLOW: [(15, 35)],
+              TrafficLight.GREEN:  [(45, 95)]}
+
+MIN_BLOB_AREA = 12       # pixels at working resolution
+MAX_BLOB_ASPECT = 2.0    # lamps are round, so reject long thin blobs
+MIN_BLOB_FILL = 0.4      # blob area / bounding box area
+DARK_HOUSING_VALUE = 90  # mean V below this counts as unlit housing
+HOUSING_VOTE_WEIGHT = 2.0
+MIN_VOTE_SCORE = 30.0    # total weighted area needed to report a colour
+
+class ColourClassifier(object):
+
+    def __init__(self):
+        self.kernel = np.ones((3, 3), np.uint8)
+
+    def colour_mask(self, hsv, hue_ranges):
+        """Binary mask of bright saturated pixels in any of the hue ranges"""
+        mask = None
+        for low, high in hue_ranges:
+            range_mask = cv2.inRange(hsv, (low, MIN_SATURATION, MIN_VALUE), (high, 255, 255))
+            mask = range_mask if mask is None else cv2.bitwise_or(mask, range_mask)
+        # Remove speckle noise
+        return cv2.morphologyEx(mask, cv2.MORPH_OPEN, self.kernel)
+
+    def housing_is_dark(self, value, x, y, w, h, dy):
+        """Whether the region one lamp spacing (dy blob heights) above/below is dark"""
+        y0 = y + dy * h
+        if y0 < 0 or y0 + h > value.shape[0]:
+            return False
+        return np.mean(value[y0:y0 + h, x:x + w]) < DARK_HOUSING_VALUE
+
+    def vote(self, state, hsv, mask):
+        """Weighted vote for one colour from the lamp-like blobs in its mask"""
+        value = hsv[:, :, 2]
+        score = 0.0
+        # [-2] picks contours whichever OpenCV version's return signature we have
+        contours = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)[-2]
+        for contour in contours:
+            area = cv2.contourArea(contour)
+            if area < MIN_BLOB_AREA:
+                continue
+            x, y, w, h = cv2.boundingRect(contour)
+            if max(w, h) > MAX_BLOB_ASPECT * min(w, h) or area < MIN_BLOB_FILL * w * h:
+                continue
+
+            # Vertical position voting: other lamps of the housing should be dark
+            if state == TrafficLight.RED:
+                dark = self.housing_is_dark(value, x, y, w, h, 1)
+            elif state == TrafficLight.GREEN:
+                dark = self.housing_is_dark(value, x, y, w, h, -1)
+            else:
+                dark = (self.housing_is_dark(value, x, y, w, h, -1) and
+                        self.housing_is_dark(value, x, y, w, h, 1))
+            score += area * (HOUSING_VOTE_WEIGHT if dark else 1.0)
+        return score
+
+    def get_classification_with_score(self, image):
+        """Determines the color of the traffic light in the image
+
+        Args:
+            image (cv::Mat): BGR image containing the traffic light
+
+        Returns:
+            int: ID of traffic light color (specified in styx_msgs/TrafficLight)
+            float: confidence 0..1, i.e. winning colour's share of all votes
+
+        """
+        if image.shape[1] > WORK_WIDTH:
+            scale = float(WORK_WIDTH) / image.shape[1]
+            image = cv2.resize(image, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        hsv = cv2.cvtColor(image, cv2.COLOR_BGR2HSV)
+
+        scores = {}
+        for state, hue_ranges in HUE_RANGES.items():
+            scores[state] = self.vote(state, hsv, self.colour_mask(hsv, hue_ranges))
+
+        best_state = max(scores, key=scores.get)
+        total_score = sum(scores.values())
+        if scores[best_state] < MIN_VOTE_SCORE:
+            # No convincing lit lamp; confident in that only if there's hardly any colour at all
+            return TrafficLight.UNKNOWN, 1.0 - min(1.0, total_score / MIN_VOTE_SCORE)
+        return best_state, scores[best_state] / total_score
+
+    def get_classification(self, image):
+        state, _ = self.get_classification_with_score(image)
+        return state
@@ -0,0 +1,55 @@
+###############################################################################
+#   Udacity self-driving car course : Capstone Project.
+#
+#   Team   : smart-carla
+#
+#   Finds the labelled traffic light images saved in the data/ folders, so
+#   that offline tools can evaluate classifiers against them. Files follow
+#   the [sim|real]_index_state.jpg naming convention, where state is the
+#   styx_msgs/TrafficLight enumeration (0=RED, 1=YELLOW, 2=GREEN, 4=UNKNOWN).
+###############################################################################
+
+import os
+import sys
+from glob import glob
+
+# Relative to this file, i.e. <repo>/data
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', '..', '..', 'data')
+
+# Full-frame folders (the cropped_roughly folder is deliberately left out as
+# the runtime classifiers see whole camera frames)
+LABELLED_IMAGE_DIRS = ['training_images',
+                       'training_images2',
+                       'training_images3/green',
+                       'training_images3/yellow',
+                       'training_images3/red',
+                       'training_images3/unknown',
+                       'yellowLight']
+
+def light_state_from_filename(image_file):
+    """Gets 0,1,2,4 light state from end of filename like real_1980_4.jpg"""
+    filename_wo_ext = os.path.splitext(os.path.basename(image_file))[0]
+    filename_parts = filename_wo_ext.split('_')
+    if len(filename_parts) != 3:
+        raise ValueError("image filename not like real_1980_4: %s" % image_file)
+    return int(filename_parts[2])
+
+def find_labelled_images(img_type="both", image_dirs=None):
+    """Returns sorted list of (path, state) for labelled images
+
+    Args:
+        img_type (str): "sim", "real" or "both"
+        image_dirs (list): folders to search, default all under data/
+    """
+    if image_dirs is None:
+        image_dirs = [os.path.join(DATA_DIR, d) for d in LABELLED_IMAGE_DIRS]
+    wildcard = "*.jpg" if img_type == "both" else img_type + "_*.jpg"
+
+    labelled_images = []
+    for image_dir in image_dirs:
+        for image_file in sorted(glob(os.path.join(image_dir, wildcard))):
+            try:
+                labelled_images.append((image_file, light_state_from_filename(image_file)))
+            except ValueError as e:
+                sys.stderr.write("Warning: skipping %s\n" % str(e))
+    return labelled_images
@@ -0,0 +1,66 @@
+###############################################################################
+#   Udacity self-driving car course : Capstone Project.
+#
+#   Team   : smart-carla
+#
+#   Low-overhead latency instrumentation: each stage of frame processing
+#   just appends its duration to a bounded rolling window (cheap enough to do
+#   on every frame), and percentiles are only worked out when a summary is
+#   asked for, e.g. once a second for the diagnostics topic.
+###############################################################################
+
+import threading
+from collections import deque
+
+import numpy as np
+
+class LatencyStats(object):
+
+    def __init__(self, window=200):
+        """
+        Args:
+            window (int): number of most recent samples kept for each stage
+        """
+        self.window = window
+        self.samples = {}   # stage name -> deque of durations in seconds
+        self.counters = {}  # event name -> count since start
+        # Recorded from the camera callback and inference threads, summarised
+        # from a timer thread
+        self.lock = threading.Lock()
+
+    def record(self, stage, seconds):
+        """Adds one duration for the given stage"""
+        with self.lock:
+            if stage not in self.samples:
+                self.samples[stage] = deque(maxlen=self.window)
+            self.samples[stage].append(seconds)
+
+    def record_all(self, timings):
+        """Adds a duration for each stage in a dict of stage name -> seconds"""
+        for stage, seconds in timings.items():
+            self.record(stage, seconds)
+
+    def count(self, event, n=1):
+        """Adds to the count of some event, e.g. frames dropped"""
+        with self.lock:
+            self.counters[event] = self.counters.get(event, 0) + n
+
+    def summary(self):
+        """Percentiles of each stage over its window, and the event counts
+
+        Returns:
+            dict: {'stages': {stage: {'p50', 'p95', 'p99', 'max' (seconds), 'samples'}},
+                   'counts': {event: count}}
+        """
+        with self.lock:
+            samples = dict((stage, list(values)) for stage, values in self.samples.items())
+            counters = dict(self.counters)
+
+        stages = {}
+        for stage, values in samples.items():
+            if not values:
+                continue
+            p50, p95, p99 = np.percentile(values, [50, 95, 99])
+            stages[stage] = {'p50': float(p50), 'p95': float(p95), 'p99': float(p99),
+                             'max': float(max(values)), 'samples': len(values)}
+        return {'stages': stages, 'counts': counters}
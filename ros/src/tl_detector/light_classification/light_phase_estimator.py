@@ -0,0 +1,147 @@
+###############################################################################
+#   Udacity self-driving car course : Capstone Project.
+#
+#   Team   : smart-carla
+#
+#   Learns how long each traffic light stays in each state, per intersection
+#   (keyed on its stop_line_positions index), from the changes of state we
+#   observe, and predicts from that how long it will be until the light we
+#   are looking at next changes. ClassificationScheduler uses the prediction
+#   to look at the light only occasionally while no change is due, and at
+#   its usual rate around when one is.
+#
+#   A duration is only learnt when both the change into a state and the
+#   change out of it were seen, with no long gap in observations between
+#   them. Both ends are noticed with about the same delay, so that delay
+#   cancels out. The learnt durations (not the current phase, as times
+#   don't carry over between runs) are saved to disk so that the next run
+#   starts with them.
+###############################################################################
+
+import json
+import os
+
+UNKNOWN = 4 # TrafficLight.UNKNOWN, not a phase of the light
+
+class LightPhaseEstimator(object):
+
+    def __init__(self, margin=1.0, deviations=3.0, max_gap=3.0, min_observations=2,
+                 smoothing=0.3):
+        """
+        Args:
+            margin (float): seconds before a predicted change to go back to
+                            looking at the usual rate
+            deviations (float): ...plus this many mean absolute deviations of
+                                the learnt duration
+            max_gap (float): seconds without an observation after which we no
+                             longer know when the current state started
+            min_observations (int): times a duration must have been seen before
+                                    it is used for prediction
+            smoothing (float): weight of each new duration in the moving averages
+        """
+        self.margin = margin
+        self.deviations = deviations
+        self.max_gap = max_gap
+        self.min_observations = min_observations
+        self.smoothing = smoothing
+        self.durations = {} # light index -> {state: [mean, mean absolute deviation, count]}
+        self.phases = {}    # light index -> [state, start time or None, last seen time]
+
+    def observe(self, light_idx, state, now):
+        """Records the state we believe a light is in now
+
+        Args:
+            light_idx (int): stop_line_positions index of the light
+            state (int): TrafficLight state
+            now (float): time in seconds
+
+        Returns:
+            bool: True if a duration was learnt, i.e. worth saving
+        """
+        if state == UNKNOWN:
+            return False
+        phase = self.phases.get(light_idx)
+        if phase is None or now - phase[2] > self.max_gap or now < phase[2]:
+            # Don't know when this state started
+            self.phases[light_idx] = [state, None, now]
+            return False
+        previous_state, start, _ = phase
+        phase[2] = now
+        if state == previous_state:
+            return False
+        learnt = False
+        if start is not None:
+            self.learn(light_idx, previous_state, now - start)
+            learnt = True
+        phase[0] = state
+        phase[1] = now
+        return learnt
+
+    def learn(self, light_idx, state, duration):
+        light_durations = self.durations.setdefault(light_idx, {})
+        if state not in light_durations:
+            light_durations[state] = [duration, 0.0, 1]
+            return
+        stats = light_durations[state]
+        stats[1] += self.smoothing * (abs(duration - stats[0]) - stats[1])
+        stats[0] += self.smoothing * (duration - stats[0])
+        stats[2] += 1
+
+    def time_to_change(self, light_idx, now):
+        """Seconds until we should be looking closely for the light to change,
+           allowing for the margin and how much its durations vary
+
+        Returns:
+            float: seconds, 0 or less if a change is due, or None if unknown
+        """
+        phase = self.phases.get(light_idx)
+        if phase is None or phase[1] is None or now - phase[2] > self.max_gap:
+            return None
+        stats = self.durations.get(light_idx, {}).get(phase[0])
+        if stats is None or stats[2] < self.min_observations:
+            return None
+        mean, deviation, _ = stats
+        return mean - (now - phase[1]) - self.margin - self.deviations * deviation
+
+    def get_saved_state(self):
+        """Copy of the learnt durations as save() writes them, so that another
+           thread can write it out while we carry on learning"""
+        data = dict((str(light_idx), dict((str(state), list(stats)) for state, stats in light_durations.items()))
+                    for light_idx, light_durations in self.durations.items())
+        return {'durations': data}
+
+    def save(self, filename, saved_state=None):
+        """Writes the learnt durations to a JSON file (replacing it atomically)
+
+        Args:
+            filename (str): file to write
+            saved_state (dict): from get_saved_state(), if taken earlier
+        """
+        if saved_state is None:
+            saved_state = self.get_saved_state()
+        temp_filename = filename + ".tmp"
+        with open(temp_filename, 'w') as f:
+            json.dump(saved_state, f, indent=2, sort_keys=True)
+        os.rename(temp_filename, filename)
+
+    def load(self, filename):
+        """Reads durations written by save(); counts are kept, so they are
+           trusted straight away
+
+        Returns:
+            bool: False if there was no file
+        """
+        if not os.path.isfile(filename):
+            return False
+        with open(filename) as f:
+            data = json.load(f)
+        self.durations = dict((int(light_idx), dict((int(state), list(stats))
+                                                    for state, stats in light_durations.items()))
+                              for light_idx, light_durations in data['durations'].items())
+        return True
+
+    def summary(self):
+        """Learnt mean duration of each state of each light, for diagnostics"""
+        return dict((str(light_idx), dict((str(state), round(stats[0], 2))
+                                          for state, stats in light_durations.items()))
+                    for light_idx, light_durations in self.durations.items())
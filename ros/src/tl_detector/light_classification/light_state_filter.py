@@ -0,0 +1,97 @@
+###############################################################################
+#   Udacity self-driving car course : Capstone Project.
+#
+#   Team   : smart-carla
+#
+#   Recursive Bayesian (hidden Markov model) filter over the state of the
+#   light we are approaching. Each classification updates the probability of
+#   red, yellow, green and unknown using the classifier's scores, and between
+#   classifications the probabilities drift according to how lights change
+#   (green -> yellow -> red -> green). A state is only reported once its
+#   probability passes a confidence level, which replaces waiting for a fixed
+#   number of identical classifications in a row: one confident red is
+#   enough, while noisy ones take a few frames.
+###############################################################################
+
+import math
+
+from styx_msgs.msg import TrafficLight
+
+# Order of states in probability vectors (same as TLClassifier.last_scores)
+FILTER_STATES = [TrafficLight.RED, TrafficLight.YELLOW, TrafficLight.GREEN, TrafficLight.UNKNOWN]
+
+# Which state each one normally changes to
+NEXT_STATE = {TrafficLight.RED: TrafficLight.GREEN,
+              TrafficLight.YELLOW: TrafficLight.RED,
+              TrafficLight.GREEN: TrafficLight.YELLOW}
+
+class LightStateFilter(object):
+
+    def __init__(self, confidence=0.8, classifier_noise=0.1, red_duration=10.0,
+                 yellow_duration=3.0, green_duration=10.0, unknown_duration=5.0,
+                 out_of_sequence=0.1):
+        """
+        Args:
+            confidence (float): probability a state must reach to be reported
+            classifier_noise (float): share of each classification treated as
+                                      uninformative, so no single frame is certain
+            red_duration, yellow_duration, green_duration, unknown_duration (float):
+                mean seconds a light stays in each state
+            out_of_sequence (float): share of state changes that are not to the
+                                     next state in the cycle (or are to/from unknown)
+        """
+        self.confidence = confidence
+        self.classifier_noise = classifier_noise
+        self.durations = {TrafficLight.RED: red_duration,
+                          TrafficLight.YELLOW: yellow_duration,
+                          TrafficLight.GREEN: green_duration,
+                          TrafficLight.UNKNOWN: unknown_duration}
+        self.out_of_sequence = out_of_sequence
+        self.reset()
+
+    def reset(self):
+        """Back to knowing nothing, e.g. when approaching a different light"""
+        self.probabilities = [1.0 / len(FILTER_STATES)] * len(FILTER_STATES)
+        self.decided_state = None
+
+    def predict(self, dt):
+        """Lets probabilities drift by how the light may have changed in dt seconds"""
+        n = len(FILTER_STATES)
+        predicted = [0.0] * n
+        for i, state in enumerate(FILTER_STATES):
+            p_change = 1.0 - math.exp(-dt / self.durations[state])
+            predicted[i] += self.probabilities[i] * (1.0 - p_change)
+            # Share out the changes between the usual next state and the rest
+            if state in NEXT_STATE:
+                usual = FILTER_STATES.index(NEXT_STATE[state])
+                predicted[usual] += self.probabilities[i] * p_change * (1.0 - self.out_of_sequence)
+                others = [j for j in range(n) if j != i and j != usual]
+                for j in others:
+                    predicted[j] += self.probabilities[i] * p_change * self.out_of_sequence / len(others)
+            else:
+                for j in range(n):
+                    if j != i:
+                        predicted[j] += self.probabilities[i] * p_change / (n - 1)
+        self.probabilities = predicted
+
+    def update(self, scores, dt):
+        """Incorporates one classification
+
+        Args:
+            scores (list): classifier probability of each of FILTER_STATES
+            dt (float): seconds since last update
+
+        Returns:
+            int: state to act on, or None if still not confident of any
+        """
+        self.predict(max(dt, 0.0))
+        n = len(FILTER_STATES)
+        posterior = [p * ((1.0 - self.classifier_noise) * score + self.classifier_noise / n)
+                     for p, score in zip(self.probabilities, scores)]
+        total = sum(posterior)
+        self.probabilities = [p / total for p in posterior]
+
+        best = max(range(n), key=lambda i: self.probabilities[i])
+        if self.probabilities[best] >= self.confidence:
+            self.decided_state = FILTER_STATES[best]
+        return self.decided_state
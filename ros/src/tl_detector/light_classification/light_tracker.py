@@ -0,0 +1,113 @@
+###############################################################################
+#   Udacity self-driving car course : Capstone Project.
+#
+#   Team   : smart-carla
+#
+#   Tracking by detection: remembers where the last confident detection of
+#   the light was in the image, predicts where it has moved to from our own
+#   motion since, and gives a small region of interest to classify instead
+#   of the whole frame. A full-frame detection is forced every so often, or
+#   as soon as a crop doesn't give a confident detection.
+###############################################################################
+
+import math
+
+class LightTracker(object):
+
+    def __init__(self, redetect_interval=10, min_score=0.7, margin_factor=2.0,
+                 margin_per_mps=0.1, min_size=48, focal_length_x=None):
+        """
+        Args:
+            redetect_interval (int): classify full frame at least this often
+            min_score (float): detection score needed to keep tracking
+            margin_factor (float): crop size as multiple of predicted box size...
+            margin_per_mps (float): ...plus this much per m/s of our speed
+            min_size (int): minimum crop width and height in pixels
+            focal_length_x (float): camera focal length in pixels if known, used
+                                    to shift the box when we turn
+        """
+        self.redetect_interval = redetect_interval
+        self.min_score = min_score
+        self.margin_factor = margin_factor
+        self.margin_per_mps = margin_per_mps
+        self.min_size = min_size
+        self.focal_length_x = focal_length_x
+        self.reset()
+
+    def reset(self):
+        """Forget the tracked light, so the next frame is classified in full"""
+        self.box = None                # x0, y0, x1, y1 pixels in full image
+        self.light_id = None
+        self.distance = None           # to light when box was detected
+        self.yaw = None                # our heading when box was detected
+        self.frames_since_detection = 0
+
+    def predict_roi(self, light_id, image_width, image_height, distance, yaw, speed):
+        """Region to classify this frame, or None if a full-frame detection is due
+
+        Args:
+            light_id: identifies which light we are approaching
+            image_width, image_height (int): size of full camera image
+            distance (float): current distance to light in metres, or None if unknown
+            yaw (float): our current heading in radians
+            speed (float): our current speed in m/s
+
+        Returns:
+            (int, int, int, int): x0, y0, x1, y1 pixel box to crop, or None
+        """
+        if (self.box is None or light_id != self.light_id or
+                self.frames_since_detection >= self.redetect_interval):
+            return None
+        self.frames_since_detection += 1
+
+        x0, y0, x1, y1 = self.box
+        centre_u, centre_v = (x0 + x1) / 2.0, (y0 + y1) / 2.0
+
+        # Driving towards the light, it grows and moves out from the image centre
+        # (focus of expansion) in proportion to how much closer we are
+        if distance and self.distance:
+            scale = self.distance / max(distance, 1.0)
+        else:
+            scale = 1.0
+        centre_u = image_width / 2.0 + (centre_u - image_width / 2.0) * scale
+        centre_v = image_height / 2.0 + (centre_v - image_height / 2.0) * scale
+
+        # Turning left moves everything right in the image, and vice versa
+        if self.focal_length_x and self.yaw is not None:
+            delta_yaw = math.atan2(math.sin(yaw - self.yaw), math.cos(yaw - self.yaw))
+            centre_u += self.focal_length_x * math.tan(delta_yaw)
+
+        margin = self.margin_factor + self.margin_per_mps * speed
+        half_width = max(self.min_size, (x1 - x0) * scale * margin) / 2.0
+        half_height = max(self.min_size, (y1 - y0) * scale * margin) / 2.0
+
+        roi = (int(max(0, centre_u - half_width)), int(max(0, centre_v - half_height)),
+               int(min(image_width, centre_u + half_width)), int(min(image_height, centre_v + half_height)))
+        if roi[2] - roi[0] < self.min_size / 2 or roi[3] - roi[1] < self.min_size / 2:
+            # Predicted to have mostly left the image
+            return None
+        return roi
+
+    def update(self, light_id, box, score, distance, yaw):
+        """Records the result of the latest classification
+
+        Args:
+            light_id: identifies which light we are approaching
+            box ((int, int, int, int)): x0, y0, x1, y1 of detection in full image
+                                        pixels, or None if detector gave no box
+            score (float): detection score
+            distance (float): current distance to light, or None if unknown
+            yaw (float): our current heading in radians
+        """
+        if box is None or score < self.min_score:
+            # Lost it, so look at the whole frame next time
+            self.reset()
+            return
+        self.box = box
+        self.light_id = light_id
+        self.distance = distance
+        self.yaw = yaw
+
+    def full_frame_classified(self):
+        """Resets the count towards the next forced full-frame detection"""
+        self.frames_since_detection = 0
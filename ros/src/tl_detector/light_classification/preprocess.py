@@ -0,0 +1,132 @@
+###############################################################################
+#   Udacity self-driving car course : Capstone Project.
+#
+#   Team   : smart-carla
+#
+#   Prepares camera frames as network input with as little copying as
+#   possible: the ROS image buffer is viewed in place rather than converted,
+#   the BGR->RGB swap is a single OpenCV copy, and the result goes into a
+#   preallocated NHWC uint8 batch array. Shrinking is still done by PIL, as
+#   the networks were always fed, so their input is unchanged (OpenCV's
+#   resamplers differ by up to 50 grey levels).
+###############################################################################
+
+import time
+
+import cv2
+import numpy as np
+from PIL import Image
+
+# Same filter; the old name is gone from recent Pillow
+ANTIALIAS = getattr(Image, 'LANCZOS', None) or Image.ANTIALIAS
+
+def image_from_msg(msg):
+    """View the pixels of a sensor_msgs/Image without copying them
+
+    Args:
+        msg (Image): rgb8 or bgr8 camera image
+
+    Returns:
+        (ndarray, bool): height x width x 3 uint8 view, and True if it's RGB
+    """
+    if msg.encoding not in ("rgb8", "bgr8"):
+        raise ValueError("unsupported image encoding %s" % msg.encoding)
+    rows = np.frombuffer(msg.data, dtype=np.uint8).reshape(msg.height, msg.step)
+    image = rows[:, :msg.width * 3].reshape(msg.height, msg.width, 3)
+    return image, msg.encoding == "rgb8"
+
+def shrink_like_pil(image, max_size, fixed_size=None):
+    """Shrinks an RGB image with PIL exactly as the classifier always has:
+       thumbnail() to fit within max_size, or resize() to fixed_size, both
+       with the antialiasing filter
+
+    Returns:
+        ndarray: height x width x 3 uint8 image; image itself if it already fits
+    """
+    height, width = image.shape[:2]
+    if fixed_size:
+        if fixed_size == (width, height):
+            return image
+        return np.asarray(Image.fromarray(image, 'RGB').resize(fixed_size, ANTIALIAS))
+    if width <= max_size[0] and height <= max_size[1]:
+        return image # thumbnail() never enlarges
+    img = Image.fromarray(image, 'RGB')
+    img.thumbnail(max_size, ANTIALIAS)
+    return np.asarray(img)
+
+class FramePreprocessor(object):
+
+    def __init__(self, max_size=(640, 480), fixed_size=None):
+        """
+        Args:
+            max_size ((int, int)): width, height frames are shrunk to fit within
+            fixed_size ((int, int)): if set, width, height every frame is resized to
+                                     (for graphs with a fixed input shape)
+        """
+        self.max_size = max_size
+        self.fixed_size = fixed_size
+        self.batch = None
+        self.batch_n = None # for prepare_batch()
+        self.last_timings = {}
+
+    def prepare(self, image, rgb=False, max_size=None):
+        """Shrink image into the reused 1 x height x width x 3 RGB uint8 batch
+
+        Args:
+            image (ndarray): height x width x 3 uint8 image
+            rgb (bool): True if image is already RGB rather than OpenCV's BGR
+            max_size ((int, int)): width, height to fit within this time instead
+                                   of the usual max_size (ignored if fixed_size)
+
+        Returns:
+            ndarray: batch ready to feed to the network; overwritten by next call
+        """
+        tic = time.time()
+        if not rgb:
+            image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+        else:
+            # PIL needs contiguous rows, which in-place views of messages may not be
+            image = np.ascontiguousarray(image)
+        toc = time.time()
+
+        image = shrink_like_pil(image, max_size or self.max_size, self.fixed_size)
+        if self.batch is None or self.batch.shape[1:3] != image.shape[:2]:
+            # Only reallocated if the frame size changes (e.g. ROI crops)
+            self.batch = np.empty((1,) + image.shape, dtype=np.uint8)
+        np.copyto(self.batch[0], image)
+
+        self.last_timings = {'channel_swap': toc - tic, 'resize': time.time() - toc}
+        return self.batch
+
+    def prepare_batch(self, images, rgb=False):
+        """Resize several images into one reused N x height x width x 3 RGB uint8
+           batch. Each is shrunk to fit within max_size (or resized to fixed_size)
+           and padded with black at the right and bottom to the largest of them.
+
+        Args:
+            images (list): height x width x 3 uint8 images, any sizes
+            rgb (bool): True if images are already RGB rather than OpenCV's BGR
+
+        Returns:
+            ndarray: batch ready to feed to the network; overwritten by next call
+            list: (width, height) of each image in its slot, before padding
+        """
+        tic = time.time()
+        images = [np.ascontiguousarray(image) if rgb else cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+                  for image in images]
+        toc = time.time()
+
+        images = [shrink_like_pil(image, self.max_size, self.fixed_size) for image in images]
+        sizes = [(image.shape[1], image.shape[0]) for image in images]
+        batch_width = max(width for width, _ in sizes)
+        batch_height = max(height for _, height in sizes)
+        if self.batch_n is None or self.batch_n.shape != (len(images), batch_height, batch_width, 3):
+            self.batch_n = np.empty((len(images), batch_height, batch_width, 3), dtype=np.uint8)
+
+        for frame, image, (width, height) in zip(self.batch_n, images, sizes):
+            frame[:height, :width] = image
+            frame[height:, :] = 0
+            frame[:height, width:] = 0
+
+        self.last_timings = {'channel_swap': toc - tic, 'resize': time.time() - toc}
+        return self.batch_n, sizes
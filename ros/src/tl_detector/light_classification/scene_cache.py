@@ -0,0 +1,84 @@
+###############################################################################
+#   Udacity self-driving car course : Capstone Project.
+#
+#   Team   : smart-carla
+#
+#   Reuses the last classification while we are stopped (e.g. waiting at a
+#   red light) and the camera sees practically the same thing, instead of
+#   running the classifier on near identical frames. The scene is compared
+#   using a tiny greyscale thumbnail of the region classified, against the
+#   frame that was last actually classified, so slow changes add up. The
+#   largest difference of any thumbnail pixel is used rather than the mean,
+#   as a lamp changing is only a small part of the picture. Entries
+#   expire after a maximum age so that the light is still checked regularly.
+###############################################################################
+
+import math
+
+import cv2
+import numpy as np
+
+class SceneCache(object):
+
+    def __init__(self, max_age=1.0, max_speed=0.2, max_position_change=0.5,
+                 max_yaw_change=0.02, max_difference=20.0, signature_size=(64, 48)):
+        """
+        Args:
+            max_age (float): seconds a classification may be reused for
+            max_speed (float): m/s above which we count as moving
+            max_position_change (float): metres we may have crept since
+            max_yaw_change (float): radians we may have turned since
+            max_difference (float): largest difference in grey level of any thumbnail
+                                    pixel that still counts as the same scene
+            signature_size ((int, int)): width, height of thumbnails
+        """
+        self.max_age = max_age
+        self.max_speed = max_speed
+        self.max_position_change = max_position_change
+        self.max_yaw_change = max_yaw_change
+        self.max_difference = max_difference
+        self.signature_size = signature_size
+        self.hits = 0
+        self.misses = 0
+        self.reset()
+
+    def reset(self):
+        self.entry = None
+
+    def get_signature(self, image):
+        """Small greyscale thumbnail of image (BGR or RGB alike)"""
+        # Subsample first so the area resize has little to do
+        step = max(1, min(image.shape[1] // (4 * self.signature_size[0]),
+                          image.shape[0] // (4 * self.signature_size[1])))
+        small = cv2.resize(image[::step, ::step], self.signature_size, interpolation=cv2.INTER_AREA)
+        return small.mean(axis=2, dtype=np.float32)
+
+    def lookup(self, key, signature, x, y, yaw, speed, now):
+        """Last classification if still valid for this frame
+
+        Args:
+            key: anything identifying what was classified, e.g. light and region
+            signature (ndarray): get_signature() of the region to classify
+            x, y, yaw (float): our pose
+            speed (float): our speed in m/s
+            now (float): time in seconds
+
+        Returns:
+            the result stored, or None if it must be classified afresh
+        """
+        entry = self.entry
+        if (entry is None or entry['key'] != key or now - entry['time'] > self.max_age or
+                now < entry['time'] or abs(speed) > self.max_speed or
+                math.hypot(x - entry['x'], y - entry['y']) > self.max_position_change or
+                abs(math.atan2(math.sin(yaw - entry['yaw']), math.cos(yaw - entry['yaw']))) >
+                    self.max_yaw_change or
+                np.max(np.abs(signature - entry['signature'])) > self.max_difference):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry['result']
+
+    def store(self, key, signature, x, y, yaw, now, result):
+        """Remembers the classification of a frame (arguments as for lookup())"""
+        self.entry = {'key': key, 'signature': signature, 'x': x, 'y': y, 'yaw': yaw,
+                      'time': now, 'result': result}
@@ -0,0 +1,112 @@
+###############################################################################
+#   Udacity self-driving car course : Capstone Project.
+#
+#   Team   : smart-carla
+#
+#   Streaming accuracy and latency metrics for the classifier running in
+#   shadow mode, i.e. while the car drives on the simulator's ground truth
+#   light states: each classification is recorded against the true state as
+#   it happens, keeping a running confusion matrix, agreement over a rolling
+#   window of recent frames and over distance bands, and how long each
+#   result took. Nothing is kept per frame beyond the rolling windows, so it
+#   can run for a whole sim session.
+###############################################################################
+
+import threading
+from collections import deque
+
+import numpy as np
+
+# TrafficLight states, in the order of confusion matrix rows and columns
+STATES = [0, 1, 2, 4]
+STATE_NAMES = ['RED', 'YELLOW', 'GREEN', 'UNKNOWN']
+RED = 0
+
+class ShadowEvaluator(object):
+
+    def __init__(self, window=200, distance_bands=(25.0, 50.0, 100.0)):
+        """
+        Args:
+            window (int): recent frames that the rolling agreement and latency
+                          percentiles are worked out over
+            distance_bands (tuple): upper edges in metres of the distance bands
+                                    agreement is also broken down by
+        """
+        self.window = window
+        self.distance_bands = list(distance_bands)
+        self.confusion = np.zeros((len(STATES), len(STATES)), dtype=int) # true x predicted
+        self.recent_agreement = deque(maxlen=window)
+        self.recent_latency = deque(maxlen=window)
+        self.recent_lag = deque(maxlen=window)
+        # [agreed, frames] per band, plus one beyond the last edge
+        self.band_counts = [[0, 0] for _ in range(len(self.distance_bands) + 1)]
+        # Recorded from the shadow thread, summarised from a timer thread
+        self.lock = threading.Lock()
+
+    def record(self, true_state, predicted_state, latency, lag=None, distance=None):
+        """Adds one shadow classification
+
+        Args:
+            true_state (int): ground truth TrafficLight state
+            predicted_state (int): what the classifier said
+            latency (float): seconds the classification took
+            lag (float): seconds from the frame being captured to the result
+            distance (float): metres to the light, if known
+        """
+        agreed = true_state == predicted_state
+        with self.lock:
+            self.confusion[STATES.index(true_state), STATES.index(predicted_state)] += 1
+            self.recent_agreement.append(agreed)
+            self.recent_latency.append(latency)
+            if lag is not None:
+                self.recent_lag.append(lag)
+            if distance is not None:
+                band = self.band_counts[np.searchsorted(self.distance_bands, distance)]
+                band[0] += agreed
+                band[1] += 1
+
+    def summary(self):
+        """Metrics so far
+
+        Returns:
+            dict: frames, overall and rolling agreement, red lights missed and
+                  false reds, per-class precision/recall, agreement by distance
+                  band, latency and lag percentiles (seconds) and the confusion
+                  matrix (rows true, columns predicted, in STATE_NAMES order)
+        """
+        with self.lock:
+            confusion = self.confusion.copy()
+            recent_agreement = list(self.recent_agreement)
+            recent_latency = list(self.recent_latency)
+            recent_lag = list(self.recent_lag)
+            band_counts = [list(band) for band in self.band_counts]
+
+        frames = int(confusion.sum())
+        red = STATES.index(RED)
+        summary = {'frames': frames,
+                   'agreement': float(np.trace(confusion)) / frames if frames else None,
+                   'recent_agreement': float(np.mean(recent_agreement)) if recent_agreement else None,
+                   # Safety relevant: a red light called anything else...
+                   'red_missed': int(confusion[red, :].sum() - confusion[red, red]),
+                   # ...or stopping for nothing
+                   'false_red': int(confusion[:, red].sum() - confusion[red, red]),
+                   'classes': {},
+                   'distance_bands': [],
+                   'confusion': confusion.tolist()}
+        for i, name in enumerate(STATE_NAMES):
+            predicted = confusion[:, i].sum()
+            actual = confusion[i, :].sum()
+            summary['classes'][name] = {'precision': float(confusion[i, i]) / predicted if predicted else None,
+                                        'recall': float(confusion[i, i]) / actual if actual else None,
+                                        'support': int(actual)}
+        lower = 0.0
+        for upper, (agreed, band_frames) in zip(self.distance_bands + [None], band_counts):
+            summary['distance_bands'].append({'min_distance': lower, 'max_distance': upper,
+                                              'frames': band_frames,
+                                              'agreement': float(agreed) / band_frames if band_frames else None})
+            lower = upper
+        for name, values in (('latency', recent_latency), ('lag', recent_lag)):
+            if values:
+                p50, p95 = np.percentile(values, [50, 95])
+                summary[name] = {'p50': float(p50), 'p95': float(p95), 'max': float(max(values))}
+        return summary
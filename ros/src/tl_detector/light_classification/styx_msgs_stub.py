@@ -0,0 +1,42 @@
+###############################################################################
+#   Udacity self-driving car course : Capstone Project.
+#
+#   Team   : smart-carla
+#
+#   Lets offline tools import the light classifiers on a machine without ROS:
+#   if styx_msgs can't be imported, a stand-in styx_msgs.msg module is
+#   registered with just the TrafficLight state enumeration the classifiers
+#   use. Must be called before importing tl_classifier.
+###############################################################################
+
+import sys
+import types
+
+class TrafficLight(object):
+    """Same state values as styx_msgs/TrafficLight.msg"""
+    UNKNOWN = 4
+    GREEN = 2
+    YELLOW = 1
+    RED = 0
+
+    def __init__(self):
+        self.state = TrafficLight.UNKNOWN
+
+def install_if_missing():
+    """Registers the stand-in styx_msgs.msg unless the real one is available
+
+    Returns:
+        bool: True if the stand-in is being used
+    """
+    try:
+        import styx_msgs.msg
+        return False
+    except ImportError:
+        pass
+    package = types.ModuleType('styx_msgs')
+    msg = types.ModuleType('styx_msgs.msg')
+    msg.TrafficLight = TrafficLight
+    package.msg = msg
+    sys.modules['styx_msgs'] = package
+    sys.modules['styx_msgs.msg'] = msg
+    return True
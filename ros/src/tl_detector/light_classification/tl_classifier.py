@@ -2,12 +2,17 @@ import os
 import os.path
 import six.moves.urllib as urllib
 import time, sys
+import subprocess
+import ctypes
+import platform
 
 from styx_msgs.msg import TrafficLight
 import tensorflow as tf
 import numpy as np
 import scipy
-from PIL import Image
+
+from light_classification.colour_classifier import ColourClassifier
+from light_classification.preprocess import FramePreprocessor
 
 # Only required for VGG classifier:
 sys.path.insert(0,"../../../training")
@@ -16,18 +21,107 @@ import cnn_classifier_model
 
 DETECTION_THRESHOLD = 0.5
 
+# Order of per-class scores in TLClassifier.last_scores
+SCORE_STATES = [TrafficLight.RED, TrafficLight.YELLOW, TrafficLight.GREEN, TrafficLight.UNKNOWN]
+
+def scores_from_confidence(state, confidence):
+    """Per-class scores in SCORE_STATES order for a classifier that only gives
+       its chosen state and how confident it is; the rest is shared equally"""
+    scores = [(1.0 - confidence) / (len(SCORE_STATES) - 1)] * len(SCORE_STATES)
+    scores[SCORE_STATES.index(state)] = confidence
+    return scores
+
+# gettid system call number by architecture, as Python 2 has no way to ask
+SYS_GETTID = {'x86_64': 186, 'aarch64': 178, 'i386': 224, 'i686': 224}
+
+def set_thread_cpu_affinity(cpus):
+    """Pins the calling thread, and so the threads it starts afterwards (like
+       TensorFlow's thread pools when the first session is created), to the
+       given CPUs; other threads already running keep theirs. Logs the
+       affinity that took effect.
+
+    Returns:
+        list: CPUs the thread could use before, to restore with
+              set_thread_cpu_affinity(), or None if it couldn't be pinned
+    """
+    if hasattr(os, 'sched_setaffinity'):
+        # On Linux, 0 means the calling thread rather than the whole process
+        previous = sorted(os.sched_getaffinity(0))
+        os.sched_setaffinity(0, cpus)
+        current = sorted(os.sched_getaffinity(0))
+    else:
+        # Python 2 has no direct call for this
+        try:
+            thread_id = str(ctypes.CDLL(None).syscall(SYS_GETTID[platform.machine()]))
+            # "pid 123's current affinity list: 0-3\npid 123's new affinity list: 1"
+            output = subprocess.check_output(["taskset", "-p", "-c",
+                                              ",".join(str(cpu) for cpu in cpus), thread_id])
+        except (KeyError, OSError, subprocess.CalledProcessError) as e:
+            print("Warning: couldn't set CPU affinity, is taskset installed? (%s)" % repr(e))
+            return None
+        lines = output.decode().strip().splitlines()
+        previous, current = [parse_cpu_list(line.split(":")[-1]) for line in (lines[0], lines[-1])]
+    print("Classifier CPU affinity: %s -> %s" %
+              (",".join(str(cpu) for cpu in previous), ",".join(str(cpu) for cpu in current)))
+    return previous
+
+def parse_cpu_list(cpu_list):
+    """e.g. "0-2,4" -> [0, 1, 2, 4]"""
+    cpus = []
+    for part in cpu_list.strip().split(","):
+        first, _, last = part.partition("-")
+        cpus.extend(range(int(first), int(last or first) + 1))
+    return cpus
+
+def model_variant_filename(model_filename, variant):
+    """e.g. models/faster_rcnn_sim.pb -> models/faster_rcnn_sim_quantised.pb"""
+    root, ext = os.path.splitext(model_filename)
+    return root + "_" + variant + ext
+
 class TLClassifier(object):
-    def __init__(self):
+    def __init__(self, is_site=False, model_variant="", classifier="FRCNN",
+                 cascade_confidence=0.9, intra_op_threads=0, inter_op_threads=0,
+                 cpu_affinity=None, warm_up=True, progress_cb=None):
+        """
+        Args:
+            is_site (bool): use the model trained on real images rather than simulator
+            model_variant (str): optional suffix selecting an optimised copy of the
+                                 FRCNN model written by optimise_frcnn_graph.py,
+                                 e.g. "optimised" for faster_rcnn_sim_optimised.pb
+            classifier (str): "FRCNN", "VGG", "COLOUR" or "CASCADE", see below
+            cascade_confidence (float): in CASCADE mode, colour classifier results
+                                        at least this confident are not escalated
+            intra_op_threads (int): TensorFlow threads used within one op (0=default)
+            inter_op_threads (int): TensorFlow threads running ops in parallel (0=default)
+            cpu_affinity (list): CPU numbers to pin TensorFlow's threads to (None=any)
+            warm_up (bool): run dummy frames through the model until its latency
+                            settles, so the first real frame isn't slow
+            progress_cb (function): called with name of each loading stage
+        """
 
         # We tried a couple of classifiers during development. The best one
         # is Faster R-CNN, which should normally be used.
         # We also tried a full-frame classifier based on VGG, which worked OK in
         # the simulator, but not for real images. It's kept here as an option just
         # so we can still demonstrate it.
-        # So choose "FRCNN" or "VGG" here. (String in case we have other alternatives later.)
-        self.classifier = "FRCNN"
-
-        self.is_site = False # if set then classifier for real images will be used
+        # "COLOUR" is a classical colour-space classifier that needs no GPU, for
+        # degraded hardware; it does well on simulator images but poorly on real ones.
+        # "CASCADE" runs the colour classifier first and only escalates frames it
+        # isn't confident about to Faster R-CNN.
+        # So choose "FRCNN", "VGG", "COLOUR" or "CASCADE" here.
+        self.classifier = classifier
+        self.cascade_confidence = cascade_confidence
+        self.progress_cb = progress_cb
+
+        # Only the thread building the classifier is pinned, while it creates the
+        # session (whose thread pools inherit the pinning) and warms up; the
+        # node's callback and publisher threads keep the other CPUs
+        previous_affinity = set_thread_cpu_affinity(cpu_affinity) if cpu_affinity else None
+        self.session_config = tf.ConfigProto(intra_op_parallelism_threads=intra_op_threads,
+                                             inter_op_parallelism_threads=inter_op_threads)
+
+        self.is_site = is_site # if set then classifier for real images will be used
+        self.model_variant = model_variant
 
         # specify path to /models directory with respect to the absolute path of tl_classifier.py
         MODEL_DIR_NAME=os.path.join(os.path.dirname(__file__), 'models')
@@ -49,6 +143,16 @@ class TLClassifier(object):
         # full path to the model file
         fullfilename = os.path.join(MODEL_DIR_NAME, FILENAME)
 
+        if self.model_variant:
+            # Optimised variants are generated locally from the downloaded model,
+            # so there is nothing to download if it's missing
+            variant_filename = model_variant_filename(fullfilename, self.model_variant)
+            if os.path.isfile(variant_filename):
+                fullfilename = variant_filename
+            else:
+                print("Warning: model variant %s not found, run optimise_frcnn_graph.py "
+                      "to create it; using original model" % variant_filename)
+
         # Function that reports downloading status
         def reporthook(count, block_size, total_size):
             global start_time
@@ -63,48 +167,131 @@ class TLClassifier(object):
                             (percent, progress_size / (1024 * 1024), speed, duration))
             sys.stdout.flush()
 
-        if self.classifier == "FRCNN":
-		if os.path.isfile(fullfilename):
-		    print("Model file is downloaded. Full path: {} \n".format(fullfilename))
-		    print("Proceeding with graph initialisation...\n")
-		else:
-		    print("Model file is missing, start downloading...\n")
-		    urllib.request.urlretrieve(DOWNLOAD_URL, fullfilename, reporthook)
-		    print()
-		    print("New directory was created: {}".format(MODEL_DIR_NAME))
-		    print("Model file is downloaded. Full path: {} \n".format(fullfilename))
-		    print("Proceeding with classifier initialisation...\n")
-
-		# Import tensorflow graph
-		self.detection_graph = tf.Graph()
-		with self.detection_graph.as_default():
-		    od_graph_def = tf.GraphDef()
-		    with tf.gfile.GFile(fullfilename, 'rb') as fid:
-		        serialized_graph = fid.read()
-		        od_graph_def.ParseFromString(serialized_graph)
-		        tf.import_graph_def(od_graph_def, name='')
-		    # get all necessary tensors
-		    self.image_tensor = self.detection_graph.get_tensor_by_name('image_tensor:0')
-		    self.d_boxes = self.detection_graph.get_tensor_by_name('detection_boxes:0')
-		    self.d_scores = self.detection_graph.get_tensor_by_name('detection_scores:0')
-		    self.d_classes = self.detection_graph.get_tensor_by_name('detection_classes:0')
-		    self.num_d = self.detection_graph.get_tensor_by_name('num_detections:0')
-		self.sess = tf.Session(graph=self.detection_graph)
+        if self.classifier in ("FRCNN", "CASCADE"):
+            if os.path.isfile(fullfilename):
+                print("Model file is downloaded. Full path: {} \n".format(fullfilename))
+                print("Proceeding with graph initialisation...\n")
+            else:
+                print("Model file is missing, start downloading...\n")
+                self.report_progress("downloading model")
+                urllib.request.urlretrieve(DOWNLOAD_URL, fullfilename, reporthook)
+                print()
+                print("New directory was created: {}".format(MODEL_DIR_NAME))
+                print("Model file is downloaded. Full path: {} \n".format(fullfilename))
+                print("Proceeding with classifier initialisation...\n")
+
+            # Import tensorflow graph
+            self.report_progress("importing graph")
+            self.detection_graph = tf.Graph()
+            with self.detection_graph.as_default():
+                od_graph_def = tf.GraphDef()
+                with tf.gfile.GFile(fullfilename, 'rb') as fid:
+                    serialized_graph = fid.read()
+                    od_graph_def.ParseFromString(serialized_graph)
+                    tf.import_graph_def(od_graph_def, name='')
+                # get all necessary tensors
+                self.image_tensor = self.detection_graph.get_tensor_by_name('image_tensor:0')
+                self.d_boxes = self.detection_graph.get_tensor_by_name('detection_boxes:0')
+                self.d_scores = self.detection_graph.get_tensor_by_name('detection_scores:0')
+                self.d_classes = self.detection_graph.get_tensor_by_name('detection_classes:0')
+                self.num_d = self.detection_graph.get_tensor_by_name('num_detections:0')
+            self.sess = tf.Session(graph=self.detection_graph, config=self.session_config)
+
+            # Optimised variants have their input shape fixed, in which case every
+            # image has to be resized to exactly that shape rather than thumbnailed
+            input_shape = self.image_tensor.get_shape()
+            if input_shape.is_fully_defined():
+                self.fixed_input_size = (int(input_shape[2]), int(input_shape[1])) # width, height
+            else:
+                self.fixed_input_size = None
+            # ...and can only take one image per run
+            self.frcnn_max_batch = input_shape.as_list()[0]
+            self.preprocessor = FramePreprocessor(max_size=(640, 480), fixed_size=self.fixed_input_size)
+            self.detection_graph.finalize()
 
         elif self.classifier == "VGG":
-            self.sess = tf.Session()
-            self.cnn_model = cnn_classifier_model.CnnClassifierModel(self.sess, True)
-            self.image_counter = 0
-
-        else:
+            self.report_progress("building VGG model")
+            # Own graph rather than the default, so it can be finalised below
+            self.vgg_graph = tf.Graph()
+            with self.vgg_graph.as_default():
+                self.sess = tf.Session(graph=self.vgg_graph, config=self.session_config)
+                self.cnn_model = cnn_classifier_model.CnnClassifierModel(self.sess, True)
+            # Inference must never add ops to the graph, or it grows for as long
+            # as the node runs; finalising makes any attempt to do so fail loudly
+            self.vgg_graph.finalize()
+
+        if self.classifier in ("COLOUR", "CASCADE"):
+            self.colour_classifier = ColourClassifier()
+            self.reset_cascade_stats()
+
+        if self.classifier not in ("FRCNN", "VGG", "COLOUR", "CASCADE"):
             print("Error: unknown classifier choice %s, aborting" % self.classifier)
             sys.exit(1)
 
-    def get_classification_frcnn(self, image):
+        self.last_timings = {} # seconds spent in each stage of last classification
+        # Top box (normalised ymin, xmin, ymax, xmax) and score of the last
+        # classification, for classifiers that detect boxes
+        self.last_detection = None
+        # Probability of each of SCORE_STATES according to the last classification
+        self.last_scores = None
+        # Top box and score for each item of the last get_classification_batch()
+        self.last_detections = []
+        self.warm_up_latencies = []
+        if warm_up:
+            self.warm_up()
+        if previous_affinity is not None:
+            set_thread_cpu_affinity(previous_affinity)
+
+    def close(self):
+        """Releases the TensorFlow session and graph; the classifier can't be
+           used afterwards"""
+        if hasattr(self, 'sess'):
+            self.sess.close()
+            del self.sess
+        self.detection_graph = None
+        self.vgg_graph = None
+        self.cnn_model = None
+
+    def report_progress(self, stage):
+        if self.progress_cb:
+            self.progress_cb(stage)
+
+    def warm_up(self, max_runs=10, tolerance=0.2):
+        """Runs a dummy 640x480 frame through the network until the time per run
+           stops falling, so that graph optimisation and memory allocation costs
+           are paid now rather than on the first real camera frame
+
+        Args:
+            max_runs (int): give up waiting for steady state after this many
+            tolerance (float): steady once a run is within this fraction of the last
+
+        """
+        if self.classifier in ("FRCNN", "CASCADE"):
+            classify = self.get_classification_frcnn
+        elif self.classifier == "VGG":
+            classify = self.get_classification_vgg
+        else:
+            return # nothing worth warming up
+
+        self.report_progress("warming up")
+        dummy_image = np.zeros((480, 640, 3), dtype=np.uint8)
+        for _ in range(max_runs):
+            tic = time.time()
+            classify(dummy_image)
+            self.warm_up_latencies.append(time.time() - tic)
+            if (len(self.warm_up_latencies) >= 2 and
+                    self.warm_up_latencies[-1] >= (1.0 - tolerance) * self.warm_up_latencies[-2]):
+                break
+        print("Classifier warmed up after %d runs, latency %.3f s (first run %.3f s)" %
+                  (len(self.warm_up_latencies), self.warm_up_latencies[-1], self.warm_up_latencies[0]))
+
+    def get_classification_frcnn(self, image, rgb=False, max_size=None):
         """Determines the color of the traffic light in the image
 
         Args:
             image (cv::Mat): image containing the traffic light
+            rgb (bool): True if image is RGB rather than OpenCV's usual BGR
+            max_size ((int, int)): shrink to fit this width, height rather than 640x480
 
         Returns:
             int: ID of traffic light color (specified in styx_msgs/TrafficLight)
@@ -114,40 +301,107 @@ class TLClassifier(object):
         # Bounding Box Detection.
         tic = time.time()
         with self.detection_graph.as_default():
-            # BGR to RGB conversion
-            image = image[:, :, ::-1]
-
-            img = Image.fromarray(image.astype('uint8'), 'RGB')
-            size = 640, 480
-            img.thumbnail(size, Image.ANTIALIAS)
-            # Expand dimension since the model expects image to have shape [1, None, None, 3].
-            img_expanded = np.expand_dims(img, axis=0)  
+            # Shrink and convert to RGB straight into the reused input batch array,
+            # which has the shape [1, None, None, 3] that the model expects
+            img_expanded = self.preprocessor.prepare(image, rgb, max_size)
+            toc_preprocess = time.time()
             # run classifier
             (boxes, scores, classes, num) = self.sess.run(
                 [self.d_boxes, self.d_scores, self.d_classes, self.num_d],
                 feed_dict={self.image_tensor: img_expanded})
-            # find the top score for a given image frame
-            top_score = np.amax(np.squeeze(scores))
-            
-            elapsed_time = time.time() - tic
-            sys.stderr.write("Debug: Time spent on classification=%.2f\n" % (elapsed_time))
-
-            # figure out traffic light class based on the top score
-            if top_score > DETECTION_THRESHOLD:
-                tl_state = int(np.squeeze(classes)[0])
-                if tl_state == 1:
-                    sys.stderr.write("Debug: Traffic state: RED, score=%.2f\n" % (top_score*100))
-                    return TrafficLight.RED
-                elif tl_state == 2:
-                    sys.stderr.write("Debug: Traffic state: YELLOW, score=%.2f\n" % (top_score*100))
-                    return TrafficLight.YELLOW
-                else:
-                    sys.stderr.write("Debug: Traffic state: GREEN, score=%.2f\n" % (top_score*100))
-                    return TrafficLight.GREEN
+            toc_inference = time.time()
+            state, self.last_scores, self.last_detection = self.frcnn_result(boxes[0], scores[0],
+                                                                             classes[0])
+
+            self.last_timings = dict(self.preprocessor.last_timings)
+            self.last_timings.update({'preprocess': toc_preprocess - tic,
+                                      'inference': toc_inference - toc_preprocess,
+                                      'postprocess': time.time() - toc_inference})
+            return state
+
+
+    def frcnn_result(self, boxes, scores, classes):
+        """Light state from the detections for one image
+
+        Args:
+            boxes, scores, classes (ndarray): detector outputs for the image, sorted by score
+
+        Returns:
+            int: ID of traffic light color (specified in styx_msgs/TrafficLight)
+            list: probability of each of SCORE_STATES
+            (ndarray, float): top box (normalised ymin, xmin, ymax, xmax) and its score
+        """
+        # Detections are sorted by score, so first box is the top one
+        top_score = float(scores[0])
+        # Top class gets its score as probability, the rest counts as no light seen
+        top_class = int(classes[0])
+        class_scores = [0.0, 0.0, 0.0, 1.0 - top_score]
+        class_scores[min(top_class, 3) - 1] += top_score
+
+        # figure out traffic light class based on the top score
+        if top_score > DETECTION_THRESHOLD:
+            if top_class == 1:
+                state = TrafficLight.RED
+            elif top_class == 2:
+                state = TrafficLight.YELLOW
             else:
-                sys.stderr.write("Debug: Traffic state: OFF\n")     
-                return TrafficLight.UNKNOWN
+                state = TrafficLight.GREEN
+        else:
+            state = TrafficLight.UNKNOWN
+        return state, class_scores, (boxes[0], top_score)
 
+    def get_classification_frcnn_batch(self, images, rgb=False):
+        """Determines the color of the traffic light in each of several images
+           in one session run (or as few as the model allows)
+
+        Args:
+            images (list): images (cv::Mat) of any sizes
+            rgb (bool): True if images are RGB rather than OpenCV's usual BGR
+
+        Returns:
+            list: ID of traffic light color for each image
+            list: probability of each of SCORE_STATES for each image
+            list: top box (normalised to that image) and score for each image
+        """
+        if self.frcnn_max_batch and len(images) > self.frcnn_max_batch:
+            # Model was optimised for a fixed batch size, so split up
+            results = ([], [], [])
+            timings = {}
+            for start in range(0, len(images), self.frcnn_max_batch):
+                chunk_results = self.get_classification_frcnn_batch(
+                                    images[start:start + self.frcnn_max_batch], rgb)
+                for result, chunk_result in zip(results, chunk_results):
+                    result.extend(chunk_result)
+                for stage, seconds in self.last_timings.items():
+                    timings[stage] = timings.get(stage, 0.0) + seconds
+            self.last_timings = timings
+            return results
+
+        tic = time.time()
+        # All resized into one batch, padded to the largest
+        batch, sizes = self.preprocessor.prepare_batch(images, rgb)
+        toc_preprocess = time.time()
+        (boxes, scores, classes, num) = self.sess.run(
+            [self.d_boxes, self.d_scores, self.d_classes, self.num_d],
+            feed_dict={self.image_tensor: batch})
+        toc_inference = time.time()
+
+        states, class_scores, detections = [], [], []
+        batch_height, batch_width = batch.shape[1:3]
+        for i, (width, height) in enumerate(sizes):
+            state, item_scores, (box, top_score) = self.frcnn_result(boxes[i], scores[i], classes[i])
+            # Box is normalised to the padded slot; make it relative to the image itself
+            box = box * [float(batch_height) / height, float(batch_width) / width,
+                         float(batch_height) / height, float(batch_width) / width]
+            states.append(state)
+            class_scores.append(item_scores)
+            detections.append((box, top_score))
+
+        self.last_timings = dict(self.preprocessor.last_timings)
+        self.last_timings.update({'preprocess': toc_preprocess - tic,
+                                  'inference': toc_inference - toc_preprocess,
+                                  'postprocess': time.time() - toc_inference})
+        return states, class_scores, detections
 
     def get_classification_vgg(self, image):
         """Determines the color of the traffic light in the image using
@@ -160,44 +414,187 @@ class TLClassifier(object):
             int: ID of traffic light color (specified in styx_msgs/TrafficLight)
 
         """
-        # Shrink image to size required by network first, so that any further
-        # operations are computationally cheaper
-        image = scipy.misc.imresize(image, self.cnn_model.image_shape)
-
-        # Convert CV2 BGR encoding to RGB as used to train model
-        image = image[...,::-1]
-
-        # Actually run image through network in inference mode to get classification
-        im_softmax = self.sess.run(
-            [tf.nn.softmax(self.cnn_model.logits)],
-            {self.cnn_model.keep_prob: 1.0, self.cnn_model.image_input: [image]})
-
-        # Identify most likely class (light colour)
-        top_score = np.argmax(im_softmax)
-        if (top_score == 3):
-            # Convert 0..3 model output to ROS light state value
-            top_score = 4 # unknown
-
-        colour_enum = ['RED', 'YELLOW', 'GREEN', 'UNKNOWN', 'UNKNOWN']
-        if True: # debug only
-            # Useful to see scores for each class. Also saving images has been useful
-            # to identify colour coding problems and so that we can see what the image
-            # looked like on occasions when it was misclassified
-            softmax_scores_as_list = im_softmax[0].tolist()[0]
-            classification = "R%.2f_Y%.2f_G%.2f_U%.2f" % tuple(softmax_scores_as_list)
-            filename = "run_%d_%d_%s.jpg" % (self.image_counter, top_score, classification)
-            #scipy.misc.imsave(filename, image)
-            print("Debug: image %s classed:%s" % (filename, colour_enum[top_score]))
-            self.image_counter += 1
-            
+        states, im_softmax = self.get_classification_vgg_batch([image])
+        top_score = states[0]
+        self.last_scores = im_softmax[0].tolist()
+
         return top_score
 
+    def get_classification_vgg_batch(self, images):
+        """Classifies several images in one session run with the VGG classifier
+
+        Args:
+            images (list): BGR images (cv::Mat) of any size
+
+        Returns:
+            list: ID of traffic light color for each image
+            ndarray: softmax scores, images x classes (red, yellow, green, unknown)
+
+        """
+        # Shrink images to size required by network first, and
+        # convert CV2 BGR encoding to RGB as used to train model
+        tic = time.time()
+        batch = np.empty((len(images),) + tuple(self.cnn_model.image_shape) + (3,), dtype=np.uint8)
+        for i, image in enumerate(images):
+            batch[i] = scipy.misc.imresize(image, self.cnn_model.image_shape)[..., ::-1]
+
+        toc_preprocess = time.time()
+
+        # Run through network in inference mode; softmax and argmax ops were built
+        # once with the model, so this adds nothing to the graph
+        im_softmax, predictions = self.sess.run(
+            [self.cnn_model.softmax, self.cnn_model.prediction],
+            {self.cnn_model.keep_prob: 1.0, self.cnn_model.image_input: batch})
+        toc_inference = time.time()
+
+        # Convert 0..3 model output to ROS light state value (3 -> 4 for unknown)
+        states = [4 if prediction == 3 else int(prediction) for prediction in predictions]
+        self.last_timings = {'preprocess': toc_preprocess - tic,
+                             'inference': toc_inference - toc_preprocess,
+                             'postprocess': time.time() - toc_inference}
+        return states, im_softmax
+
+
+    def get_classification_cascade(self, image, rgb=False, max_size=None):
+        """Determines the color of the traffic light in the image using the cheap
+           colour classifier, escalating to Faster R-CNN only if it isn't confident
+
+        Args:
+            image (cv::Mat): image containing the traffic light
+            rgb (bool): True if image is RGB rather than OpenCV's usual BGR
+            max_size ((int, int)): Faster R-CNN input size limit, as for get_classification()
+
+        Returns:
+            int: ID of traffic light color (specified in styx_msgs/TrafficLight)
+
+        """
+        tic = time.time()
+        state, confidence = self.colour_classifier.get_classification_with_score(
+                                np.ascontiguousarray(image[..., ::-1]) if rgb else image)
+        self.last_scores = scores_from_confidence(state, confidence)
+        toc = time.time()
+        self.cascade_stats['frames'] += 1
+        self.cascade_stats['stage1_time'] += toc - tic
+
+        if confidence < self.cascade_confidence:
+            state = self.get_classification_frcnn(image, rgb, max_size)
+            self.cascade_stats['escalated'] += 1
+            self.cascade_stats['stage2_time'] += time.time() - toc
+        self.last_timings['colour'] = toc - tic
+
+        return state
+
+    def reset_cascade_stats(self):
+        self.cascade_stats = {'frames': 0, 'escalated': 0, 'stage1_time': 0.0, 'stage2_time': 0.0}
+
+    def get_cascade_stats(self):
+        """Returns escalation rate and mean time per frame (seconds) of each
+           cascade stage since the stats were last reset"""
+        stats = self.cascade_stats
+        return {'frames': stats['frames'],
+                'escalation_rate': float(stats['escalated']) / max(1, stats['frames']),
+                'stage1_mean_time': stats['stage1_time'] / max(1, stats['frames']),
+                'stage2_mean_time': stats['stage2_time'] / max(1, stats['escalated'])}
+
+    def get_classification_batch(self, images, rgb=False, rois=None):
+        """Determines the color of the traffic light in each of several images,
+           or regions of images, with the chosen classifier. FRCNN and VGG
+           classify them all in one session run, which is much quicker than
+           one call per image.
+
+        Args:
+            images (list): images (cv::Mat), or a single image to take all the rois from
+            rgb (bool): True if images are RGB rather than OpenCV's usual BGR
+            rois (list): if given, x0, y0, x1, y1 pixel box to classify in each image
+
+        Returns:
+            list: ID of traffic light color for each image or region
+            list: probability of each of SCORE_STATES for each image or region
+
+        """
+        if rois is not None:
+            if isinstance(images, np.ndarray):
+                images = [images] * len(rois)
+            images = [image[y0:y1, x0:x1] for image, (x0, y0, x1, y1) in zip(images, rois)]
+        self.last_detections = [None] * len(images)
+        self.last_timings = {}
+        if not images:
+            return [], []
 
-    def get_classification(self, image):
         if self.classifier == "FRCNN":
-            return self.get_classification_frcnn(image)
-        elif self.classifier == "VGG":
+            states, class_scores, self.last_detections = self.get_classification_frcnn_batch(images, rgb)
+            return states, class_scores
+
+        if rgb:
+            # Other classifiers only take BGR
+            images = [np.ascontiguousarray(image[..., ::-1]) for image in images]
+        if self.classifier == "VGG":
+            states, im_softmax = self.get_classification_vgg_batch(images)
+            return states, im_softmax.tolist()
+
+        tic = time.time()
+        states, class_scores, confidences = [], [], []
+        for image in images:
+            state, confidence = self.colour_classifier.get_classification_with_score(image)
+            states.append(state)
+            class_scores.append(scores_from_confidence(state, confidence))
+            confidences.append(confidence)
+        toc = time.time()
+
+        if self.classifier == "CASCADE":
+            # Escalate all the ones the colour classifier isn't sure about together
+            escalate = [i for i, confidence in enumerate(confidences)
+                        if confidence < self.cascade_confidence]
+            self.cascade_stats['frames'] += len(images)
+            self.cascade_stats['stage1_time'] += toc - tic
+            if escalate:
+                frcnn_states, frcnn_scores, frcnn_detections = self.get_classification_frcnn_batch(
+                                                                    [images[i] for i in escalate])
+                for i, state, scores, detection in zip(escalate, frcnn_states, frcnn_scores,
+                                                       frcnn_detections):
+                    states[i] = state
+                    class_scores[i] = scores
+                    self.last_detections[i] = detection
+                self.cascade_stats['escalated'] += len(escalate)
+                self.cascade_stats['stage2_time'] += time.time() - toc
+        self.last_timings['colour'] = toc - tic
+        return states, class_scores
+
+    def get_classification(self, image, rgb=False, max_size=None):
+        """Determines the color of the traffic light in the image with the
+           chosen classifier
+
+        Args:
+            image (cv::Mat): image containing the traffic light
+            rgb (bool): True if image is RGB rather than OpenCV's usual BGR;
+                        FRCNN takes either without an extra copy
+            max_size ((int, int)): for FRCNN (and CASCADE), width, height to shrink
+                                   the image to fit rather than the default 640x480;
+                                   other classifiers have a fixed input size
+
+        Returns:
+            int: ID of traffic light color (specified in styx_msgs/TrafficLight)
+
+        """
+        self.last_detection = None
+        self.last_scores = None
+        self.last_timings = {}
+        if self.classifier == "FRCNN":
+            return self.get_classification_frcnn(image, rgb, max_size)
+        elif self.classifier == "CASCADE":
+            return self.get_classification_cascade(image, rgb, max_size)
+
+        if rgb:
+            # Other classifiers only take BGR
+            image = np.ascontiguousarray(image[..., ::-1])
+        if self.classifier == "VGG":
             return self.get_classification_vgg(image)
+        elif self.classifier == "COLOUR":
+            tic = time.time()
+            state, confidence = self.colour_classifier.get_classification_with_score(image)
+            self.last_scores = scores_from_confidence(state, confidence)
+            self.last_timings = {'colour': time.time() - tic}
+            return state
         else:
             print("Error: unknown classifier choice %s, aborting" % self.classifier)
             sys.exit(1)
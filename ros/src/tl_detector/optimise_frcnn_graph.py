@@ -0,0 +1,145 @@
+###############################################################################
+#   Udacity self-driving car course : Capstone Project.
+#
+#   Team   : smart-carla
+#
+#   Writes optimised variants of the frozen Faster R-CNN graph used by
+#   TLClassifier, and reports the latency and accuracy of each on the
+#   labelled images in data/ so we can pick a speed/accuracy trade-off.
+#
+#   Variants written next to the original model in light_classification/models:
+#     faster_rcnn_<sim|real>_optimised.pb  unused nodes stripped, constants and
+#                                          batch norms folded, input shape fixed
+#     faster_rcnn_<sim|real>_quantised.pb  as above plus 8-bit weights
+#
+#   Select one at run time with the ~model_variant parameter of tl_detector,
+#   e.g. "optimised". Needs the catkin workspace sourced (for styx_msgs), e.g.
+#     python optimise_frcnn_graph.py --quantise --max-images 200
+###############################################################################
+
+import argparse
+import json
+import os
+import sys
+import time
+
+import cv2
+import numpy as np
+import tensorflow as tf
+from tensorflow.tools.graph_transforms import TransformGraph
+
+from light_classification.tl_classifier import TLClassifier, model_variant_filename
+from light_classification.labelled_images import find_labelled_images
+
+INPUT_NAMES = ['image_tensor']
+OUTPUT_NAMES = ['detection_boxes', 'detection_scores', 'detection_classes', 'num_detections']
+
+def get_transforms(input_height, input_width, quantise):
+    """Graph Transform Tool steps for one variant"""
+    transforms = ['strip_unused_nodes(type=uint8, shape="1,%d,%d,3")' % (input_height, input_width),
+                  'fold_constants(ignore_errors=true)',
+                  'fold_batch_norms',
+                  'fold_old_batch_norms']
+    if quantise:
+        transforms.append('quantize_weights')
+    transforms.append('sort_by_execution_order')
+    return transforms
+
+def write_variant(model_filename, variant, transforms):
+    """Applies transforms to frozen graph and saves it under the variant name"""
+    graph_def = tf.GraphDef()
+    with tf.gfile.GFile(model_filename, 'rb') as fid:
+        graph_def.ParseFromString(fid.read())
+
+    tic = time.time()
+    optimised_graph_def = TransformGraph(graph_def, INPUT_NAMES, OUTPUT_NAMES, transforms)
+    variant_filename = model_variant_filename(model_filename, variant)
+    with tf.gfile.GFile(variant_filename, 'wb') as fid:
+        fid.write(optimised_graph_def.SerializeToString())
+
+    print("Wrote %s (%d -> %d nodes) in %.1f s" % (variant_filename, len(graph_def.node),
+              len(optimised_graph_def.node), time.time() - tic))
+    return variant_filename
+
+def evaluate(classifier, labelled_images):
+    """Runs every labelled image through classifier
+
+    Returns:
+        dict: latency statistics (ms) and accuracy
+    """
+    # First run pays one-off graph optimisation and allocation costs, so don't time it
+    classifier.get_classification(cv2.imread(labelled_images[0][0]))
+
+    latencies = []
+    num_correct = 0
+    for image_file, true_state in labelled_images:
+        image = cv2.imread(image_file) # BGR, as from camera via cv_bridge
+        tic = time.time()
+        state = classifier.get_classification(image)
+        latencies.append((time.time() - tic) * 1000.0)
+        num_correct += 1 if state == true_state else 0
+
+    latencies = np.array(latencies)
+    return {'images': len(labelled_images),
+            'accuracy': float(num_correct) / len(labelled_images),
+            'latency_mean_ms': float(np.mean(latencies)),
+            'latency_p50_ms': float(np.percentile(latencies, 50)),
+            'latency_p95_ms': float(np.percentile(latencies, 95))}
+
+def run():
+    parser = argparse.ArgumentParser(description="Optimise and evaluate the FRCNN traffic light model")
+    parser.add_argument('--site', action='store_true', help="use the real-image model rather than sim")
+    parser.add_argument('--input-height', type=int, default=480, help="fixed input image height")
+    parser.add_argument('--input-width', type=int, default=640, help="fixed input image width")
+    parser.add_argument('--quantise', action='store_true', help="also write 8-bit weight variant")
+    parser.add_argument('--max-images', type=int, default=0, help="limit evaluation set (0=all)")
+    parser.add_argument('--skip-eval', action='store_true', help="only write the variants")
+    parser.add_argument('--json', help="also write results to this file")
+    args = parser.parse_args()
+
+    # Constructing the original classifier makes sure the model is downloaded
+    classifier = TLClassifier(is_site=args.site)
+    model_filename = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                  'light_classification', 'models',
+                                  'faster_rcnn_real.pb' if args.site else 'faster_rcnn_sim.pb')
+
+    variants = [('optimised', False)]
+    if args.quantise:
+        variants.append(('quantised', True))
+    for variant, quantise in variants:
+        write_variant(model_filename, variant,
+                      get_transforms(args.input_height, args.input_width, quantise))
+
+    if args.skip_eval:
+        return
+
+    labelled_images = find_labelled_images("real" if args.site else "sim")
+    if args.max_images:
+        labelled_images = labelled_images[:args.max_images]
+    if not labelled_images:
+        print("Error: no labelled images found to evaluate with")
+        sys.exit(1)
+
+    results = {}
+    for variant in [''] + [v for v, _ in variants]:
+        if variant:
+            classifier = TLClassifier(is_site=args.site, model_variant=variant)
+        name = variant or 'original'
+        print("Evaluating %s on %d images..." % (name, len(labelled_images)))
+        results[name] = evaluate(classifier, labelled_images)
+        results[name]['size_mb'] = os.path.getsize(
+            model_variant_filename(model_filename, variant) if variant else model_filename) / 1e6
+        classifier.sess.close()
+
+    print("\n%-10s %8s %10s %10s %10s %9s" % ("variant", "size MB", "mean ms", "p50 ms", "p95 ms", "accuracy"))
+    for name in sorted(results):
+        r = results[name]
+        print("%-10s %8.1f %10.1f %10.1f %10.1f %9.3f" % (name, r['size_mb'], r['latency_mean_ms'],
+                  r['latency_p50_ms'], r['latency_p95_ms'], r['accuracy']))
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,168 @@
+###############################################################################
+#   Udacity self-driving car course : Capstone Project.
+#
+#   Team   : smart-carla
+#
+#   Tests of the out-of-process classifier service: a ClassifierServer with
+#   stand-in classifiers (so neither ROS nor TensorFlow is needed) and a
+#   ClassifierClient talking to it over a real socket and shared memory.
+#   Run with e.g.
+#     python -m pytest test/   or   python -m unittest discover test
+###############################################################################
+
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from light_classification.classifier_service import ClassifierServer, ClassifierClient, UNKNOWN
+
+RED, GREEN = 0, 2
+
+class StandInClassifier(object):
+    """Calls a bright frame RED and a dark one GREEN after a delay, keeping
+       count of how many classifications run at once across all workers"""
+
+    def __init__(self, delay, activity, warm_up_latency=None):
+        self.delay = delay
+        self.activity = activity
+        self.last_scores = None
+        self.last_timings = {}
+        self.last_detection = None
+        if warm_up_latency is not None:
+            self.warm_up_latencies = [warm_up_latency]
+
+    def get_classification(self, image, rgb=False, max_size=None):
+        with self.activity['lock']:
+            self.activity['running'] += 1
+            self.activity['most_running'] = max(self.activity['most_running'], self.activity['running'])
+        try:
+            time.sleep(self.delay)
+            state = RED if image.mean() > 127 else GREEN
+            self.last_scores = [1.0 if i == state else 0.0 for i in range(4)]
+            return state
+        finally:
+            with self.activity['lock']:
+                self.activity['running'] -= 1
+
+class ClassifierServiceTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.socket_path = os.path.join(self.directory, "classifier.sock")
+        self.activity = {'lock': threading.Lock(), 'running': 0, 'most_running': 0}
+        self.server = None
+        self.clients = []
+
+    def tearDown(self):
+        for client in self.clients:
+            client.close()
+        if self.server:
+            self.server.stop()
+        shutil.rmtree(self.directory)
+
+    def start_server(self, delay=0.0, workers=1, max_queue=8, warm_up_latency=None):
+        def make_classifier(progress_cb):
+            return StandInClassifier(delay, self.activity, warm_up_latency)
+        self.server = ClassifierServer(self.socket_path, make_classifier, workers=workers,
+                                       max_queue=max_queue)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def make_client(self, timeout=1.0, max_in_flight=4):
+        client = ClassifierClient(self.socket_path, timeout=timeout, max_in_flight=max_in_flight,
+                                  ring_path=os.path.join(self.directory, "ring"),
+                                  reconnect_interval=0.05)
+        self.clients.append(client)
+        self.assertTrue(client.wait_until_ready(5.0, poll_interval=0.05))
+        return client
+
+    def wait_for_idle_server(self, client):
+        give_up = time.time() + 5.0
+        while time.time() < give_up:
+            health = client.get_health()
+            if health and health['in_progress'] == 0 and health['queue_depth'] == 0:
+                return health
+            time.sleep(0.05)
+        self.fail("server still busy")
+
+    def test_classifies_frames(self):
+        self.start_server()
+        client = self.make_client()
+        bright = np.full((60, 80, 3), 255, dtype=np.uint8)
+        dark = np.zeros((60, 80, 3), dtype=np.uint8)
+        self.assertEqual(client.get_classification(bright), RED)
+        self.assertEqual(client.last_scores, [1.0, 0.0, 0.0, 0.0])
+        self.assertEqual(client.get_classification(dark), GREEN)
+        self.assertEqual(client.counts['requests'], 2)
+        self.assertEqual(client.counts['timeouts'], 0)
+        self.assertEqual(self.wait_for_idle_server(client)['completed'], 2)
+
+    def test_timeout_gives_unknown(self):
+        self.start_server(delay=0.5)
+        client = self.make_client(timeout=0.1)
+        tic = time.time()
+        state = client.get_classification(np.zeros((60, 80, 3), dtype=np.uint8))
+        self.assertLess(time.time() - tic, 0.4)
+        self.assertEqual(state, UNKNOWN)
+        self.assertEqual(client.last_scores, [0.25] * 4)
+        self.assertEqual(client.counts['timeouts'], 1)
+        # Server finishes it anyway, and its worker is then free again
+        self.assertEqual(self.wait_for_idle_server(client)['in_progress'], 0)
+
+    def test_workers_classify_concurrently(self):
+        workers, frames, delay = 3, 6, 0.2
+        self.start_server(delay=delay, workers=workers)
+        client = self.make_client(timeout=5.0, max_in_flight=frames)
+        images = [np.full((60, 80, 3), 255 * (i % 2), dtype=np.uint8) for i in range(frames)]
+        tic = time.time()
+        states, _ = client.get_classification_batch(images)
+        elapsed = time.time() - tic
+        self.assertEqual(states, [GREEN if i % 2 == 0 else RED for i in range(frames)])
+        self.assertEqual(self.activity['most_running'], workers)
+        # Two rounds of three at once, rather than six one after another
+        self.assertLess(elapsed, frames * delay * 0.6)
+        health = self.wait_for_idle_server(client)
+        self.assertEqual(health['completed'], frames)
+        self.assertEqual(health['in_progress'], 0)
+
+    def test_overload_turned_away_as_busy(self):
+        self.start_server(delay=0.5, workers=1, max_queue=1)
+        client = self.make_client(timeout=2.0, max_in_flight=4)
+        image = np.zeros((60, 80, 3), dtype=np.uint8)
+        requests = [client.submit(image)]
+        while self.server.in_progress == 0:
+            time.sleep(0.01) # until the worker is busy with the first
+        requests += [client.submit(image) for _ in range(3)]
+        replies = [client.result(request_id, deadline) for request_id, deadline in requests]
+        # One classifying and one queued; the rest can't wait
+        self.assertEqual([reply.get('state', reply.get('error')) for reply in replies],
+                         [GREEN, GREEN, "busy", "busy"])
+        health = self.wait_for_idle_server(client)
+        self.assertEqual((health['busy'], health['completed']), (2, 2))
+
+    def test_server_down_gives_unknown(self):
+        client = ClassifierClient(self.socket_path, timeout=0.2,
+                                  ring_path=os.path.join(self.directory, "ring"))
+        self.clients.append(client)
+        self.assertEqual(client.get_classification(np.zeros((60, 80, 3), dtype=np.uint8)), UNKNOWN)
+        self.assertEqual(client.counts['disconnected'], 1)
+
+    def test_timeout_fitted_to_classification_time(self):
+        self.start_server(delay=0.3, workers=1, warm_up_latency=0.3)
+        client = self.make_client(timeout=None, max_in_flight=2)
+        # Two requests queue for the one worker, so allow for both
+        self.assertGreater(client.timeout, 2 * 0.3)
+        states, _ = client.get_classification_batch([np.zeros((60, 80, 3), dtype=np.uint8)] * 2)
+        self.assertEqual(states, [GREEN, GREEN])
+        self.assertEqual(client.counts['timeouts'], 0)
+
+if __name__ == '__main__':
+    unittest.main()
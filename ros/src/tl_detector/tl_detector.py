@@ -1,12 +1,24 @@
 #!/usr/bin/env python
 import rospy
-from std_msgs.msg import Int32
-from geometry_msgs.msg import PoseStamped, Pose
+from std_msgs.msg import Int32, String
+from geometry_msgs.msg import PoseStamped, Pose, TwistStamped
 from styx_msgs.msg import TrafficLightArray, TrafficLight
-from styx_msgs.msg import Lane
+from styx_msgs.msg import Lane, SharedImage
+from styx_msgs.srv import SwapClassifier, SwapClassifierResponse
 from sensor_msgs.msg import Image
 from cv_bridge import CvBridge
-from light_classification.tl_classifier import TLClassifier
+from light_classification.tl_classifier import TLClassifier, scores_from_confidence, SCORE_STATES
+from light_classification.light_state_filter import LightStateFilter
+from light_classification.preprocess import image_from_msg
+from light_classification.light_tracker import LightTracker
+from light_classification.latency_stats import LatencyStats
+from light_classification.capture_writer import CaptureWriter
+from light_classification.scene_cache import SceneCache
+from light_classification.classification_scheduler import ClassificationScheduler
+from light_classification.classifier_service import (ClassifierClient, DEFAULT_SOCKET_PATH,
+                                                     peak_rss_mb, rss_mb)
+from light_classification.shadow_evaluator import ShadowEvaluator
+from light_classification.light_phase_estimator import LightPhaseEstimator
 from scipy.spatial import KDTree
 import tf
 import cv2
@@ -14,18 +26,61 @@ import math
 import yaml
 import sys # for debug output
 import time
+import threading
+import bisect
+import gc
+import json
+import os
+import subprocess
+
+# Shared memory image transport from the styx bridge
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'styx'))
+from image_ring import ImageRingReader
 
 STATE_COUNT_THRESHOLD = 3
 
+class LatestFrameMailbox(object):
+    """One-slot mailbox between the image callback and the inference worker.
+       Posting a new frame simply replaces any frame not yet taken, so the
+       worker always gets the newest image and stale ones are never queued."""
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.frame = None
+        self.frames_posted = 0
+        self.frames_overwritten = 0
+
+    def post(self, frame):
+        with self.cond:
+            if self.frame is not None:
+                # Worker hasn't got round to the previous one, just drop it
+                self.frames_overwritten += 1
+            self.frame = frame
+            self.frames_posted += 1
+            self.cond.notify()
+
+    def take(self, timeout=None):
+        """Waits for and removes the newest frame, or returns None on timeout"""
+        with self.cond:
+            if self.frame is None:
+                self.cond.wait(timeout)
+            frame = self.frame
+            self.frame = None
+            return frame
+
 class TLDetector(object):
     def __init__(self):
         rospy.init_node('tl_detector')
 
         self.pose = None
+        self.velocity = None
         self.waypoints = None
         self.waypoints_2d = None
         self.waypoints_tree = None
+        self.stop_line_wp_idxs = []  # sorted waypoint indices of stop lines...
+        self.stop_line_order = []    # ...and the stop_line_positions index of each
         self.camera_image = None
+        self.has_image = False
         self.lights = []
         self.light_classifier = None # until ready
         
@@ -41,7 +96,14 @@ class TLDetector(object):
         self.image_grab_last_light = None      # Identify which light we were approaching last time
         self.image_grab_last_distance = 0      # Distance from light last time
         self.real_image_grab_decimator = 20    # Only grab fraction of real images
-        
+        self.capture_writer = None
+
+        # Shadow mode: drive on the simulator's ground truth, as above, but also
+        # run the classifier on a separate thread as fast as it can keep up,
+        # scoring it against the ground truth without affecting what we publish
+        self.shadow_mode = rospy.get_param('~shadow_mode', False)
+        if self.shadow_mode:
+            self.stub_return_ground_truth = True
 
         # Moved most initialisations before subscribers set up so they don't fire
         # before we are ready
@@ -51,27 +113,192 @@ class TLDetector(object):
         self.last_wp = -1
         self.state_count = 0
 
+        # Bayesian filter on light state, replacing the STATE_COUNT_THRESHOLD
+        # debounce (which is still used if this is turned off)
+        if rospy.get_param('~state_filter', True):
+            self.state_filter = LightStateFilter(
+                confidence=rospy.get_param('~state_filter_confidence', 0.8))
+        else:
+            self.state_filter = None
+        self.filter_light_idx = None
+        self.filter_update_time = None
+        self.light_scores = None
+
         config_string = rospy.get_param("/traffic_light_config")
         self.config = yaml.load(config_string)
 
+        # Visibility gate: don't bother running the classifier when the next
+        # light is too far away or outside the camera's field of view
+        self.light_visible_max_distance = rospy.get_param('~light_visible_max_distance', 100.)
+        self.light_visible_fov_margin = math.radians(rospy.get_param('~light_visible_fov_margin_deg', 5.))
+        self.camera_half_fov = self.get_camera_half_fov(
+                                   self.config.get('camera_info', {}),
+                                   math.radians(rospy.get_param('~camera_fov_deg', 90.)))
+        self.frames_gated = 0
+
+        # Stale frame policy, all in ROS time from image header stamps so it holds
+        # when bags are replayed faster or slower than real time: a frame is
+        # skipped if it is already too old for its result to be published within
+        # ~max_frame_age, given how long classifying it is expected to take
+        self.max_frame_age = rospy.get_param('~max_frame_age', 0.5)
+        self.max_frame_age_inference_factor = rospy.get_param('~max_frame_age_inference_factor', 2.0)
+        self.max_consecutive_stale_drops = rospy.get_param('~max_consecutive_stale_drops', 5)
+        self.expected_classification_time = 0.0 # moving average, seconds of ROS time
+        self.consecutive_stale_drops = 0
+        # Shared memory frames are copied out of the ring as soon as the worker
+        # takes them; if they keep being overwritten first, settle for the newer
+        # frame that took the slot after this many drops in a row
+        self.max_consecutive_shared_drops = rospy.get_param('~max_consecutive_shared_drops', 3)
+        self.consecutive_shared_drops = 0
+        self.camera_frame = None # (image, is RGB) copied out of shared memory
+
+        # Region-of-interest mode: project the light's 3D position into the image
+        # and classify only a box around it. Needs a camera model (focal lengths),
+        # which only the site config has; otherwise we always use the full frame.
+        self.classify_roi = rospy.get_param('~classify_roi', False)
+        self.roi_light_height = rospy.get_param('~roi_light_height', 1.0)  # metres
+        self.roi_margin_factor = rospy.get_param('~roi_margin_factor', 3.0)
+        self.roi_min_size = rospy.get_param('~roi_min_size', 64)           # pixels
+
+        # Tracking mode: once the detector has found the light, classify only a
+        # crop round where our own motion says it should now be, with a full
+        # frame detection every so often or whenever we lose it
+        if rospy.get_param('~track_lights', False):
+            self.light_tracker = LightTracker(
+                redetect_interval=rospy.get_param('~track_redetect_interval', 10),
+                min_score=rospy.get_param('~track_min_score', 0.7),
+                focal_length_x=self.config.get('camera_info', {}).get('focal_length_x'))
+        else:
+            self.light_tracker = None
+        self.closest_light_idx = None # stop_line_positions index of light we're approaching
+
+        # Stationary scene cache: while we're stopped and the camera sees the same
+        # thing, reuse the last classification for up to ~scene_cache_max_age seconds
+        if rospy.get_param('~scene_cache', False):
+            self.scene_cache = SceneCache(
+                max_age=rospy.get_param('~scene_cache_max_age', 1.0),
+                max_speed=rospy.get_param('~scene_cache_max_speed', 0.2),
+                max_difference=rospy.get_param('~scene_cache_max_difference', 20.0))
+        else:
+            self.scene_cache = None
+        # Crop boxes are snapped out to this many pixels while the cache is on
+        self.scene_cache_roi_grid = rospy.get_param('~scene_cache_roi_grid', 16)
+
+        # Adaptive rate: classify rarely while the light is far off or we're
+        # stopped, every frame inside the braking envelope, and use a smaller
+        # input image the closer the light is
+        if rospy.get_param('~adaptive_rate', False):
+            self.classification_scheduler = ClassificationScheduler(
+                decel=rospy.get_param('~schedule_decel', 3.0),
+                reaction_time=rospy.get_param('~schedule_reaction_time', 0.5),
+                min_looks=rospy.get_param('~schedule_min_looks', 3),
+                max_interval=rospy.get_param('~schedule_max_interval', 2.0),
+                stopped_interval=rospy.get_param('~schedule_stopped_interval', 0.5),
+                pyramid=rospy.get_param('~resolution_pyramid', None),
+                phase_max_interval=rospy.get_param('~phase_max_interval', 1.0))
+        else:
+            self.classification_scheduler = None
+
+        # Learnt timing of each light's cycle, so that the scheduler can look
+        # only occasionally while no change of light is due
+        self.phase_estimator = None
+        if self.classification_scheduler and rospy.get_param('~phase_estimator', False):
+            self.phase_estimator = LightPhaseEstimator(margin=rospy.get_param('~phase_margin', 1.0),
+                                                       max_gap=rospy.get_param('~phase_max_gap', 3.0))
+            # Stop line indices differ between sim and site
+            self.phase_estimator_file = os.path.expanduser(rospy.get_param('~phase_estimator_file',
+                "~/.ros/tl_phase_%s.json" % ("site" if rospy.get_param('~is_site', False) else "sim")))
+            try:
+                if self.phase_estimator.load(self.phase_estimator_file):
+                    rospy.loginfo("tl_detector: light cycle timings loaded from %s" % self.phase_estimator_file)
+            except (IOError, OSError, ValueError, KeyError) as e:
+                rospy.logwarn("tl_detector: ignoring light cycle timings in %s: %s" %
+                              (self.phase_estimator_file, repr(e)))
+            # Saved from a timer and at shutdown rather than on the image
+            # thread, as the write to disk can take a while
+            self.light_phases_lock = threading.Lock()
+            self.light_phases_learnt = False
+            self.light_phases_timer = rospy.Timer(rospy.Duration(rospy.get_param('~phase_save_period', 30.0)),
+                                                  self.save_light_phases)
+            rospy.on_shutdown(self.save_light_phases)
+        self.light_state_observed = False
+        self.light_gated = False # light couldn't be in view, so wasn't classified
+        self.decided_state = None # state of this frame's light, once filter or debounce is sure
+        self.schedule_light_idx = None
+        self.stop_line_distance = None # to stop line of light we're approaching, metres
+
         self.upcoming_red_light_pub = rospy.Publisher('/traffic_waypoint', Int32, queue_size=1)
 
         self.bridge = CvBridge()
         self.listener = tf.TransformListener()
 
+        if self.grab_training_images:
+            # Images are encoded and saved on a background thread, and dropped
+            # rather than holding us up if it can't keep up
+            self.capture_writer = CaptureWriter("../../../data/training_images/",
+                                      sharded=rospy.get_param('~capture_shards', True),
+                                      records_per_shard=rospy.get_param('~capture_records_per_shard', 500),
+                                      queue_size=rospy.get_param('~capture_queue_size', 32))
+            rospy.on_shutdown(self.capture_writer.close)
+
         # OK to set up waypoints
         sub2 = rospy.Subscriber('/base_waypoints', Lane, self.waypoints_cb)
 
-        # Load model last because this is slow, so that at least other initialisations
-        # likely to have finished before callbacks start firing
-        self.last_classify_time = time.time()
-        if not self.stub_return_ground_truth:
-            self.light_classifier = TLClassifier()
-            print("Debug: light classifier initialised")
+        # Model loading is slow, so it's done on a background thread while we carry
+        # on setting up; until it's ready we publish -1 (no red light known), and
+        # report loading progress on a latched status topic
+        self.light_classifier = None
+        self.classifier_status_pub = rospy.Publisher('~classifier_status', String,
+                                                     queue_size=1, latch=True)
+
+        # Rolling latency of each processing stage and frame counts, summarised
+        # as JSON on a diagnostics topic every ~diagnostics_period seconds
+        self.latency_stats = LatencyStats(window=rospy.get_param('~latency_window', 200))
+        self.diagnostics_pub = rospy.Publisher('~diagnostics', String, queue_size=1)
+
+        # Handover of a classifier loaded by the ~swap_classifier service to the
+        # thread using the classifier, which may start below
+        self.pending_classifier = None   # loaded and waiting to be swapped in...
+        self.retired_classifier = None   # ...and the one it replaced
+        self.pending_lock = threading.Lock()
+        self.classifier_swapped = threading.Event()
+        self.swap_lock = threading.Lock()
+        self.swap_timeout = rospy.get_param('~classifier_swap_timeout', 10.0)
+        if self.shadow_mode:
+            self.shadow_evaluator = ShadowEvaluator(window=rospy.get_param('~latency_window', 200))
+            self.shadow_metrics_pub = rospy.Publisher('~shadow_metrics', String, queue_size=1)
+            self.shadow_mailbox = LatestFrameMailbox()
+            self.shadow_thread = threading.Thread(target=self.shadow_loop, name="tl_shadow")
+            self.shadow_thread.daemon = True
+            self.shadow_thread.start()
+            rospy.on_shutdown(self.report_shadow_metrics)
+        # Model used at first; the ~swap_classifier service can change it later
+        self.classifier_config = {'classifier': rospy.get_param('~classifier', 'FRCNN'),
+                                  'is_site': rospy.get_param('~is_site', False),
+                                  'model_variant': rospy.get_param('~model_variant', '')}
+        self.classifier_server_count = 0
+        self.classifier_server_counts = (None, None) # (client, its counts) at the last diagnostics
+        rospy.on_shutdown(self.close_classifier_server)
+        if not self.stub_return_ground_truth or self.shadow_mode:
+            self.classifier_load_thread = threading.Thread(target=self.load_classifier,
+                                                           name="tl_classifier_load")
+            self.classifier_load_thread.daemon = True
+            self.classifier_load_thread.start()
         else:
-            self.light_classifier = None
+            self.publish_classifier_status("not required")
             print("Debug: skipping classifier model construction, using simulator light states")        
         
+        # Classification runs on its own thread so the subscriber thread only
+        # has to swap the frame pointer, however long the model takes; started
+        # before subscribing so that the first image has somewhere to go
+        self.frame_mailbox = LatestFrameMailbox()
+        self.inference_thread = threading.Thread(target=self.inference_loop,
+                                                 name="tl_inference")
+        self.inference_thread.daemon = True
+        self.inference_thread.start()
+
+        self.image_rings = {} # ring file path -> ImageRingReader, for shared memory frames
+
         '''
         /vehicle/traffic_lights provides you with the location of the traffic light in 3D map space and
         helps you acquire an accurate ground truth data source for the traffic light
@@ -83,6 +310,7 @@ class TLDetector(object):
         sub3 = rospy.Subscriber('/vehicle/traffic_lights', TrafficLightArray, self.traffic_cb)
         
         sub1 = rospy.Subscriber('/current_pose', PoseStamped, self.pose_cb)
+        sub4 = rospy.Subscriber('/current_velocity', TwistStamped, self.velocity_cb)
 
         # Walkthrough video ~2 mins:
         # /image_color is camera data, but might alternatively want to use image_raw instead
@@ -90,45 +318,490 @@ class TLDetector(object):
         # the classifier easier
         # Queue size set to 1 to avoid backlog as we are likely to be slow in processing
         self.debug_show_encoding = True
-        sub6 = rospy.Subscriber('/image_color', Image, self.image_cb, queue_size=1)
+        if rospy.get_param('/camera_shared_memory', False):
+            # Bridge leaves frames in shared memory and just tells us where
+            sub6 = rospy.Subscriber('/image_color_shm', SharedImage, self.image_cb, queue_size=1)
+        else:
+            sub6 = rospy.Subscriber('/image_color', Image, self.image_cb, queue_size=1)
+
+        self.diagnostics_timer = rospy.Timer(rospy.Duration(rospy.get_param('~diagnostics_period', 1.0)),
+                                             self.publish_diagnostics)
+
+        # Change model while running, e.g.
+        #   rosservice call /tl_detector/swap_classifier FRCNN true optimised
+        self.swap_service = rospy.Service('~swap_classifier', SwapClassifier, self.swap_classifier_cb)
 
         rospy.spin()
 
+    def load_classifier(self):
+        """Background thread: constructs the classifier, reporting progress"""
+        tic = time.time()
+        self.publish_classifier_status("loading")
+        try:
+            light_classifier = self.make_classifier(self.classifier_config, self.publish_classifier_status)
+        except Exception as e:
+            rospy.logerr("tl_detector: failed to load light classifier: %s" % repr(e))
+            self.publish_classifier_status("failed", time.time() - tic)
+            return
+        # Only start using it once it is fully warmed up
+        self.light_classifier = light_classifier
+        self.publish_classifier_status("ready", time.time() - tic)
+        rospy.loginfo("tl_detector: light classifier ready after %.1f s" % (time.time() - tic))
+
+    def make_classifier(self, config, progress_cb):
+        """Constructs and warms up a classifier, in this process or (with
+           ~classifier_server) in a server process of its own
+
+        Args:
+            config (dict): 'classifier', 'is_site' and 'model_variant' to use;
+                           other settings come from our parameters
+            progress_cb (function): called with name of each loading stage
+
+        Returns:
+            TLClassifier or ClassifierClient: ready to use
+        """
+        if rospy.get_param('~classifier_server', False):
+            return self.start_classifier_server(config, progress_cb)
+        return TLClassifier(is_site=config['is_site'],
+                            model_variant=config['model_variant'],
+                            classifier=config['classifier'],
+                            cascade_confidence=rospy.get_param('~cascade_confidence', 0.9),
+                            intra_op_threads=rospy.get_param('~intra_op_threads', 0),
+                            inter_op_threads=rospy.get_param('~inter_op_threads', 0),
+                            cpu_affinity=rospy.get_param('~cpu_affinity', []),
+                            warm_up=rospy.get_param('~classifier_warm_up', True),
+                            progress_cb=progress_cb)
+
+    def start_classifier_server(self, config, progress_cb):
+        """Runs the classifier in its own process (see classifier_server.py),
+           so inference doesn't compete with our callbacks for the interpreter,
+           and waits for it to load
+
+        Returns:
+            ClassifierClient: connected to the server, and stopping it when closed
+        """
+        socket_path = rospy.get_param('~classifier_server_socket', DEFAULT_SOCKET_PATH)
+        server_process = None
+        if rospy.get_param('~classifier_server_spawn', True):
+            # Otherwise connect to one already running, e.g. started by hand
+            self.classifier_server_count += 1
+            if self.classifier_server_count > 1:
+                # Old one keeps serving until the new one is ready
+                socket_path = "%s_%d" % (socket_path, self.classifier_server_count)
+            server_args = [sys.executable,
+                           os.path.join(os.path.dirname(os.path.abspath(__file__)), 'classifier_server.py'),
+                           '--socket', socket_path,
+                           '--classifier', config['classifier'],
+                           '--model-variant', config['model_variant'],
+                           '--cascade-confidence', str(rospy.get_param('~cascade_confidence', 0.9)),
+                           '--intra-op-threads', str(rospy.get_param('~intra_op_threads', 0)),
+                           '--inter-op-threads', str(rospy.get_param('~inter_op_threads', 0)),
+                           '--cpu-affinity', ','.join(str(cpu) for cpu in
+                                                      rospy.get_param('~cpu_affinity', [])),
+                           '--workers', str(rospy.get_param('~classifier_server_workers', 1))]
+            if config['is_site']:
+                server_args.append('--site')
+            if not rospy.get_param('~classifier_warm_up', True):
+                server_args.append('--no-warm-up')
+            server_process = subprocess.Popen(server_args, cwd=os.path.dirname(server_args[1]))
+        elif self.light_classifier:
+            raise ValueError("can't change the model of a classifier server we didn't start")
+
+        # 0 to fit the timeout to how long the server takes once it's loaded
+        client = ClassifierClient(socket_path,
+                                  timeout=rospy.get_param('~classifier_server_timeout', 0.0),
+                                  max_in_flight=rospy.get_param('~classifier_server_max_in_flight', 4),
+                                  server_process=server_process)
+        if not client.wait_until_ready(rospy.get_param('~classifier_server_ready_timeout', 300.0),
+                                       progress_cb=progress_cb):
+            client.close()
+            raise RuntimeError("classifier server at %s failed to load" % socket_path)
+        rospy.loginfo("tl_detector: classifier server at %s ready, timeout %.2f s" %
+                      (socket_path, client.timeout))
+        return client
+
+    def close_classifier_server(self):
+        """At shutdown: stops the classifier server, if we're using one"""
+        if isinstance(self.light_classifier, ClassifierClient):
+            self.light_classifier.close()
+
+    def swap_classifier_cb(self, request):
+        """Service: loads another model alongside the current one, warms it up,
+           switches to it between frames and then releases the old one, so
+           there is no gap in perception
+
+        Args:
+            request (SwapClassifierRequest): model to change to
+
+        Returns:
+            SwapClassifierResponse: success, timings and memory use
+        """
+        if not self.swap_lock.acquire(False):
+            return SwapClassifierResponse(success=False, message="swap already in progress")
+        try:
+            return self.swap_classifier(request)
+        finally:
+            self.swap_lock.release()
+
+    def swap_classifier(self, request):
+        config = dict(self.classifier_config)
+        if request.classifier:
+            config['classifier'] = request.classifier
+        config['is_site'] = request.is_site
+        config['model_variant'] = request.model_variant
+        if not self.light_classifier:
+            return SwapClassifierResponse(success=False, message="no classifier loaded yet")
+        if config['classifier'] not in ("FRCNN", "VGG", "COLOUR", "CASCADE"):
+            return SwapClassifierResponse(success=False,
+                                          message="unknown classifier %s" % config['classifier'])
+
+        def report_progress(stage):
+            # Current classifier carries on meanwhile, so we're still ready
+            self.publish_classifier_status("ready", swap_stage=stage)
+
+        tic = time.time()
+        rospy.loginfo("tl_detector: loading %s classifier to swap in" % json.dumps(config, sort_keys=True))
+        try:
+            new_classifier = self.make_classifier(config, report_progress)
+        except Exception as e:
+            rospy.logerr("tl_detector: failed to load classifier to swap in: %s" % repr(e))
+            report_progress("failed")
+            return SwapClassifierResponse(success=False, message="failed to load: %s" % repr(e))
+        load_time = time.time() - tic
+
+        # Thread using the classifier picks it up between frames (within its
+        # 0.5 s take() timeout even if no frames are coming)
+        self.classifier_swapped.clear()
+        self.pending_classifier = new_classifier
+        give_up = time.time() + self.swap_timeout
+        while not self.classifier_swapped.wait(0.5):
+            if rospy.is_shutdown() or time.time() > give_up:
+                with self.pending_lock:
+                    taken = self.pending_classifier is None
+                    self.pending_classifier = None
+                if taken:
+                    break # just in time
+                # Thread using the classifier is stuck or gone, so back out
+                new_classifier.close()
+                report_progress("failed")
+                if rospy.is_shutdown():
+                    return SwapClassifierResponse(success=False, message="shutting down")
+                return SwapClassifierResponse(success=False,
+                                              message="classifier not picked up within %.1f s" %
+                                                      self.swap_timeout)
+        swap_time = time.time() - tic
+        self.classifier_config = config
+
+        toc = time.time()
+        old_classifier = self.retired_classifier
+        self.retired_classifier = None
+        old_classifier.close()
+        del old_classifier
+        gc.collect()
+        release_time = time.time() - toc
+
+        if isinstance(new_classifier, ClassifierClient):
+            # Memory of interest is the server's
+            health = new_classifier.get_health() or {}
+            peak_rss, rss = health.get('peak_rss_mb'), health.get('rss_mb')
+        else:
+            peak_rss, rss = peak_rss_mb(), rss_mb()
+        message = ("swapped to %s in %.2f s (loading %.2f s), old model released in %.2f s, "
+                   "peak RSS %.0f MB, now %.0f MB" % (json.dumps(config, sort_keys=True), swap_time,
+                                                      load_time, release_time, peak_rss or 0.0, rss or 0.0))
+        rospy.loginfo("tl_detector: " + message)
+        self.publish_classifier_status("ready", swap_time, swap_stage="swapped", config=config)
+        return SwapClassifierResponse(success=True, message=message, load_time=load_time,
+                                      swap_time=swap_time, release_time=release_time,
+                                      peak_rss_mb=peak_rss or 0.0, rss_mb=rss or 0.0)
+
+    def apply_pending_classifier(self):
+        """Switches to a classifier loaded by swap_classifier(), if any; called
+           between frames by the thread that uses the classifier"""
+        with self.pending_lock:
+            if self.pending_classifier is None:
+                return
+            self.retired_classifier = self.light_classifier
+            self.light_classifier = self.pending_classifier
+            self.pending_classifier = None
+        # What was learnt about the old model doesn't apply to the new one
+        self.expected_classification_time = 0.0
+        if self.scene_cache:
+            self.scene_cache.reset()
+        if self.light_tracker:
+            self.light_tracker.reset()
+        self.classifier_swapped.set()
+
+    def publish_classifier_status(self, stage, load_time=None, **extra):
+        """Publishes classifier loading stage (and total load time once
+           finished), and anything else given, e.g. the stage of a model swap"""
+        status = {'ready': stage == "ready", 'stage': stage}
+        if load_time is not None:
+            status['load_time'] = load_time
+        status.update(extra)
+        self.classifier_status_pub.publish(String(json.dumps(status)))
+
+    def publish_diagnostics(self, event=None):
+        """Timer callback: publishes latency percentiles of each stage and frame counts"""
+        diagnostics = self.latency_stats.summary()
+        diagnostics['counts'].update({'frames_received': self.frame_mailbox.frames_posted,
+                                      'frames_dropped_superseded': self.frame_mailbox.frames_overwritten,
+                                      'frames_gated': self.frames_gated})
+        diagnostics['frame_age_budget'] = self.get_frame_age_budget()
+        diagnostics['expected_classification_time'] = self.expected_classification_time
+        if isinstance(self.light_classifier, ClassifierClient):
+            # Health from last time; the answer to this request turns up for next time
+            diagnostics['classifier_server'] = {'client': dict(self.light_classifier.counts),
+                                                'server': self.light_classifier.last_health}
+            server_process = self.light_classifier.server_process
+            if server_process and server_process.poll() is not None:
+                diagnostics['classifier_server']['exit_code'] = server_process.returncode
+            self.light_classifier.request_health()
+            self.check_classifier_server_timeouts(self.light_classifier)
+        elif getattr(self.light_classifier, 'classifier', None) == "CASCADE":
+            # How often the colour classifier is unsure enough to escalate,
+            # for tuning ~cascade_confidence (server cascade stats are in its health)
+            diagnostics['cascade'] = self.light_classifier.get_cascade_stats()
+        if self.phase_estimator:
+            with self.light_phases_lock:
+                diagnostics['light_cycle_durations'] = self.phase_estimator.summary()
+        if self.shadow_mode:
+            self.shadow_metrics_pub.publish(String(json.dumps(self.get_shadow_metrics())))
+        self.diagnostics_pub.publish(String(json.dumps(diagnostics)))
+
+    def check_classifier_server_timeouts(self, client):
+        """Warns if most requests since last time timed out, i.e. became UNKNOWN"""
+        previous_client, previous_counts = self.classifier_server_counts
+        self.classifier_server_counts = (client, dict(client.counts))
+        if previous_client is not client:
+            return
+        requests = client.counts['requests'] - previous_counts['requests']
+        timeouts = client.counts['timeouts'] - previous_counts['timeouts']
+        if requests and timeouts * 2 > requests:
+            rospy.logwarn_throttle(30.0, "tl_detector: %d of %d classifier server requests timed out "
+                                         "after %.2f s, try raising ~classifier_server_timeout "
+                                         "(mean classification time %s s)" %
+                                   (timeouts, requests, client.timeout,
+                                    (client.last_health or {}).get('mean_classification_time')))
+
+    def get_shadow_metrics(self):
+        """Shadow classifier accuracy and latency so far, and frames it skipped"""
+        metrics = self.shadow_evaluator.summary()
+        metrics['frames_offered'] = self.shadow_mailbox.frames_posted
+        # Newer frame came along before the classifier was free for this one
+        metrics['frames_superseded'] = self.shadow_mailbox.frames_overwritten
+        return metrics
+
+    def report_shadow_metrics(self):
+        """At shutdown: logs the final shadow metrics, and saves them to
+           ~shadow_metrics_file if set"""
+        metrics = self.get_shadow_metrics()
+        rospy.loginfo("tl_detector: shadow classifier agreed with ground truth on %s of %d frames, "
+                      "%d red lights missed, %d false reds" %
+                      ("%.1f%%" % (100.0 * metrics['agreement']) if metrics['agreement'] is not None else "-",
+                       metrics['frames'], metrics['red_missed'], metrics['false_red']))
+        metrics_file = rospy.get_param('~shadow_metrics_file', '')
+        if metrics_file:
+            with open(metrics_file, 'w') as f:
+                json.dump(metrics, f, indent=2, sort_keys=True)
+
     def pose_cb(self, msg):
         self.pose = msg
 
+    def velocity_cb(self, msg):
+        self.velocity = msg
+
     def waypoints_cb(self, waypoints):
         self.waypoints = waypoints
         if not self.waypoints_2d:
             self.waypoints_2d = [[waypoint.pose.pose.position.x, waypoint.pose.pose.position.y] for waypoint in waypoints.waypoints]
             self.waypoints_tree = KDTree(self.waypoints_2d)
+            self.index_stop_lines()
+
+    def index_stop_lines(self):
+        """Maps each stop line to its nearest waypoint once, keeping the indices
+           sorted so the next one ahead can be found by bisection every frame"""
+        stop_line_wps = []
+        for i, line in enumerate(self.config['stop_line_positions']):
+            stop_line_wps.append((self.get_closest_waypoint(line[0], line[1]), i))
+        stop_line_wps.sort()
+        self.stop_line_order = [i for _, i in stop_line_wps]
+        self.stop_line_wp_idxs = [wp_idx for wp_idx, _ in stop_line_wps]
+
+    def get_next_stop_line(self, car_wp_idx):
+        """Finds the first stop line at or ahead of the given waypoint, wrapping
+           round to the start of the track after the last one
+
+        Args:
+            car_wp_idx (int): waypoint index of the car
+
+        Returns:
+            (int, int): index into stop_line_positions and waypoint index of
+                        that stop line, or (None, None) if there are none
+
+        """
+        if not self.stop_line_wp_idxs:
+            return None, None
+        pos = bisect.bisect_left(self.stop_line_wp_idxs, car_wp_idx)
+        if pos == len(self.stop_line_wp_idxs):
+            pos = 0 # loop track, so next one is first after the start
+        return self.stop_line_order[pos], self.stop_line_wp_idxs[pos]
 
     def traffic_cb(self, msg):
         self.lights = msg.lights
 
     def image_cb(self, msg):
-        """Identifies red lights in the incoming camera image and publishes the index
+        """Hands the incoming camera image to the inference worker. Only the
+            newest image is kept, so if the classifier is still busy with an
+            earlier frame, any frame it hasn't started yet is simply replaced.
+
+        Args:
+            msg (Image or SharedImage): image from car-mounted camera
+
+        """
+        self.frame_mailbox.post(msg)
+        if msg.header.stamp:
+            # Time from capture (or bridge publish) to arriving here
+            self.latency_stats.record('receive_age', rospy.get_time() - msg.header.stamp.to_sec())
+
+    def inference_loop(self):
+        """Worker thread: repeatedly takes the newest camera image and classifies it"""
+        while not rospy.is_shutdown():
+            try:
+                if not self.shadow_mode:
+                    self.apply_pending_classifier()
+                msg = self.frame_mailbox.take(timeout=0.5)
+                if msg is None:
+                    continue
+                self.process_image(msg)
+            except Exception as e:
+                # Keep the worker alive; one bad frame shouldn't stop detection
+                rospy.logerr("tl_detector: failed to process image: %s" % repr(e))
+
+    def shadow_loop(self):
+        """Shadow thread: classifies the newest frame offered by
+           submit_shadow_frame() and scores the result against ground truth"""
+        while not rospy.is_shutdown():
+            try:
+                self.apply_pending_classifier()
+                frame = self.shadow_mailbox.take(timeout=0.5)
+                if frame is None:
+                    continue
+                tic = time.time()
+                state = self.light_classifier.get_classification(frame['image'], frame['rgb'])
+                latency = time.time() - tic
+                lag = rospy.get_time() - frame['stamp'] if frame['stamp'] else None
+                self.shadow_evaluator.record(frame['true_state'], state, latency, lag, frame['distance'])
+                self.latency_stats.record('shadow_classification', latency)
+            except Exception as e:
+                rospy.logerr("tl_detector: shadow classification failed: %s" % repr(e))
+
+    def process_image(self, msg):
+        """Identifies red lights in the camera image and publishes the index
             of the waypoint closest to the red light's stop line to /traffic_waypoint
 
         Args:
             msg (Image): image from car-mounted camera
 
         """
+        if not self.stub_return_ground_truth and not self.light_classifier:
+            # Still loading; publish safe default so downstream nodes hear from us
+            self.latency_stats.count('frames_dropped_loading')
+            self.upcoming_red_light_pub.publish(Int32(self.last_wp))
+            return
+
+        tic = time.time()
+        if msg.header.stamp:
+            # Includes any wait for the worker to finish the previous frame
+            frame_age = rospy.get_time() - msg.header.stamp.to_sec()
+            self.latency_stats.record('frame_age', frame_age)
+            if (frame_age > self.get_frame_age_budget() and
+                    self.consecutive_stale_drops < self.max_consecutive_stale_drops):
+                # Too old to be worth classifying; a fresher one should be along
+                # soon (but don't skip so many in a row that we never publish)
+                self.consecutive_stale_drops += 1
+                self.latency_stats.count('frames_dropped_stale')
+                self.upcoming_red_light_pub.publish(Int32(self.last_wp))
+                return
+        self.consecutive_stale_drops = 0
+        self.camera_frame = None
+        if isinstance(msg, SharedImage):
+            # Take our own copy now, so that the bridge is free to reuse the
+            # slot however long classification takes
+            self.camera_frame = self.copy_shared_frame(
+                msg, self.consecutive_shared_drops >= self.max_consecutive_shared_drops)
+            if self.camera_frame is None:
+                self.consecutive_shared_drops += 1
+                rospy.logwarn_throttle(10.0, "tl_detector: shared memory frames overwritten before "
+                                             "they could be copied, try raising /camera_ring_slots")
+                self.upcoming_red_light_pub.publish(Int32(self.last_wp))
+                return
+            self.consecutive_shared_drops = 0
         self.has_image = True
         self.camera_image = msg
-        
-        if time.time() - self.last_classify_time < 0.1:
-            # CW: discard latest messages, which will have been queued some time ago
-            # just before we started last model run. Otherwise we end up processing
-            # historical messages. Note: since we set queue_size=1, I have not
-            # understood why this is still a problem (discarding just one queued
-            # message is not sufficient). Tried setting deadtime here to 0.01 sec
-            # but was too short, still seemed to end up processing some stale images.
-            #print("Debug: skipping queued image to flush")
-            return
-                
+
+        self.light_scores = None
         light_wp, state = self.process_traffic_lights()
-        self.last_classify_time = time.time()
+        if state is None:
+            # Not time to look at the light again yet
+            self.latency_stats.count('frames_skipped_schedule')
+            self.upcoming_red_light_pub.publish(Int32(self.last_wp))
+            return
+
+        toc = time.time()
+        self.publish_state(light_wp, state)
+        if self.phase_estimator and self.light_state_observed and self.decided_state is not None:
+            # Learn from the state we decided on, after filtering
+            with self.light_phases_lock:
+                if self.phase_estimator.observe(self.closest_light_idx, self.decided_state, rospy.get_time()):
+                    self.light_phases_learnt = True
+        self.latency_stats.record('publish', time.time() - toc)
+        self.latency_stats.record('total', time.time() - tic)
+
+    def save_light_phases(self, event=None):
+        """Saves light cycle timings learnt since the last save, so the next
+           run starts with them"""
+        with self.light_phases_lock:
+            if not self.light_phases_learnt:
+                return
+            saved_state = self.phase_estimator.get_saved_state()
+            self.light_phases_learnt = False
+        try:
+            self.phase_estimator.save(self.phase_estimator_file, saved_state)
+        except (IOError, OSError) as e:
+            rospy.logwarn("tl_detector: failed to save light cycle timings: %s" % repr(e))
+            with self.light_phases_lock:
+                self.light_phases_learnt = True # try again next time
+
+    def get_frame_age_budget(self):
+        """Oldest a frame may be when we start on it, in seconds: ~max_frame_age
+           less the time we expect classifying it to take, but never below a
+           multiple of that time, so that on a slow CPU we still classify
+           frames rather than dropping them all"""
+        expected = self.expected_classification_time
+        return max(self.max_frame_age - expected,
+                   (self.max_frame_age_inference_factor - 1.0) * expected)
+
+    def update_expected_classification_time(self, duration, smoothing=0.1):
+        """Moving average of classification time in ROS time"""
+        if self.expected_classification_time == 0.0:
+            self.expected_classification_time = duration
+        else:
+            self.expected_classification_time += smoothing * (duration - self.expected_classification_time)
+
+    def publish_state(self, light_wp, state):
+        """Publishes the red light waypoint from this frame's light state,
+            through the state filter or the debounce
+
+        Args:
+            light_wp (int): waypoint index of stop line of light we're approaching
+            state (int): classified light state (specified in styx_msgs/TrafficLight)
+
+        """
+        self.decided_state = None
+        if self.state_filter:
+            self.publish_filtered_state(light_wp, state)
+            return
 
         '''
         Publish upcoming red lights at camera frequency.
@@ -143,6 +816,7 @@ class TLDetector(object):
         elif self.state_count >= STATE_COUNT_THRESHOLD:
             # CW: in case classifier a bit noisy/unstable, debounce state
             self.last_state = self.state
+            self.decided_state = self.state
             # CW: only really interested in red lights, at which we must stop
             # (but could be more cautious and act if yellow)
             light_wp = light_wp if state == TrafficLight.RED else -1
@@ -152,6 +826,45 @@ class TLDetector(object):
             self.upcoming_red_light_pub.publish(Int32(self.last_wp))
         self.state_count += 1
 
+    def publish_filtered_state(self, light_wp, state):
+        """Updates the light state filter with this frame's classification and
+            publishes the red light waypoint once the filter is confident of the state
+
+        Args:
+            light_wp (int): waypoint index of stop line of light we're approaching
+            state (int): classified light state (specified in styx_msgs/TrafficLight)
+
+        """
+        if self.closest_light_idx != self.filter_light_idx:
+            # Different light now, so what we knew about the last one doesn't apply
+            self.state_filter.reset()
+            self.filter_light_idx = self.closest_light_idx
+
+        if self.light_gated:
+            # Not seeing the light tells us nothing about its state; feeding the
+            # filter UNKNOWN would make it doubt the first red once in view, so
+            # start afresh then instead, meanwhile reporting no red light
+            self.state_filter.reset()
+            self.filter_update_time = None
+            self.last_wp = -1
+            self.upcoming_red_light_pub.publish(Int32(self.last_wp))
+            return
+
+        now = rospy.get_time()
+        dt = now - self.filter_update_time if self.filter_update_time is not None else 0.0
+        self.filter_update_time = now
+
+        # Classifier scores if it ran this frame, else the state is certain
+        # (ground truth, or no light ahead)
+        scores = self.light_scores or scores_from_confidence(state, 1.0)
+        filtered_state = self.state_filter.update(scores, dt)
+        self.decided_state = filtered_state
+        if filtered_state is not None:
+            self.last_state = filtered_state
+            # CW: only really interested in red lights, at which we must stop
+            self.last_wp = light_wp if filtered_state == TrafficLight.RED else -1
+        self.upcoming_red_light_pub.publish(Int32(self.last_wp))
+
     def get_closest_waypoint(self, x, y):
         """Identifies the closest path waypoint to the given position
             https://en.wikipedia.org/wiki/Closest_pair_of_points_problem
@@ -172,6 +885,236 @@ class TLDetector(object):
         else:
             return 0
 
+    def get_camera_half_fov(self, camera_info, default_fov):
+        """Horizontal half field of view of the camera in radians, from the focal
+           length in the traffic light config if we have it (site), or else the
+           given default (the simulator config has no camera model)"""
+        if 'focal_length_x' in camera_info and 'image_width' in camera_info:
+            return math.atan2(camera_info['image_width'] / 2.0, camera_info['focal_length_x'])
+        else:
+            return default_fov / 2.0
+
+    def get_car_yaw(self):
+        """Our heading in radians from the current pose"""
+        orientation = self.pose.pose.orientation
+        _, _, car_yaw = tf.transformations.euler_from_quaternion(
+                             [orientation.x, orientation.y, orientation.z, orientation.w])
+        return car_yaw
+
+    def get_distance_to_light(self, light):
+        """Straight-line distance in metres from us to the light, or None if we
+           don't know where one or other is"""
+        light_pos = light.pose.pose.position
+        if not self.pose or (light_pos.x == 0 and light_pos.y == 0):
+            return None
+        return math.sqrt((light_pos.x - self.pose.pose.position.x) ** 2 +
+                         (light_pos.y - self.pose.pose.position.y) ** 2)
+
+    def light_possibly_visible(self, light, stop_line):
+        """Cheap check using pose and map geometry of whether the light we are
+           approaching could appear in the camera image at all
+
+        Args:
+            light (TrafficLight): next light ahead
+            stop_line ([x, y]): position of its stop line
+
+        Returns:
+            bool: False if the light certainly can't be seen, so no point classifying
+        """
+        car_x = self.pose.pose.position.x
+        car_y = self.pose.pose.position.y
+
+        # Gate on distance to the stop line; beyond this lights are too small to classify
+        distance = math.sqrt((stop_line[0] - car_x) ** 2 + (stop_line[1] - car_y) ** 2)
+        if distance > self.light_visible_max_distance:
+            return False
+
+        # Bearing to the light itself if we know where it is, else to its stop line
+        light_pos = light.pose.pose.position
+        if light_pos.x == 0 and light_pos.y == 0:
+            target_x, target_y = stop_line[0], stop_line[1]
+        else:
+            target_x, target_y = light_pos.x, light_pos.y
+        bearing = math.atan2(target_y - car_y, target_x - car_x) - self.get_car_yaw()
+        bearing = math.atan2(math.sin(bearing), math.cos(bearing)) # wrap to -pi..pi
+
+        return abs(bearing) <= self.camera_half_fov + self.light_visible_fov_margin
+
+    def project_to_image_plane(self, point_in_world):
+        """Projects a point from world coordinates into the camera image
+
+        Args:
+            point_in_world (Point): 3D location of a point in the world
+
+        Returns:
+            (float, float, float): u, v pixel coordinates and depth ahead of the
+                                   camera, or None if no transform or
+                                   camera model available, or the point is behind us
+
+        """
+        camera_info = self.config.get('camera_info', {})
+        if 'focal_length_x' not in camera_info or 'focal_length_y' not in camera_info:
+            return None
+        fx = camera_info['focal_length_x']
+        fy = camera_info['focal_length_y']
+        cx = camera_info['image_width'] / 2.0
+        cy = camera_info['image_height'] / 2.0
+
+        # Get transform between pose of camera and world frame
+        try:
+            trans, rot = self.listener.lookupTransform("/base_link", "/world", rospy.Time(0))
+        except (tf.Exception, tf.LookupException, tf.ConnectivityException):
+            return None
+        transform = tf.transformations.quaternion_matrix(rot)
+        transform[0:3, 3] = trans
+        x, y, z, _ = transform.dot([point_in_world.x, point_in_world.y, point_in_world.z, 1.0])
+
+        if x <= 0.0:
+            # Behind the camera
+            return None
+
+        # Car frame is x forward, y left, z up; image is u right, v down
+        u = fx * -y / x + cx
+        v = fy * -z / x + cy
+        return u, v, x
+
+    def get_light_roi(self, light):
+        """Bounding box in the camera image where we expect to see the light
+
+        Args:
+            light (TrafficLight): light to find in the image
+
+        Returns:
+            (int, int, int, int): x0, y0, x1, y1 pixel box, or None if we can't
+                                  trust the projection and should use the whole frame
+
+        """
+        light_pos = light.pose.pose.position
+        if light_pos.x == 0 and light_pos.y == 0:
+            # No real position for this light (e.g. invented for training grab)
+            return None
+        projection = self.project_to_image_plane(light_pos)
+        if projection is None:
+            return None
+        u, v, distance = projection
+
+        width = self.config['camera_info']['image_width']
+        height = self.config['camera_info']['image_height']
+        if not (0 <= u < width and 0 <= v < height):
+            # Off-screen, so our projection is probably wrong
+            return None
+
+        # Box size scales with apparent size of the light, with plenty of margin
+        # as the light position, transform and camera mounting are all approximate
+        fy = self.config['camera_info']['focal_length_y']
+        half_size = max(self.roi_min_size,
+                        self.roi_margin_factor * fy * self.roi_light_height / distance) / 2.0
+        x0 = int(max(0, u - half_size))
+        x1 = int(min(width, u + half_size))
+        y0 = int(max(0, v - half_size))
+        y1 = int(min(height, v + half_size))
+        if x1 - x0 < self.roi_min_size / 2 or y1 - y0 < self.roi_min_size / 2:
+            # Too much of the box clipped off to be worth it
+            return None
+        return x0, y0, x1, y1
+
+    def get_image_ring(self, msg):
+        """Reader for the shared memory ring buffer a SharedImage refers to"""
+        if msg.ring not in self.image_rings:
+            # Every ring file has a new name, so once the bridge moves to another
+            # (restarted, or frames got bigger) it's done with the old ones
+            self.image_rings = {msg.ring: ImageRingReader(msg.ring)}
+        return self.image_rings[msg.ring]
+
+    def copy_shared_frame(self, msg, accept_newer=False):
+        """Copies the frame a SharedImage refers to out of shared memory
+
+        Args:
+            msg (SharedImage): descriptor from the bridge
+            accept_newer (bool): if the slot has been reused, copy the newer
+                                 frame now in it instead
+
+        Returns:
+            (ndarray, bool): height x width x 3 image and True if it's RGB, or
+                             None if the frame was overwritten before or while
+                             being copied
+        """
+        ring = self.get_image_ring(msg)
+        sequence = ring.slot_sequence(msg.slot)
+        image = None
+        if sequence == msg.sequence or (accept_newer and sequence > msg.sequence):
+            image = ring.view(msg.slot, sequence, msg.height, msg.width)
+        if image is None:
+            # Bridge has already reused its shared memory for newer frames
+            self.latency_stats.count('frames_dropped_overwritten')
+            return None
+        image = image.copy()
+        if not ring.is_current(msg.slot, sequence):
+            # Bridge started writing a newer frame over it while we copied
+            self.latency_stats.count('frames_dropped_torn')
+            return None
+        return image, msg.encoding == "rgb8"
+
+    def get_camera_frame(self):
+        """Pixels of the latest camera image, viewed in place in the message
+           buffer where possible rather than converted by cv_bridge
+
+        Returns:
+            (ndarray, bool): height x width x 3 image, and True if it's RGB
+                             rather than OpenCV's usual BGR
+
+        """
+        if self.camera_frame is not None:
+            # Already copied out of shared memory by process_image()
+            return self.camera_frame
+        try:
+            return image_from_msg(self.camera_image)
+        except ValueError:
+            # Some other encoding, so let cv_bridge deal with it
+            return self.bridge.imgmsg_to_cv2(self.camera_image, "bgr8"), False
+
+    def snap_roi(self, roi, image_shape):
+        """Crop box widened out to multiples of ~scene_cache_roi_grid pixels,
+           within the image"""
+        grid = self.scene_cache_roi_grid
+        x0, y0, x1, y1 = roi
+        return (x0 // grid * grid, y0 // grid * grid,
+                min(image_shape[1], -(-x1 // grid) * grid), min(image_shape[0], -(-y1 // grid) * grid))
+
+    def predict_tracked_roi(self, light, image_shape):
+        """Crop box round where the tracked light should now be, or None to
+           classify the full frame"""
+        if not self.light_tracker or not self.pose:
+            return None
+        speed = self.velocity.twist.linear.x if self.velocity else 0.0
+        return self.light_tracker.predict_roi(self.closest_light_idx, image_shape[1], image_shape[0],
+                                              self.get_distance_to_light(light),
+                                              self.get_car_yaw(), abs(speed))
+
+    def update_light_tracker(self, light, roi, classified_shape, full_frame):
+        """Tells the tracker where the classifier found the light this time
+
+        Args:
+            light (TrafficLight): light we classified
+            roi ((int, int, int, int)): box we cropped to, or None if full frame
+            classified_shape (tuple): shape of image actually classified
+            full_frame (bool): True if the tracker didn't choose the region
+        """
+        if full_frame:
+            self.light_tracker.full_frame_classified()
+        detection = self.light_classifier.last_detection
+        if detection is None or not self.pose:
+            self.light_tracker.reset()
+            return
+        (ymin, xmin, ymax, xmax), score = detection
+        # Detector box is normalised to the image it was given; convert to full frame pixels
+        x_offset, y_offset = (roi[0], roi[1]) if roi is not None else (0, 0)
+        height, width = classified_shape[0], classified_shape[1]
+        box = (x_offset + xmin * width, y_offset + ymin * height,
+               x_offset + xmax * width, y_offset + ymax * height)
+        self.light_tracker.update(self.closest_light_idx, box, score,
+                                  self.get_distance_to_light(light), self.get_car_yaw())
+
     def get_light_state(self, light):
         """Determines the current color of the traffic light
 
@@ -191,19 +1134,18 @@ class TLDetector(object):
         if not self.has_image:
             # We cannot infer state using classifier, nor grab training images
             self.prev_light_loc = None
-        elif self.stub_return_ground_truth and not self.grab_training_images:
+        elif self.stub_return_ground_truth and not self.grab_training_images and not self.shadow_mode:
             # We have no use for the image if not faking it as we're not grabbing images right now
             pass
         else:
             # Either for training data grab or real classification or both, we need an image
-            cv_image = self.bridge.imgmsg_to_cv2(self.camera_image, "bgr8")
+            tic = time.time()
+            cv_image, image_is_rgb = self.get_camera_frame()
+            self.latency_stats.record('image_conversion', time.time() - tic)
 
             if self.grab_training_images:
                 # We now have an image, and a known state for it (if in simulator), so save
                 # it as a training item with ground truth
-                filename = "real" if self.using_real_images else "sim"
-                filename += "_" + str(self.training_image_idx) + "_" + str(light.state) + ".jpg"
-                filename = "../../../data/training_images/" + filename
                 if (self.using_real_images and 
                       self.training_image_idx % self.real_image_grab_decimator != 0):
                     # Skip this image so we don't get too many when using real data
@@ -214,24 +1156,129 @@ class TLDetector(object):
                     pass
                 else:
                     # This is a good time to save a training image
-                    cv2.imwrite(filename, cv_image)
-                    sys.stderr.write("Debug tl_detector: saved training image " + filename + "\n")
+                    self.capture_training_image(cv_image, image_is_rgb, light)
                 # A bit arbitrary but incrementing the image index whether or not we used
                 # the image, so that if we change settings, we will in principle get the same
                 # index at the same point in the simulation or .bag file replay:
                 self.training_image_idx += 1
 
+            if self.shadow_mode:
+                # Ground truth drives; classifier just gets marked on it
+                self.submit_shadow_frame(light, cv_image, image_is_rgb)
+
             if not self.stub_return_ground_truth:
                 # Get classification, this is not a drill!
                 if not self.light_classifier:
                     print("Debug: light_classifier=None so unknown")
                     light_state_inferred = 4
                 else:
-                    light_state_inferred = self.light_classifier.get_classification(cv_image)
+                    light_state_inferred = self.classify_light(light, cv_image, image_is_rgb)
 
         # Return either ground truth for debug or real classifier result for production
         return light_state_known if self.stub_return_ground_truth else light_state_inferred
 
+    def submit_shadow_frame(self, light, cv_image, image_is_rgb):
+        """Offers the frame to the shadow classifier thread, with the light's
+           true state, if the classifier would have been run on it when not
+           in shadow mode"""
+        if not self.light_classifier:
+            return # still loading
+        if self.pose and self.closest_light_idx is not None:
+            stop_line = self.config['stop_line_positions'][self.closest_light_idx]
+            if not self.light_possibly_visible(light, stop_line):
+                return # would have been gated
+            distance = self.get_distance_to_light(light)
+        else:
+            distance = None
+        if self.classify_roi:
+            roi = self.get_light_roi(light)
+            if roi is not None:
+                x0, y0, x1, y1 = roi
+                cv_image = cv_image[y0:y1, x0:x1]
+        self.shadow_mailbox.post({'image': cv_image, 'rgb': image_is_rgb, 'true_state': light.state,
+                                  'stamp': self.camera_image.header.stamp.to_sec(),
+                                  'distance': distance})
+
+    def classify_light(self, light, cv_image, image_is_rgb):
+        """Runs the classifier on the part of the camera image where the light
+           should be, unless nothing has changed since it last did
+
+        Args:
+            light (TrafficLight): light to classify
+            cv_image (ndarray): full camera image
+            image_is_rgb (bool): True if RGB rather than OpenCV's usual BGR
+
+        Returns:
+            int: ID of traffic light color (specified in styx_msgs/TrafficLight)
+
+        """
+        tracked_roi = self.predict_tracked_roi(light, cv_image.shape)
+        roi = tracked_roi
+        if roi is None and self.classify_roi:
+            roi = self.get_light_roi(light)
+        if roi is not None and self.scene_cache:
+            # Tracked boxes shift a little every frame; snapped to a coarse grid,
+            # the crop (and so the cache key and signature) stays put while stopped
+            roi = self.snap_roi(roi, cv_image.shape)
+        if roi is not None:
+            # Only classify the part of the image where the light should be
+            x0, y0, x1, y1 = roi
+            cv_image = cv_image[y0:y1, x0:x1]
+
+        if self.scene_cache and self.pose:
+            # If we're stopped and the scene hasn't changed, reuse the last result
+            position = self.pose.pose.position
+            scene_key = (self.closest_light_idx, roi)
+            signature = self.scene_cache.get_signature(cv_image)
+            car_yaw = self.get_car_yaw()
+            speed = self.velocity.twist.linear.x if self.velocity else 0.0
+            cached_state = self.scene_cache.lookup(scene_key, signature, position.x, position.y,
+                                                   car_yaw, speed, rospy.get_time())
+            if cached_state is not None:
+                # Seeing the same frame again isn't fresh evidence about the light,
+                # so the state filter just carries on with what it already knows
+                self.light_scores = [1.0 / len(SCORE_STATES)] * len(SCORE_STATES)
+                self.latency_stats.count('frames_cached')
+                return cached_state
+
+        if self.classification_scheduler and self.stop_line_distance is not None:
+            # Small input is enough close up, where the light is big
+            max_size = self.classification_scheduler.get_input_size(self.stop_line_distance)
+        else:
+            max_size = None
+
+        tic = time.time()
+        ros_tic = rospy.get_time()
+        light_state_inferred = self.light_classifier.get_classification(cv_image, image_is_rgb, max_size)
+        self.latency_stats.record('classification', time.time() - tic)
+        self.update_expected_classification_time(rospy.get_time() - ros_tic)
+        # Breakdown into preprocess, inference (sess.run), postprocess etc.
+        self.latency_stats.record_all(self.light_classifier.last_timings)
+        self.latency_stats.count('frames_classified')
+        self.light_scores = self.light_classifier.last_scores
+        if self.light_tracker:
+            self.update_light_tracker(light, roi, cv_image.shape, tracked_roi is None)
+        if self.scene_cache and self.pose:
+            self.scene_cache.store(scene_key, signature, position.x, position.y, car_yaw,
+                                   rospy.get_time(), light_state_inferred)
+        return light_state_inferred
+
+    def capture_training_image(self, cv_image, image_is_rgb, light):
+        """Hands the image, with its ground truth state and where we were,
+           to the background writer"""
+        metadata = {'image_type': "real" if self.using_real_images else "sim",
+                    'idx': self.training_image_idx,
+                    'state': light.state,
+                    'stamp': self.camera_image.header.stamp.to_sec(),
+                    'light_idx': self.closest_light_idx}
+        if self.pose:
+            position = self.pose.pose.position
+            metadata.update({'x': position.x, 'y': position.y, 'z': position.z,
+                             'yaw': self.get_car_yaw(),
+                             'distance': self.get_distance_to_light(light)})
+        if not self.capture_writer.submit(cv_image, image_is_rgb, metadata):
+            self.latency_stats.count('capture_dropped')
+
     def good_position_to_save_sim_image(self, closest_light):
         """Considers whether we are within the range limits before a traffic light
            to save a training image, and also whether we have moved far enough since
@@ -286,19 +1333,53 @@ class TLDetector(object):
         return do_grab_image
         
             
+    def classification_due(self, stop_line):
+        """Asks the scheduler whether to classify the light this frame, given
+           how far away its stop line is and how fast we are going
+
+        Args:
+            stop_line ([x, y]): position of stop line of light we're approaching
+
+        Returns:
+            bool: True to classify now
+        """
+        if self.closest_light_idx != self.schedule_light_idx:
+            # New light, so look at it straight away
+            self.classification_scheduler.reset()
+            self.schedule_light_idx = self.closest_light_idx
+        self.stop_line_distance = math.sqrt((stop_line[0] - self.pose.pose.position.x) ** 2 +
+                                            (stop_line[1] - self.pose.pose.position.y) ** 2)
+        speed = self.velocity.twist.linear.x if self.velocity else 0.0
+        now = rospy.get_time()
+        if self.phase_estimator:
+            time_to_change = self.phase_estimator.time_to_change(self.closest_light_idx, now)
+        else:
+            time_to_change = None
+        if not self.classification_scheduler.should_classify(self.stop_line_distance, speed, now,
+                                                             self.expected_classification_time,
+                                                             time_to_change):
+            return False
+        self.classification_scheduler.classified(now)
+        return True
+
     def process_traffic_lights(self):
         """Finds closest visible traffic light, if one exists, and determines its
             location and color
 
         Returns:
             int: index of waypoint closes to the upcoming stop line for a traffic light (-1 if none exists)
-            int: ID of traffic light color (specified in styx_msgs/TrafficLight)
+            int: ID of traffic light color (specified in styx_msgs/TrafficLight), or
+                 None if the classification scheduler says not to look at it this frame
 
         """
         
         # CW: started with example code from walkthrough video at ~3min
         closest_light = None
         light_wp_idx = None
+        self.closest_light_idx = None
+        self.stop_line_distance = None
+        self.light_state_observed = False
+        self.light_gated = False
 
         # List of positions that correspond to the line to stop in front of for a given intersection
         stop_line_positions = self.config['stop_line_positions']
@@ -312,20 +1393,29 @@ class TLDetector(object):
             # CW: starting with walkthrough code suggestion; gets closest in terms of
             #  waypoint index rather than actual distance, but that's fine assuming
             #  waypoints are sorted in list following the route (which they are of course)
-            # List of traffic lights not too long so OK to search all
-            diff = len(self.waypoints.waypoints)
-            for i, light in enumerate(self.lights):
-                # get stop line waypoint index
-                line = stop_line_positions[i]
-                # Go from coords of light stop line to nearest waypoint in our list
-                temp_wp_idx = self.get_closest_waypoint(line[0], line[1])
-                
-                # find closest stop line waypoint index
-                d = temp_wp_idx - car_wp_idx
-                if d >= 0 and d < diff:
-                    diff = d
-                    closest_light = light
-                    light_wp_idx = temp_wp_idx
+            # Stop line waypoints are indexed once when waypoints arrive, so this
+            #  lookup doesn't get slower with the number of intersections on the map
+            line_idx, line_wp_idx = self.get_next_stop_line(car_wp_idx)
+            closest_line = None
+            if line_idx is not None and line_idx < len(self.lights):
+                closest_light = self.lights[line_idx]
+                closest_line = stop_line_positions[line_idx]
+                self.closest_light_idx = line_idx
+                light_wp_idx = line_wp_idx
+
+            if (closest_light and not self.stub_return_ground_truth and
+                    not self.grab_training_images and
+                    not self.light_possibly_visible(closest_light, closest_line)):
+                # Light can't be in view, so skip the expensive classifier and
+                # report it as unknown, i.e. no red light to stop for
+                self.frames_gated += 1
+                self.light_gated = True
+                return light_wp_idx, TrafficLight.UNKNOWN
+
+            if (closest_light and self.classification_scheduler and
+                    not self.stub_return_ground_truth and not self.grab_training_images and
+                    not self.classification_due(closest_line)):
+                return light_wp_idx, None
      
         if not closest_light and self.grab_training_images:
             # When playing from the bag file, we don't have pose information but nevertheless
@@ -337,6 +1427,7 @@ class TLDetector(object):
 
         if closest_light:
             state = self.get_light_state(closest_light)
+            self.light_state_observed = self.closest_light_idx is not None
             #sys.stderr.write("Debug: tl_detector process_traffic_lights() returning light_wp_idx=%d state=%d\n" % (light_wp_idx, state))
             return light_wp_idx, state
         else:
@@ -219,6 +219,11 @@ class CnnClassifierModel():
         # Build optimiser (doesn't actually get run as yet)
         self.logits, self.train_op, self.cross_entropy_loss = self.build_optimizer()
 
+        # Inference outputs, built once here so that classifying images never
+        # adds new ops to the graph
+        self.softmax = tf.nn.softmax(self.logits, name='softmax')
+        self.prediction = tf.argmax(self.logits, axis=1, name='prediction')
+
         # Add operations to save and restore the variables
         self.saver = tf.train.Saver()
 
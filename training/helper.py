@@ -24,6 +24,12 @@ import tensorflow as tf
 from glob import glob
 import subprocess
 import sys
+from io import BytesIO
+
+# Reader for the record files tl_detector saves training images in
+sys.path.insert(0, "../ros/src/tl_detector")
+from light_classification.capture_writer import (SHARD_EXT, find_capture_shards,
+                                                 read_capture_index, read_capture_jpeg)
 
 def maybe_download_file(url, local_path):
     """Download file from the internet, unless we already have it"""
@@ -99,6 +105,7 @@ def get_split_image_paths(proportion_train, img_type, training_dir_list):
     image_paths = []
     for data_folder in training_dir_list:
         image_paths.extend(glob(os.path.join(data_folder, wildcard)))
+        image_paths.extend(get_capture_record_paths(data_folder, img_type))
 
     random.shuffle(image_paths)
     num_train = int(round(len(image_paths) * proportion_train))
@@ -125,6 +132,28 @@ def get_split_image_paths(proportion_train, img_type, training_dir_list):
 
     return training_paths, validation_paths
 
+def get_capture_record_paths(data_folder, img_type):
+    """Images in record files saved by tl_detector, as pseudo paths like
+       folder/capture_20180801_120000_0001.tlrec@1234/sim_12_0.jpg (record file,
+       offset of record in it, then usual image name), so they can be shuffled,
+       flipped and labelled just like ordinary image files"""
+    record_paths = []
+    for shard_file in find_capture_shards(data_folder):
+        for offset, metadata in read_capture_index(shard_file):
+            if img_type == "both" or metadata['image_type'] == img_type:
+                record_paths.append("%s@%d/%s_%d_%d.jpg" % (shard_file, offset, metadata['image_type'],
+                                                            metadata['idx'], metadata['state']))
+    return record_paths
+
+def read_image(image_file):
+    """Reads an image file, or the image in a record file for a pseudo path
+       from get_capture_record_paths()"""
+    if SHARD_EXT + "@" in image_file:
+        shard_file, record = image_file.rsplit(SHARD_EXT + "@", 1)
+        offset = int(record.split("/")[0])
+        return scipy.misc.imread(BytesIO(read_capture_jpeg(shard_file + SHARD_EXT, offset)))
+    return scipy.misc.imread(image_file)
+
 def get_numeric_light_state_from_filename(image_file):
     """Gets 0,1,2,4 integer from end of filename and returns 0-3 integer accordingly"""
 
@@ -169,7 +198,7 @@ def gen_batch_function(image_paths, image_shape, num_classes):
                 if flip_image:
                     image_file = image_file[:-5] # remove ".flip"
                 # Resize whether or not it needs flipping
-                image = scipy.misc.imresize(scipy.misc.imread(image_file), image_shape)
+                image = scipy.misc.imresize(read_image(image_file), image_shape)
                 if flip_image:
                     np.fliplr(image) # image now flipped compared to disk version
 
@@ -198,12 +227,14 @@ def gen_test_output(sess, logits, image_pl, image_paths, keep_prob, image_shape)
     :return: Output for for each test image
     """
     num_correct = 0
+    # Build softmax op once, not once per image which would keep growing the graph
+    softmax = tf.nn.softmax(logits)
     for image_file in image_paths:
-        image = scipy.misc.imresize(scipy.misc.imread(image_file), image_shape)
+        image = scipy.misc.imresize(read_image(image_file), image_shape)
 
         # Run this image through the model in inference mode
         im_softmax = sess.run(
-            [tf.nn.softmax(logits)],
+            [softmax],
             {keep_prob: 1.0, image_pl: [image]})
 
         #print("Debug im_softmax: " + repr(im_softmax))